@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from loadgen import ROOT, HERE, percentile, wait_for_http
+
+############################################################################
+## Benchmark: how long generations outlive their clients in proxy-hpc     ##
+############################################################################
+## Starts the emulating fake_sshd.py with a cancellation log and a        ##
+## proxy-hpc worker, opens N streamed completions and disconnects each    ##
+## after a random number of events, some of them already during prompt    ##
+## processing. The log tells when and why each generation stopped, once   ##
+## with CANCEL_ON_DISCONNECT=0 (the channel is just closed) and once      ##
+## with the cancel command sent to the login node.                        ##
+##                                                                        ##
+##     KEY_NAME=test-key python bench_cancellation.py -n 50 --rate 20     ##
+############################################################################
+
+
+async def abandon(client, url, index, leave_after, timeout, max_tokens):
+    """Streams a completion and disconnects after leave_after events; returns the disconnect time"""
+    body = json.dumps({"model": "bench", "stream": True, "max_tokens": max_tokens,
+                       "messages": [{"role": "user", "content": f"Request {index}"}]})
+    headers = {"X-Consumer-Custom-ID": f"bench-{index}", "inference-id": f"bench-{index}"}
+    events = 0
+    try:
+        async with client.stream("POST", url, content=body, headers=headers, timeout=timeout) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data:"):
+                    events += 1
+                    if events >= leave_after:
+                        break
+    except httpx.TimeoutException:
+        pass    # Left during prompt processing
+    return time.time()
+
+
+async def run_mode(args, cancel):
+    with tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False) as log:
+        log_path = log.name
+    backend = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_sshd.py"), "--emulate", "--port", str(args.ssh_port),
+         "--tokens", str(args.tokens), "--rate", str(args.rate), "--delay", str(args.delay),
+         "--cancel-log", log_path],
+        cwd=HERE, stderr=subprocess.DEVNULL,
+    )
+    env = {**os.environ, "HPC_HOST": "127.0.0.1", "HPC_PORT": str(args.ssh_port), "HPC_USER": "bench",
+           "CANCEL_ON_DISCONNECT": "1" if cancel else "0"}
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "proxy:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=os.path.join(ROOT, "proxy-hpc"), env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        base = f"http://127.0.0.1:{args.port}"
+        await wait_for_http(f"{base}/metrics")
+        await asyncio.sleep(2)  # Let the SSH pool connect
+        rng = random.Random(args.seed)
+        url = f"{base}/passthrough/v1/chat/completions"
+        async with httpx.AsyncClient(limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            tasks = []
+            for i in range(args.concurrency):
+                if rng.random() < args.prefill_share:
+                    # Disconnect while the prompt is still being processed
+                    timeout = httpx.Timeout(args.delay * rng.uniform(0.2, 0.8))
+                    leave_after = 10 ** 9
+                else:
+                    timeout = httpx.Timeout(60)
+                    leave_after = rng.randint(2, args.tokens // 2)
+                tasks.append(asyncio.create_task(abandon(client, url, i, leave_after, timeout, args.tokens)))
+            left = await asyncio.gather(*tasks)
+        await asyncio.sleep(args.delay + args.tokens / args.rate + 1)    # Long enough for any generation to end
+        with open(log_path) as f:
+            stopped = {entry["id"]: entry for entry in map(json.loads, f)}
+    finally:
+        proxy.terminate()
+        backend.terminate()
+        proxy.wait()
+        backend.wait()
+        os.remove(log_path)
+    lag = [stopped[f"bench-{i}"]["time"] - t for i, t in enumerate(left) if f"bench-{i}" in stopped]
+    return {
+        "mode": "cancel" if cancel else "close only",
+        "stopped": len(stopped),
+        "by_cancel": sum(1 for e in stopped.values() if e["reason"] == "cancel"),
+        "wasted_tokens": sum(e["generated"] for e in stopped.values()),
+        "saved_tokens": sum(e["saved"] for e in stopped.values()),
+        "lag_p50_ms": round(percentile(lag, 50) * 1000, 1) if lag else None,
+        "lag_max_ms": round(max(lag) * 1000, 1) if lag else None,
+    }
+
+
+async def main(args):
+    results = [await run_mode(args, cancel) for cancel in (False, True)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.concurrency} abandoned streams, {args.tokens} tokens at {args.rate}/s after {args.delay} s")
+    for r in results:
+        print(f"{r['mode']:>10}: {r['stopped']}/{args.concurrency} stopped early ({r['by_cancel']} by cancel),"
+              f" stop lag p50 {r['lag_p50_ms']} ms, max {r['lag_max_ms']} ms, {r['saved_tokens']} tokens saved")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time generations keep running after their client left proxy-hpc")
+    parser.add_argument("-n", "--concurrency", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=400, help="Tokens each generation would produce")
+    parser.add_argument("--rate", type=float, default=20, help="Tokens per second per stream")
+    parser.add_argument("--delay", type=float, default=2, help="Seconds of emulated prompt processing")
+    parser.add_argument("--prefill-share", type=float, default=0.3,
+                        help="Fraction of clients that leave during prompt processing")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=8793)
+    parser.add_argument("--ssh-port", type=int, default=8794)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from loadgen import ROOT, HERE, percentile, wait_for_http
+
+############################################################################
+## Benchmark: event-loop lag of proxy-azure under long-context chats      ##
+############################################################################
+## Starts fake_openai.py and a proxy-azure worker whose event loop is     ##
+## sampled every few milliseconds, then runs concurrent streamed chats    ##
+## with a long history. The lag is how much later than planned the        ##
+## sampler woke up, so every ms spent in synchronous work such as token   ##
+## counting shows up there. Runs once with the stub reporting usage and   ##
+## once without, where the proxy has to count all tokens itself.          ##
+## tiktoken encodings that cannot be downloaded are replaced with a       ##
+## byte-level BPE over the benchmark's words, using cl100k's pattern.     ##
+## Point --proxy-dir at a checkout of another revision to compare.        ##
+##                                                                        ##
+##     python bench_event_loop_lag.py -c 16 --history-chars 200000        ##
+############################################################################
+
+SAMPLE_INTERVAL = 0.005             # Seconds between samples of the event loop
+CL100K_PATTERN = (r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}++|\p{N}{1,3}+| ?[^\s\p{L}\p{N}]++[\r\n]*+"""
+                  r"""|\s++$|\s*[\r\n]|\s+(?!\S)|\s""")
+SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "sa", "ti", "po", "de", "an", "or", "el", "is", "tok")
+
+
+def vocabulary(seed=0):
+    rng = random.Random(seed)
+    return sorted({"".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))) for _ in range(400)})
+
+
+def synthetic_encoding(name, words):
+    """A byte-level BPE with merges for words, with and without a leading space, and numbers"""
+    import tiktoken
+    pieces = set()
+    for word in [*words, *(" " + w for w in words), *map(str, range(1000))]:
+        data = word.encode()
+        pieces.update(data[:end] for end in range(2, len(data) + 1))
+        pieces.update(data[start:] for start in range(1, len(data) - 1))
+    ranks = {bytes([i]): i for i in range(256)}
+    for piece in sorted(pieces, key=lambda p: (len(p), p)):
+        ranks.setdefault(piece, len(ranks))
+    return tiktoken.Encoding(name, pat_str=CL100K_PATTERN, mergeable_ranks=ranks, special_tokens={})
+
+
+def serve(args):
+    """Runs proxy-azure in this process with a sampler of its event loop and /bench/lag to read the samples"""
+    import uvicorn
+    sys.path.insert(0, args.proxy_dir)
+    os.chdir(args.proxy_dir)
+    import proxy
+    from starlette.responses import JSONResponse
+
+    samples = []
+
+    async def sample():
+        while True:
+            planned = time.perf_counter() + SAMPLE_INTERVAL
+            await asyncio.sleep(SAMPLE_INTERVAL)
+            samples.append(max(0.0, time.perf_counter() - planned))
+
+    async def start_sampler():
+        asyncio.get_running_loop().create_task(sample())
+        await proxy.prewarm_task
+        # Only encodings that failed to download are replaced
+        for name in ("cl100k_base", "o200k_base"):
+            proxy.encodings._encodings.setdefault(name, synthetic_encoding(name, vocabulary()))
+        proxy.encodings._missing = set()
+
+    async def lag(request):
+        """Samples since the last call"""
+        taken = samples[:]
+        del samples[:len(taken)]
+        return JSONResponse(taken)
+
+    proxy.app.add_event_handler("startup", start_sampler)
+    proxy.app.add_route("/bench/lag", lag)
+    uvicorn.run(proxy.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+def history(chars, seed):
+    """Alternating user and assistant messages of about chars characters in total"""
+    rng = random.Random(seed)
+    words = vocabulary()
+    messages = []
+    size = 0
+    while size < chars:
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(50, 400)))
+        messages.append({"role": "user" if len(messages) % 2 == 0 else "assistant", "content": text})
+        size += len(text)
+    messages.append({"role": "user", "content": "Summarize the conversation."})
+    return messages
+
+
+async def chat(client, url, body, deadline, latencies):
+    headers = {"X-Consumer-Custom-ID": "bench", "inference-service": "openai-gpt4o-mini",
+               "Content-Type": "application/json"}
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        async with client.stream("POST", url, content=body, headers=headers) as response:
+            async for _ in response.aiter_bytes():
+                pass
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+
+
+def summarize_tokens(metrics_text):
+    tokens = {}
+    for line in metrics_text.splitlines():
+        if line.startswith("proxy_tokens_total{"):
+            direction = line.split('direction="')[1].split('"')[0]
+            tokens[direction] = tokens.get(direction, 0) + float(line.rsplit(" ", 1)[1])
+    return tokens
+
+
+async def run_mode(args, usage):
+    backend = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_openai.py"), "--port", str(args.azure_port),
+         "--tokens", str(args.tokens), "--rate", str(args.rate), *([] if usage else ["--no-usage"])],
+        cwd=HERE, stderr=subprocess.DEVNULL,
+    )
+    metrics_dir = tempfile.mkdtemp(prefix="bench-lag-")
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--proxy-dir", args.proxy_dir,
+         "--port", str(args.port)],
+        env={**os.environ, "PROMETHEUS_MULTIPROC_DIR": metrics_dir}, stdout=subprocess.DEVNULL,
+    )
+    try:
+        base = f"http://127.0.0.1:{args.port}"
+        await wait_for_http(f"{base}/metrics")
+        async with httpx.AsyncClient(timeout=120) as client:
+            while (await client.get(f"{base}/ready")).status_code != 200:
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.5)
+            await client.get(f"{base}/bench/lag")
+            body = json.dumps({"model": "x", "stream": True, "messages": history(args.history_chars, args.seed)})
+            latencies = []
+            started = time.perf_counter()
+            deadline = started + args.duration
+            url = f"{base}/passthrough/v1/chat/completions"
+            await asyncio.gather(*(chat(client, url, body, deadline, latencies) for _ in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+            lag = (await client.get(f"{base}/bench/lag")).json()
+            tokens = summarize_tokens((await client.get(f"{base}/metrics")).text)
+    finally:
+        server.terminate()
+        backend.terminate()
+        server.wait()
+        backend.wait()
+    return {
+        'mode': "usage" if usage else "counted",
+        'requests': len(latencies),
+        'requests_per_s': len(latencies) / elapsed,
+        'latency_p50': percentile(latencies, 50),
+        'lag_p50': percentile(lag, 50),
+        'lag_p99': percentile(lag, 99),
+        'lag_max': max(lag) if lag else None,
+        'lag_over_10ms': sum(1 for sample in lag if sample > 0.01) / len(lag) if lag else None,
+        'stalled_per_s': sum(lag) / elapsed,
+        'tokens_per_request': {k: v / max(1, len(latencies)) for k, v in tokens.items()},
+    }
+
+
+async def main(args):
+    reports = [await run_mode(args, usage) for usage in args.modes]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+    print(f"{args.concurrency} chats with {args.history_chars} characters of history and {args.tokens} output tokens, "
+          f"{os.path.relpath(args.proxy_dir, ROOT)}")
+    for report in reports:
+        tokens = ", ".join(f"{k} {v:.0f}" for k, v in sorted(report['tokens_per_request'].items()))
+        print(f"{report['mode']:>7}: {report['requests_per_s']:.1f} req/s, latency p50 {report['latency_p50'] * 1000:.0f} ms"
+              f" | loop lag p50 {report['lag_p50'] * 1000:.2f} ms, p99 {report['lag_p99'] * 1000:.1f} ms, "
+              f"max {report['lag_max'] * 1000:.1f} ms, {report['lag_over_10ms'] * 100:.1f}% over 10 ms, "
+              f"stalled {report['stalled_per_s'] * 1000:.0f} ms/s"
+              f" | tokens per request: {tokens}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Event-loop lag of proxy-azure under long-context chats")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=15, help="Seconds of load per mode")
+    parser.add_argument("--history-chars", type=int, default=200000, help="Characters of history per chat")
+    parser.add_argument("--tokens", type=int, default=300, help="Output tokens per response")
+    parser.add_argument("--rate", type=float, default=50, help="Output tokens per second per stream, 0 = unlimited")
+    parser.add_argument("--modes", default="usage,counted",
+                        help="usage: the stub reports usage; counted: the proxy counts all tokens")
+    parser.add_argument("--proxy-dir", default=os.path.join(ROOT, "proxy-azure"))
+    parser.add_argument("--port", type=int, default=8797)
+    parser.add_argument("--azure-port", type=int, default=8999, help="Port of the stub in openai_config")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.proxy_dir = os.path.abspath(args.proxy_dir)
+    if args.serve:
+        serve(args)
+        sys.exit(0)
+    modes = args.modes.split(",")
+    if set(modes) - {"usage", "counted"}:
+        parser.error("modes must be usage and/or counted")
+    args.modes = [mode == "usage" for mode in modes]
+    asyncio.run(main(args))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy-azure"))
+from images import image_size
+
+############################################################################
+## Microbenchmark: image sizes for vision token accounting in proxy-azure ##
+############################################################################
+## Compares the previous path (regex over the data URL, decode all of     ##
+## the base64 data, open it with PIL) with the header probe of images.py  ##
+## on noise images of several MB in every supported format, and a JPEG    ##
+## with half a MiB of ICC profile ahead of its frame header.              ##
+##                                                                        ##
+##     python bench_image_probe.py --sizes 10 20                          ##
+############################################################################
+
+FORMATS = (
+    # Name, PIL format, encoded bytes per pixel of noise, save options
+    ("png", "PNG", 3, {}),
+    ("jpeg", "JPEG", 2, {"quality": 100}),
+    ("jpeg-icc", "JPEG", 2, {"quality": 100, "icc_profile": b"\0" * 512 * 1024}),
+    ("gif", "GIF", 1.4, {}),
+    ("webp", "WEBP", 3, {"lossless": True}),
+)
+
+
+def legacy_size(url):
+    """The image size as extract_tokens read it before the header probe"""
+    match = re.search(r"data:image/(.*);base64,(.*)", url)
+    decoded_image = base64.b64decode(match.group(2))
+    image = Image.open(io.BytesIO(decoded_image))
+    return image.size
+
+
+def make_image(image_format, bytes_per_pixel, options, size, seed):
+    """A data URL of a noise image of about size bytes; noise keeps the encoders from compressing it"""
+    side = int((size / bytes_per_pixel) ** 0.5)
+    width, height = side + side // 3, side - side // 4
+    rng = random.Random(seed)
+    mode = "L" if image_format == "GIF" else "RGB"
+    image = Image.frombytes(mode, (width, height), rng.randbytes(width * height * len(mode)))
+    data = io.BytesIO()
+    image.save(data, image_format, **options)
+    return f"data:image/{image_format.lower()};base64," + base64.b64encode(data.getvalue()).decode(), (width, height)
+
+
+def measure(fn, url, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(url)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(url)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main(args):
+    results = []
+    for name, image_format, bytes_per_pixel, options in FORMATS:
+        for mb in args.sizes:
+            url, expected = make_image(image_format, bytes_per_pixel, options, mb * 1024 * 1024, args.seed)
+            row = {"format": name, "size_mb": round(len(url) * 3 / 4 / 2**20, 2)}
+            for path, fn in (("legacy", legacy_size), ("probe", image_size)):
+                size, seconds, peak = measure(fn, url, args.repeat)
+                assert tuple(size) == expected, (path, name, size, expected)
+                row[f"{path}_ms"] = round(seconds * 1000, 3)
+                row[f"{path}_peak_kb"] = round(peak / 1024, 1)
+            row["speedup"] = round(row["legacy_ms"] / row["probe_ms"])
+            results.append(row)
+            if not args.json:
+                print(f"{name:8} {row['size_mb']:7.2f} MB  legacy {row['legacy_ms']:8.2f} ms {row['legacy_peak_kb']:9.1f} KiB"
+                      f"  probe {row['probe_ms']:7.3f} ms {row['probe_peak_kb']:7.1f} KiB  x{row['speedup']}")
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Image size probe microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 20], help="Image sizes in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    main(parser.parse_args())
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from loadgen import HERE
+
+############################################################################
+## Benchmark: SSE passthrough against OpenAI client objects, proxy-azure  ##
+############################################################################
+## Runs loadgen.py against proxy-azure and fake_openai.py twice, first    ##
+## with OPENAI_PASSTHROUGH=0, where every chunk is parsed into an OpenAI  ##
+## client object and serialized again, then with the SSE bytes passed     ##
+## through, and compares the second run with the first. Arguments after   ##
+## -- go to loadgen.py.                                                   ##
+##                                                                        ##
+##     python bench_passthrough.py -- -c 32 --rate 0 --prompt-size 100000 ##
+############################################################################
+
+
+def run(loadgen_args, passthrough, report, baseline=None):
+    command = [sys.executable, os.path.join(HERE, "loadgen.py"), "--launch", "azure", "--json", report, *loadgen_args]
+    if baseline:
+        command += ["--baseline", baseline]
+    print(f"OPENAI_PASSTHROUGH={int(passthrough)}", flush=True)
+    subprocess.run(command, cwd=HERE, check=True, env={**os.environ, "OPENAI_PASSTHROUGH": str(int(passthrough))})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SSE passthrough against OpenAI client objects in proxy-azure")
+    parser.add_argument("loadgen_args", nargs="*", help="Arguments for loadgen.py, after --")
+    args = parser.parse_args()
+    loadgen_args = args.loadgen_args or ["-c", "32", "--duration", "15", "--rate", "0", "--tokens", "256"]
+    with tempfile.TemporaryDirectory() as tmp:
+        objects = os.path.join(tmp, "objects.json")
+        run(loadgen_args, False, objects)
+        run(loadgen_args, True, os.path.join(tmp, "passthrough.json"), baseline=objects)
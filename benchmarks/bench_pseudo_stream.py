@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import warnings
+
+from openai.types.chat import ChatCompletion
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy-azure"))
+from rechunk import ChunkTemplate, WORD
+
+############################################################################
+## Microbenchmark: pseudo-streaming of o1 completions in proxy-azure      ##
+############################################################################
+## Compares the previous path, one event per character built as a dict    ##
+## and serialized with json.dumps, with the events of a ChunkTemplate     ##
+## per word and per 64 bytes. Reports the CPU time per answer, the        ##
+## events and bytes sent, and checks that the events carry the answer.    ##
+##                                                                        ##
+##     python bench_pseudo_stream.py --sizes 1000 10000 100000            ##
+############################################################################
+
+WORDS = ("the", "reaction", "of", "a", "sample", "is", "measured", "at", "room", "temperature", "über", "résumé",
+         "Δx", "≈", "42", "and", "(see", "Table", "3).", "\n\n")
+
+
+def make_completion(chars, seed):
+    rng = random.Random(seed)
+    text = ""
+    while len(text) < chars:
+        text += rng.choice(WORDS) + " "
+    return ChatCompletion.model_validate({
+        "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "o1-2024-12-17",
+        "system_fingerprint": "fp_bench",
+        "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                     "message": {"role": "assistant", "content": text[:chars], "function_call": None, "tool_calls": None},
+                     "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}}}],
+        "usage": {"prompt_tokens": 100, "completion_tokens": chars // 4, "total_tokens": 100 + chars // 4},
+    })
+
+
+def legacy_events(response):
+    """The o1 branch of the stream generator as it was before ChunkTemplate"""
+    message = response.choices[0].message.dict()
+    full_response = message["content"]
+    choice = response.choices[0].dict()
+    completion = response.dict()
+    for r_char in full_response:
+        r = {"id": completion["id"],
+            "choices": [{"delta": {"content": str(r_char),
+                                    "function_call": message["function_call"],
+                                    "role": None,
+                                    "tool_calls": message["tool_calls"]},
+                            "finish_reason": None,
+                            "index": choice["index"],
+                            "logprobs": choice["logprobs"],
+                            "content_filter_results":choice["content_filter_results"]}],
+            "created": completion["created"],
+            "model": completion["model"],
+            "object": "chat.completion.chunk",
+            "system_fingerprint": completion["system_fingerprint"]
+        }
+        response_str = 'data: ' + json.dumps(r) + '\n'
+        yield response_str
+
+
+def template_events(chunking):
+    def events(response):
+        completion = response.dict()
+        yield from ChunkTemplate(completion).events(completion["choices"][0]["message"]["content"], chunking)
+    return events
+
+
+def replay(writes):
+    """The content of the events in the writes, and the number of events"""
+    events = [line for write in writes for line in write.split('\n') if line]
+    return "".join(json.loads(event[6:])["choices"][0]["delta"]["content"] for event in events), len(events)
+
+
+def measure(fn, response, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.process_time()
+        writes = list(fn(response))
+        best = min(best, time.process_time() - start)
+    return writes, best
+
+
+def main(args):
+    warnings.simplefilter("ignore", DeprecationWarning)   # .dict(), as the proxy calls it
+    results = []
+    paths = (("legacy", legacy_events), ("word", template_events(WORD)), ("64 bytes", template_events(64)))
+    for chars in args.sizes:
+        response = make_completion(chars, args.seed)
+        for name, fn in paths:
+            writes, seconds = measure(fn, response, args.repeat)
+            content, events = replay(writes)
+            assert content == response.choices[0].message.content, name
+            row = {"chars": chars, "path": name, "cpu_ms": round(seconds * 1000, 2), "events": events,
+                   "yields": len(writes), "kib": round(sum(map(len, writes)) / 1024, 1)}
+            results.append(row)
+            if not args.json:
+                print(f"{chars:7} chars  {name:8}  {row['cpu_ms']:9.2f} ms CPU  {events:7} events  "
+                      f"{row['yields']:7} yields  {row['kib']:9.1f} KiB")
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pseudo-streaming microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000], help="Answer sizes in characters")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    main(parser.parse_args())
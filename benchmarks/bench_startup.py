@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+import httpx
+
+from loadgen import ROOT, HERE, DEFAULT_SERVICES
+
+############################################################################
+## Benchmark: import and cold-start time of both proxies                  ##
+############################################################################
+## Profiles `import proxy` with -X importtime and lists the slowest       ##
+## direct imports, then starts the fake backend and a fresh proxy worker  ##
+## several times and measures how long the proxy takes to accept          ##
+## connections, to report /ready, and to answer its first and second      ##
+## request. Results are checked against a startup budget; the exit code   ##
+## is 1 if a median exceeds it.                                           ##
+##                                                                        ##
+##     KEY_NAME=test-key python bench_startup.py --runs 5                 ##
+############################################################################
+
+IMPORT_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def profile_imports(proxy_dir, env):
+    """Returns (total seconds, [(module, cumulative seconds)] of the direct imports of proxy)"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import proxy"], cwd=proxy_dir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    total = 0.0
+    direct = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        if not match:
+            continue
+        cumulative, indent, module = int(match.group(2)) / 1e6, len(match.group(3)), match.group(4)
+        if module == "proxy" and indent == 0:
+            total = cumulative
+        elif indent == 2:
+            direct.append((module, cumulative))
+    return total, sorted(direct, key=lambda item: -item[1])
+
+
+def interpreter_startup():
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.perf_counter() - started
+
+
+async def poll(client, url, deadline, ok=lambda response: True):
+    """Polls url until ok(response); returns the time it happened"""
+    while time.perf_counter() < deadline:
+        try:
+            response = await client.get(url)
+            if ok(response):
+                return time.perf_counter()
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.01)
+    raise RuntimeError(f"{url} not ready in time")
+
+
+def prewarmed(response):
+    """Ready, or degraded because the encodings cannot be downloaded where the benchmark runs"""
+    return response.status_code == 200 or (response.status_code == 503 and
+                                           response.json().get('status') == 'degraded')
+
+
+async def timed_request(client, url, headers, body):
+    started = time.perf_counter()
+    async with client.stream("POST", url, content=body, headers=headers) as response:
+        async for _ in response.aiter_bytes():
+            pass
+    if response.status_code != 200:
+        raise RuntimeError(f"Request failed with {response.status_code}")
+    return time.perf_counter() - started
+
+
+async def cold_start(proxy, proxy_dir, env, args):
+    """Starts one proxy worker; returns its timings in seconds from the process start"""
+    base = f"http://127.0.0.1:{args.port}"
+    service = DEFAULT_SERVICES[proxy]
+    headers = {"X-Consumer-Custom-ID": "bench", "inference-service": service}
+    body = json.dumps({"model": service, "stream": True, "messages": [{"role": "user", "content": "Hello"}]})
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "proxy:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=proxy_dir, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        async with httpx.AsyncClient(timeout=30) as client:
+            deadline = started + args.timeout
+            listening = await poll(client, f"{base}/metrics", deadline)
+            ready = await poll(client, f"{base}/ready", deadline, prewarmed)
+            url = f"{base}/passthrough/v1/chat/completions"
+            first = await timed_request(client, url, headers, body)
+            second = await timed_request(client, url, headers, body)
+    finally:
+        process.terminate()
+        process.wait()
+    return {
+        'listening': listening - started,
+        'ready': ready - started,
+        'first_request': first,
+        'second_request': second,
+    }
+
+
+async def run_proxy(proxy, args):
+    proxy_dir = os.path.join(ROOT, f"proxy-{proxy}")
+    if proxy == 'hpc':
+        backend = [sys.executable, os.path.join(HERE, "fake_sshd.py"), "--emulate", "--port", str(args.backend_port),
+                   "--tokens", "16", "--rate", "0", "--delay", "0"]
+        env = {**os.environ, 'HPC_HOST': '127.0.0.1', 'HPC_PORT': str(args.backend_port), 'HPC_USER': 'bench'}
+    else:
+        backend = [sys.executable, os.path.join(HERE, "fake_openai.py"), "--port", str(args.azure_port),
+                   "--tokens", "16", "--rate", "0", "--delay", "0"]
+        env = dict(os.environ)
+    import_total, direct = profile_imports(proxy_dir, env)
+    backend = subprocess.Popen(backend, cwd=HERE, stderr=subprocess.DEVNULL)
+    try:
+        await asyncio.sleep(1)
+        runs = [await cold_start(proxy, proxy_dir, env, args) for _ in range(args.runs)]
+    finally:
+        backend.terminate()
+        backend.wait()
+    report = {'proxy': proxy, 'import': import_total, 'slowest_imports': direct[:args.top]}
+    for key in runs[0]:
+        report[key] = statistics.median(run[key] for run in runs)
+    return report
+
+
+def check_budget(report, args):
+    """Returns the budget items the report exceeds"""
+    budget = {'import': args.import_budget, 'ready': args.ready_budget, 'first_request': args.request_budget}
+    return [f"{key} {report[key]:.3f} s > {limit} s" for key, limit in budget.items() if report[key] > limit]
+
+
+async def main(args):
+    reports = [await run_proxy(proxy, args) for proxy in args.proxies or ("hpc", "azure")]
+    over = {report['proxy']: check_budget(report, args) for report in reports}
+    if args.json:
+        print(json.dumps({'interpreter': interpreter_startup(), 'reports': reports, 'over_budget': over}, indent=2))
+    else:
+        print(f"python -c pass: {interpreter_startup() * 1000:.0f} ms, medians of {args.runs} cold starts")
+        for report in reports:
+            print(f"proxy-{report['proxy']}: import {report['import'] * 1000:.0f} ms, "
+                  f"listening after {report['listening'] * 1000:.0f} ms, ready after {report['ready'] * 1000:.0f} ms, "
+                  f"first request {report['first_request'] * 1000:.1f} ms, "
+                  f"second {report['second_request'] * 1000:.1f} ms")
+            print("    slowest imports: " + ", ".join(f"{module} {seconds * 1000:.0f} ms"
+                                                     for module, seconds in report['slowest_imports']))
+            for item in over[report['proxy']]:
+                print(f"    OVER BUDGET: {item}")
+    return 1 if any(over.values()) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import and cold-start times of proxy-hpc and proxy-azure")
+    parser.add_argument("proxies", nargs="*", help="hpc and/or azure (default both)")
+    parser.add_argument("--runs", type=int, default=3, help="Cold starts per proxy")
+    parser.add_argument("--top", type=int, default=6, help="Slowest direct imports to list")
+    parser.add_argument("--port", type=int, default=8795)
+    parser.add_argument("--backend-port", type=int, default=8796, help="Port of the fake SSH server")
+    parser.add_argument("--azure-port", type=int, default=8999, help="Port of the stub in openai_config")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds a cold start may take at most")
+    parser.add_argument("--import-budget", type=float, default=1.5, help="Seconds for importing the proxy module")
+    parser.add_argument("--ready-budget", type=float, default=3.0, help="Seconds from process start to /ready")
+    parser.add_argument("--request-budget", type=float, default=0.5, help="Seconds for the first request")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+    if set(args.proxies) - {"hpc", "azure"}:
+        parser.error("proxies must be hpc or azure")
+    sys.exit(asyncio.run(main(args)))
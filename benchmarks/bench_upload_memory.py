@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import psutil
+
+############################################################################
+## Benchmark: peak memory of proxy-hpc under concurrent large uploads     ##
+############################################################################
+## Starts fake_sshd.py and a proxy-hpc worker, sends N concurrent uploads ##
+## of the given size and samples the worker's RSS while they run, once    ##
+## with buffered bodies (STREAM_UPLOADS=0) and once with streamed ones.   ##
+## The proxy reads its key from /run/secrets/$KEY_NAME as usual.          ##
+##                                                                        ##
+##     KEY_NAME=test-key python bench_upload_memory.py -n 100 --size 10   ##
+############################################################################
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PROXY_DIR = os.path.join(HERE, "..", "proxy-hpc")
+CHUNK_SIZE = 64 * 1024
+
+
+def make_body(size, model_first):
+    """A chat request of roughly size bytes, with the model before or after the messages"""
+    content = "x" * size
+    if model_first:
+        body = {"model": "bench", "stream": True, "messages": [{"role": "user", "content": content}]}
+    else:
+        body = {"messages": [{"role": "user", "content": content}], "stream": True, "model": "bench"}
+    return json.dumps(body).encode()
+
+
+async def upload(client, url, body, uid):
+    async def chunks():
+        for i in range(0, len(body), CHUNK_SIZE):
+            yield body[i:i + CHUNK_SIZE]
+    started = time.perf_counter()
+    headers = {"X-Consumer-Custom-ID": uid}    # Distinct users, so the per-user queue cap does not apply
+    async with client.stream("POST", url, content=chunks(), headers=headers) as response:
+        async for _ in response.aiter_bytes():
+            pass
+    return response.status_code, time.perf_counter() - started
+
+
+async def sample_rss(pid, samples, stop):
+    process = psutil.Process(pid)
+    while not stop.is_set():
+        samples.append(process.memory_info().rss)
+        try:
+            await asyncio.wait_for(stop.wait(), 0.05)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def wait_for_port(url, timeout=15):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+async def run_mode(args, streamed, body):
+    env = {
+        **os.environ,
+        "HPC_HOST": "127.0.0.1",
+        "HPC_PORT": str(args.ssh_port),
+        "HPC_USER": "bench",
+        "STREAM_UPLOADS": "1" if streamed else "0",
+    }
+    proxy = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "proxy:app", "--port", str(args.port), "--log-level", "warning"],
+        cwd=PROXY_DIR, env=env,
+    )
+    try:
+        base = f"http://127.0.0.1:{args.port}"
+        await wait_for_port(f"{base}/health")
+        idle_rss = psutil.Process(proxy.pid).memory_info().rss
+        samples, stop = [], asyncio.Event()
+        sampler = asyncio.create_task(sample_rss(proxy.pid, samples, stop))
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(upload(client, f"{base}/passthrough/v1/chat/completions", body, f"bench-{i}")
+                                             for i in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+        stop.set()
+        await sampler
+        return {
+            "mode": "streamed" if streamed else "buffered",
+            "ok": sum(1 for status, _ in results if status == 200),
+            "statuses": dict(collections.Counter(status for status, _ in results)),
+            "idle_rss_mb": round(idle_rss / 2**20, 1),
+            "peak_rss_mb": round(max(samples) / 2**20, 1),
+            "elapsed_s": round(elapsed, 2),
+            "upload_mb_s": round(len(body) * args.concurrency / 2**20 / elapsed, 1),
+        }
+    finally:
+        proxy.terminate()
+        proxy.wait()
+
+
+async def main(args):
+    sshd = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_sshd.py"), "--port", str(args.ssh_port)],
+                            stderr=subprocess.DEVNULL)
+    try:
+        await asyncio.sleep(1)
+        body = make_body(args.size * 2**20, not args.model_last)
+        results = [await run_mode(args, streamed, body) for streamed in (False, True)]
+    finally:
+        sshd.terminate()
+        sshd.wait()
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{args.concurrency} concurrent uploads of {len(body) / 2**20:.1f} MB"
+          f" (model {'last' if args.model_last else 'first'})")
+    for r in results:
+        print(f"{r['mode']:>9}: {r['ok']}/{args.concurrency} ok, idle {r['idle_rss_mb']} MB,"
+              f" peak {r['peak_rss_mb']} MB, {r['elapsed_s']} s, {r['upload_mb_s']} MB/s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Peak RSS of proxy-hpc with concurrent large uploads")
+    parser.add_argument("-n", "--concurrency", type=int, default=100)
+    parser.add_argument("--size", type=int, default=10, help="Body size in MB")
+    parser.add_argument("--model-last", action="store_true", help="Put the model after the messages")
+    parser.add_argument("--port", type=int, default=8791)
+    parser.add_argument("--ssh-port", type=int, default=8792)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import argparse
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tools"))
+import usage_analytics
+
+############################################################################
+## Benchmark: ingestion and rollups of tools/usage_analytics.py           ##
+############################################################################
+## Writes months of synthetic usage ledgers like the proxies do, ingests  ##
+## them in several rounds as if tailing them, and times rollup queries    ##
+## over the store. Checks that every inference is stored once and that    ##
+## the token totals match the ledgers.                                    ##
+##                                                                        ##
+##     python bench_usage_analytics.py --months 6 --per-month 500000      ##
+############################################################################
+
+SERVICES = ("openai-gpt4o", "openai-gpt4o-mini", "openai-o1", "meta-llama-3.1-8b-instruct", "qwen2.5-72b-instruct")
+PORTALS = ("Chat AI", "API")
+STATUSES = ("COMPLETED", "COMPLETED", "COMPLETED", "FAILED", "CANCELLED")
+QUERIES = (
+    ("total", {}),
+    ("by service", {'by': ['service']}),
+    ("by o, service, month", {'by': ['o', 'service'], 'bucket': 'month'}),
+    ("by uid, day, one service", {'by': ['uid'], 'bucket': 'day', 'where': {'service': {"openai-gpt4o"}}}),
+    ("by portal, hour, last month", {'by': ['portal'], 'bucket': 'hour', 'last_month': True}),
+)
+
+
+def write_ledgers(directory, months, per_month, users, seed):
+    """Monthly ledgers of request and response records; returns the month after the last and the token totals"""
+    rng = random.Random(seed)
+    totals = [0, 0]
+    month = datetime.datetime(2025, 1, 1)
+    for _ in range(months):
+        following = (month + datetime.timedelta(days=32)).replace(day=1)
+        seconds = (following - month).total_seconds()
+        with open(os.path.join(directory, f"usage-{month:%Y-%m}.jsonl"), 'w') as f:
+            for start in sorted(rng.uniform(0, seconds) for _ in range(per_month)):
+                user = rng.randrange(users)
+                started = month + datetime.timedelta(seconds=start)
+                inference = {'id': str(uuid.UUID(int=rng.getrandbits(128))), 'uid': f"user{user}@example.org",
+                             'o': f"org{user % 40}", 'ou': f"unit{user % 200}", 'service': rng.choice(SERVICES),
+                             'input_size': rng.randint(10, 20000), 'start_timestamp': started.isoformat(),
+                             'portal': rng.choice(PORTALS), 'status': "PENDING"}
+                f.write(json.dumps({'v': 1, 'event': 'request', 'logged_at': started.isoformat(), **inference}) + "\n")
+                inference['status'] = rng.choice(STATUSES)
+                ended = started + datetime.timedelta(seconds=rng.lognormvariate(1, 0.8))
+                inference['end_timestamp'] = ended.isoformat()
+                inference['output_size'] = rng.randint(10, 8000)
+                inference['input_tokens'] = inference['input_size'] // 4
+                inference['output_tokens'] = inference['output_size'] // 4
+                totals[0] += inference['input_tokens']
+                totals[1] += inference['output_tokens']
+                f.write(json.dumps({'v': 1, 'event': 'response', 'logged_at': inference['end_timestamp'],
+                                    **inference}) + "\n")
+        month = following
+    return month, totals
+
+
+def grow(sources, directory, rounds):
+    """Appends the ledgers to copies in directory in order, in rounds cut even inside lines; yields after each"""
+    sizes = [os.path.getsize(source) for source in sources]
+    total = sum(sizes)
+    for r in range(rounds):
+        low, high = total * r // rounds, total * (r + 1) // rounds
+        offset = 0
+        for source, size in zip(sources, sizes):
+            start, end = max(low - offset, 0), min(high - offset, size)
+            if start < end:
+                with open(source, 'rb') as f, open(os.path.join(directory, os.path.basename(source)), 'ab') as out:
+                    f.seek(start)
+                    while start < end:
+                        block = f.read(min(end - start, 2**24))
+                        out.write(block)
+                        start += len(block)
+            offset += size
+        yield
+
+
+def main(args):
+    work = tempfile.mkdtemp(prefix="bench-analytics-")
+    try:
+        ledgers = os.path.join(work, "ledgers")
+        logs = os.path.join(work, "log")
+        store = os.path.join(work, "store")
+        os.makedirs(ledgers)
+        os.makedirs(logs)
+        started = time.perf_counter()
+        end, totals = write_ledgers(ledgers, args.months, args.per_month, args.users, args.seed)
+        print(f"Wrote {args.months} months of {args.per_month} inferences in {time.perf_counter() - started:.1f} s")
+        paths = sorted(os.path.join(ledgers, name) for name in os.listdir(ledgers))
+        ledger_size = sum(os.path.getsize(path) for path in paths)
+
+        stored = 0
+        started = time.perf_counter()
+        for _ in grow(paths, logs, args.rounds):
+            stored += usage_analytics.ingest(store, [logs])
+        elapsed = time.perf_counter() - started
+        store_size = sum(os.path.getsize(os.path.join(root, name))
+                         for root, _, names in os.walk(store) for name in names)
+        print(f"Ingested {stored} inferences in {args.rounds} rounds in {elapsed:.1f} s "
+              f"({stored / elapsed:.0f}/s); ledgers {ledger_size / 2**20:.0f} MiB, store {store_size / 2**20:.1f} MiB")
+        assert stored == args.months * args.per_month, stored
+
+        for name, options in QUERIES:
+            options = dict(options)
+            if options.pop('last_month', False):
+                last = (end - datetime.timedelta(days=1)).replace(day=1)
+                options['since'] = (last - usage_analytics.EPOCH).total_seconds()
+            started = time.perf_counter()
+            results = usage_analytics.query(store, **options)
+            elapsed = time.perf_counter() - started
+            if name == "total":
+                assert (results[0]['input_tokens'], results[0]['output_tokens']) == tuple(totals), results
+            print(f"{name:28} {len(results):7} groups in {elapsed:6.2f} s")
+    finally:
+        shutil.rmtree(work)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Usage analytics benchmark")
+    parser.add_argument("--months", type=int, default=6)
+    parser.add_argument("--per-month", type=int, default=200000, help="Inferences per month")
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--rounds", type=int, default=4, help="Ingests while the ledgers grow")
+    parser.add_argument("--seed", type=int, default=0)
+    main(parser.parse_args())
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "proxy-hpc"))
+from accounting import UsageExtractor
+
+############################################################################
+## Microbenchmark: token accounting in the proxy-hpc stream_generator     ##
+############################################################################
+## Compares the previous path (concatenate every chunk, decode, split on  ##
+## blank lines, json-parse events in reverse) with the incremental        ##
+## UsageExtractor on multi-MB SSE streams and JSON bodies.                ##
+##                                                                        ##
+##     python bench_usage_extraction.py --sizes 4 16 64                   ##
+############################################################################
+
+CHUNK_SIZE = 4096                   # Read size of stream_generator
+
+
+def legacy_extract_tokens(response):
+    """extract_tokens as it was before the incremental extractor"""
+    input_tokens = 0
+    output_tokens = 0
+    try:
+        response = response.decode()
+    except Exception:
+        return input_tokens, output_tokens
+    events = response.split('\n\n')
+    for event in reversed(events):
+        try:
+            if event.startswith('data: '):
+                payload = json.loads(event[6:])
+            else:
+                payload = json.loads(event)
+            if 'usage' in payload:
+                usage = payload['usage']
+                input_tokens = usage.get('prompt_tokens', 0)
+                output_tokens = usage.get('completion_tokens', 0)
+                break
+        except json.JSONDecodeError:
+            pass
+    return input_tokens, output_tokens
+
+
+def legacy_path(chunks):
+    full_response = b''
+    for chunk in chunks:
+        full_response += chunk
+    return len(full_response), legacy_extract_tokens(full_response)
+
+
+def incremental_path(chunks):
+    usage = UsageExtractor()
+    for chunk in chunks:
+        usage.feed(chunk)
+    return usage.output_size, usage.tokens()
+
+
+def make_sse_stream(size):
+    event = ('data: ' + json.dumps({
+        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+        "choices": [{"index": 0, "delta": {"content": "token "}, "logprobs": None, "finish_reason": None}],
+        "usage": None,
+    }) + '\n\n').encode()
+    n = max(1, size // len(event))
+    tail = ('data: ' + json.dumps({
+        "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0, "model": "bench",
+        "choices": [], "usage": {"prompt_tokens": 123, "total_tokens": 123 + n, "completion_tokens": n},
+    }) + '\n\ndata: [DONE]\n\n').encode()
+    return event * n + tail, (123, n)
+
+
+def make_json_body(size):
+    vector = json.dumps([0.0123456789] * 1024)
+    n = max(1, size // (len(vector) + 48))
+    data = ','.join('{"object":"embedding","index":%d,"embedding":%s}' % (i, vector) for i in range(n))
+    body = '{"object":"list","data":[%s],"model":"bench","usage":{"prompt_tokens":%d,"total_tokens":%d,"completion_tokens":0}}' % (data, n, n)
+    return body.encode(), (n, 0)
+
+
+def split(body):
+    return [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+
+
+def measure(fn, chunks, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(chunks)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    fn(chunks)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def main(args):
+    results = []
+    for kind, make in (("sse", make_sse_stream), ("json", make_json_body)):
+        for mb in args.sizes:
+            body, expected = make(mb * 1024 * 1024)
+            chunks = split(body)
+            row = {"kind": kind, "size_mb": round(len(body) / 2**20, 2)}
+            for name, fn in (("legacy", legacy_path), ("incremental", incremental_path)):
+                (size, tokens), seconds, peak = measure(fn, chunks, args.repeat)
+                assert size == len(body) and tuple(tokens) == expected, (name, size, tokens, expected)
+                row[f"{name}_ms"] = round(seconds * 1000, 2)
+                row[f"{name}_peak_kb"] = round(peak / 1024, 1)
+            row["speedup"] = round(row["legacy_ms"] / row["incremental_ms"], 2)
+            results.append(row)
+            if not args.json:
+                print(f"{kind:5} {row['size_mb']:8.2f} MB  legacy {row['legacy_ms']:9.2f} ms {row['legacy_peak_kb']:10.1f} KiB"
+                      f"  incremental {row['incremental_ms']:9.2f} ms {row['incremental_peak_kb']:8.1f} KiB  x{row['speedup']}")
+    if args.json:
+        print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Token accounting microbenchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 4, 16], help="Response sizes in MiB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    main(parser.parse_args())
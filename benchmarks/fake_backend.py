@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+
+############################################################################
+## Shared behaviour of the fake inference backends                        ##
+############################################################################
+## fake_sshd.py (emulating cloud_interface.sh) and fake_openai.py answer  ##
+## chat completions with the same OpenAI-style chunks, at a configurable  ##
+## token rate, after a configurable delay, and fail or break off streams  ##
+## at configurable rates, so proxy-hpc and proxy-azure can be compared.   ##
+############################################################################
+
+OK, FAIL, ABORT = "ok", "fail", "abort"
+
+
+class Profile:
+    """Timing, length and failure behaviour of a fake backend"""
+
+    def __init__(self, tokens=16, rate=0.0, delay=0.0, failure_rate=0.0, abort_rate=0.0, prompt_tokens=8,
+                 seed=None):
+        self.tokens = tokens                # Completion tokens per response
+        self.rate = rate                    # Tokens per second per stream, 0 for as fast as possible
+        self.delay = delay                  # Seconds before the first byte of a response
+        self.failure_rate = failure_rate    # Fraction of requests answered with an HTTP error
+        self.abort_rate = abort_rate        # Fraction of streams that break off half-way
+        self.prompt_tokens = prompt_tokens
+        self._random = random.Random(seed)
+
+    @staticmethod
+    def add_arguments(parser):
+        parser.add_argument("--tokens", type=int, default=16, help="Completion tokens per response")
+        parser.add_argument("--rate", type=float, default=0.0, help="Tokens per second per stream, 0 = unlimited")
+        parser.add_argument("--delay", type=float, default=0.0, help="Seconds before the first byte")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="Fraction of requests that fail")
+        parser.add_argument("--abort-rate", type=float, default=0.0, help="Fraction of streams cut off half-way")
+        parser.add_argument("--seed", type=int, default=None)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.tokens, args.rate, args.delay, args.failure_rate, args.abort_rate, seed=args.seed)
+
+    def outcome(self):
+        """Draws whether the next request succeeds, fails or breaks off"""
+        draw = self._random.random()
+        if draw < self.failure_rate:
+            return FAIL
+        if draw < self.failure_rate + self.abort_rate:
+            return ABORT
+        return OK
+
+    def usage(self):
+        return {
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.tokens,
+            'total_tokens': self.prompt_tokens + self.tokens,
+        }
+
+
+class Cancellations:
+    """Running generations by id, so a cancel command can stop them, and a log of how they ended early.
+
+    Every generation that stops before its last token is recorded as a JSON
+    line with the tokens generated and those it would still have produced:
+    "cancel" if a cancel command stopped it, "disconnect" if it only noticed
+    the closed channel when writing the next token.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._running = {}
+
+    def start(self, completion_id):
+        """Registers a generation; returns the event set when it is cancelled"""
+        cancelled = asyncio.Event()
+        self._running[completion_id] = cancelled
+        return cancelled
+
+    def finish(self, completion_id):
+        self._running.pop(completion_id, None)
+
+    def cancel(self, completion_id):
+        """Stops a running generation; returns False if there is none with this id"""
+        cancelled = self._running.get(completion_id)
+        if cancelled is None:
+            return False
+        cancelled.set()
+        return True
+
+    def record(self, completion_id, reason, generated, planned):
+        entry = {'id': completion_id, 'reason': reason, 'generated': generated, 'saved': planned - generated,
+                 'time': time.time()}
+        logging.info(f"Generation {completion_id} stopped by {reason} after {generated} of {planned} tokens")
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+
+async def pause(seconds, cancelled=None):
+    """Sleeps for seconds; returns True early if cancelled is set meanwhile"""
+    if cancelled is None:
+        await asyncio.sleep(seconds)
+        return False
+    try:
+        await asyncio.wait_for(cancelled.wait(), seconds)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+def parse_request(body):
+    """Returns (model, stream, include_usage) of a chat completion request body"""
+    try:
+        request = json.loads(body) if body else {}
+    except ValueError:
+        request = {}
+    if not isinstance(request, dict):
+        request = {}
+    include_usage = bool((request.get('stream_options') or {}).get('include_usage'))
+    return request.get('model', 'fake'), bool(request.get('stream')), include_usage
+
+
+def _chunk(completion_id, created, model, delta=None, finish_reason=None, usage=None):
+    choices = []
+    if delta is not None or finish_reason:
+        choices.append({
+            'index': 0,
+            'delta': delta or {},
+            'finish_reason': finish_reason,
+            'logprobs': None,
+            'content_filter_results': {},
+        })
+    chunk = {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': created,
+        'model': model,
+        'system_fingerprint': None,
+        'choices': choices,
+    }
+    if usage:
+        chunk['usage'] = usage
+    return b'data: ' + json.dumps(chunk).encode() + b'\n\n'
+
+
+async def stream_events(profile, model, include_usage, abort=False, completion_id=None, cancelled=None):
+    """Yields the SSE events of a streamed chat completion, paced at profile.rate.
+
+    Stops without the closing events once the cancelled event is set.
+    """
+    completion_id = completion_id or f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    interval = 1 / profile.rate if profile.rate else 0
+    yield _chunk(completion_id, created, model, delta={'role': 'assistant', 'content': ''})
+    started = time.monotonic()
+    for i in range(profile.tokens):
+        if abort and i == profile.tokens // 2:
+            return
+        if interval:
+            # Pace against the start time, so sleep overhead does not add up
+            await asyncio.sleep(max(0.0, started + (i + 1) * interval - time.monotonic()))
+        if cancelled is not None and cancelled.is_set():
+            return
+        yield _chunk(completion_id, created, model, delta={'content': f"tok{i} "})
+    yield _chunk(completion_id, created, model, delta={}, finish_reason='stop')
+    if include_usage:
+        yield _chunk(completion_id, created, model, usage=profile.usage())
+    yield b'data: [DONE]\n\n'
+
+
+async def completion_body(profile, model, completion_id=None, cancelled=None):
+    """Returns the JSON body of a non-streamed chat completion after generating all tokens, or None if cancelled"""
+    if profile.rate and await pause(profile.tokens / profile.rate, cancelled):
+        return None
+    return json.dumps({
+        'id': completion_id or f"chatcmpl-{uuid.uuid4().hex}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'system_fingerprint': None,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': ''.join(f"tok{i} " for i in range(profile.tokens)),
+                        'function_call': None, 'tool_calls': None},
+            'finish_reason': 'stop',
+            'logprobs': None,
+            'content_filter_results': {},
+        }],
+        'usage': profile.usage(),
+    }).encode()
+
+
+def error_body(message, code="server_error"):
+    return json.dumps({'error': {'message': message, 'type': code, 'code': code}}).encode()
+
+
+def models_body(models):
+    return json.dumps({'object': 'list', 'data': [{'id': m, 'object': 'model'} for m in models]}).encode()
@@ -0,0 +1,50 @@
+#!/bin/bash
+# Stand-in for the HPC-side cloud_interface.sh. It is started by fake_sshd.py
+# (or a real sshd ForceCommand) and answers like `curl -i -N` would, without
+# any cluster behind it.
+#
+# SSH_ORIGINAL_COMMAND layout, as built by proxy-hpc:
+#   <inference id>\n<uid>\n<service>\n/<path>\n -X <method> -H ...
+
+if [ "$SSH_ORIGINAL_COMMAND" == "keep-alive" ]; then
+    exit 0
+fi
+
+# "cancel <inference id>": stop the session serving that inference, if any.
+# Ids end up in a file name, so anything but [A-Za-z0-9_-] is refused.
+if [[ "$SSH_ORIGINAL_COMMAND" == "cancel "* ]]; then
+    id="${SSH_ORIGINAL_COMMAND#cancel }"
+    [[ "$id" =~ ^[A-Za-z0-9_-]+$ ]] || exit 2
+    pidfile="${TMPDIR:-/tmp}/fake-cloud-interface-$id.pid"
+    [ -f "$pidfile" ] && kill "$(cat "$pidfile")" 2>/dev/null && exit 0
+    exit 1
+fi
+
+mapfile -t lines <<< "$SSH_ORIGINAL_COMMAND"
+id="${lines[0]}"
+service="${lines[2]}"
+path="${lines[3]}"
+
+if [[ "$id" =~ ^[A-Za-z0-9_-]+$ ]]; then
+    pidfile="${TMPDIR:-/tmp}/fake-cloud-interface-$id.pid"
+    echo $$ > "$pidfile"
+    trap 'rm -f "$pidfile"' EXIT
+fi
+
+# Consume a request body sent through stdin, like curl --data-binary @-
+if [[ "${lines[4]}" == *"-X POST"* && "${lines[4]}" != *" -d "* ]]; then
+    cat > /dev/null
+fi
+
+if [[ "$path" == /v1/models* ]]; then
+    body="{\"object\":\"list\",\"data\":[{\"id\":\"$service\",\"object\":\"model\"}]}"
+    printf 'HTTP/1.1 200 OK\r\ncontent-type: application/json\r\ncontent-length: %d\r\n\r\n%s' "${#body}" "$body"
+    exit 0
+fi
+
+printf 'HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\n\r\n'
+for i in $(seq 1 ${FAKE_TOKENS:-16}); do
+    printf 'data: {"id":"%s","object":"chat.completion.chunk","model":"%s","choices":[{"index":0,"delta":{"content":"tok%d "}}]}\n\n' "$id" "$service" "$i"
+done
+printf 'data: {"id":"%s","object":"chat.completion.chunk","model":"%s","choices":[],"usage":{"prompt_tokens":8,"completion_tokens":%d,"total_tokens":%d}}\n\n' "$id" "$service" "${FAKE_TOKENS:-16}" "$((8 + ${FAKE_TOKENS:-16}))"
+printf 'data: [DONE]\n\n'
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import random
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from fake_backend import Profile, FAIL, ABORT, parse_request, stream_events, completion_body, error_body, models_body
+
+############################################################################
+## Local stand-in for Azure OpenAI and OpenAI-compatible endpoints        ##
+############################################################################
+## Serves chat completions under the Azure deployment path and under      ##
+## /v1, streamed or not, with usage when include_usage is requested and   ##
+## x-ratelimit-* headers like Azure sends them. Point the openai_endpoint ##
+## of proxy-azure's openai_config at it.                                  ##
+##                                                                        ##
+##     python fake_openai.py --port 8999 --rate 50 --tokens 256           ##
+############################################################################
+
+profile = Profile()
+throttle_rate = 0.0                 # Fraction of requests answered with 429
+retry_after = 1                     # Seconds suggested in Retry-After of throttled requests
+report_usage = True                 # If False, ignores include_usage like deployments that do not support it
+
+
+def rate_limit_headers():
+    return {
+        'x-ratelimit-limit-requests': '1000',
+        'x-ratelimit-remaining-requests': str(random.randint(1, 1000)),
+        'x-ratelimit-limit-tokens': '1000000',
+        'x-ratelimit-remaining-tokens': str(random.randint(1000, 1000000)),
+    }
+
+
+async def chat_completions(request):
+    body = await request.body()
+    model, stream, include_usage = parse_request(body)
+    include_usage = include_usage and report_usage
+    model = request.path_params.get('deployment', model)
+    if throttle_rate and random.random() < throttle_rate:
+        return Response(error_body("Rate limit exceeded", "429"), status_code=429, media_type="application/json",
+                        headers={'Retry-After': str(retry_after), 'retry-after-ms': str(retry_after * 1000)})
+    if profile.delay:
+        await asyncio.sleep(profile.delay)
+    outcome = profile.outcome()
+    if outcome == FAIL:
+        return Response(error_body("Emulated failure"), status_code=500, media_type="application/json")
+    if stream:
+        return StreamingResponse(stream_events(profile, model, include_usage, abort=outcome == ABORT),
+                                 media_type="text/event-stream", headers=rate_limit_headers())
+    return Response(await completion_body(profile, model), media_type="application/json",
+                    headers=rate_limit_headers())
+
+
+async def models(request):
+    return Response(models_body(["fake"]), media_type="application/json")
+
+
+app = Starlette(routes=[
+    Route("/openai/deployments/{deployment}/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/chat/completions", chat_completions, methods=["POST"]),
+    Route("/v1/models", models),
+])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local Azure OpenAI / OpenAI stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After of throttled requests")
+    parser.add_argument("--no-usage", action="store_true", help="Ignore stream_options.include_usage")
+    Profile.add_arguments(parser)
+    args = parser.parse_args()
+    profile = Profile.from_args(args)
+    throttle_rate = args.throttle_rate
+    retry_after = args.retry_after
+    report_usage = not args.no_usage
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
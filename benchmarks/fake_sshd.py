@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import asyncssh
+from fake_backend import (Profile, Cancellations, FAIL, ABORT, parse_request, pause, stream_events, completion_body,
+                          error_body, models_body)
+
+############################################################################
+## In-process SSH server standing in for the HPC login node               ##
+############################################################################
+## Accepts any client and runs every session through an interface script  ##
+## the way sshd's ForceCommand does, exporting SSH_ORIGINAL_COMMAND.      ##
+## With --emulate, sessions are answered in-process instead, with curl-   ##
+## style output at the rates and failure rates given on the command line, ##
+## so load tests are not limited by forking a script per request. The     ##
+## emulator also honors "cancel <inference id>" sessions and can log the  ##
+## generations that ended early with --cancel-log.                        ##
+##                                                                        ##
+##     python fake_sshd.py --port 8022                                    ##
+##     python fake_sshd.py --port 8022 --emulate --rate 50 --tokens 256   ##
+##     HPC_HOST=127.0.0.1 HPC_PORT=8022 HPC_USER=test ... python proxy.py ##
+############################################################################
+
+DEFAULT_INTERFACE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_cloud_interface.sh")
+
+
+class OpenServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return False  # No authentication required
+
+
+def make_process_handler(interface, env=None):
+    async def handle(process):
+        proc = await asyncio.create_subprocess_exec(
+            interface,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env={**os.environ, **(env or {}), "SSH_ORIGINAL_COMMAND": process.command or ""},
+        )
+        await process.redirect(stdin=proc.stdin, stdout=proc.stdout, stderr=proc.stderr)
+        try:
+            process.exit(await proc.wait())
+            await process.wait_closed()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+    return handle
+
+
+def _head(status, content_type):
+    return f"HTTP/1.1 {status}\r\ncontent-type: {content_type}\r\n\r\n".encode()
+
+
+def make_emulator_handler(profile, cancellations=None):
+    """Answers sessions like cloud_interface.sh and curl -i would, without running anything"""
+    cancellations = cancellations or Cancellations()
+
+    async def handle(process):
+        command = process.command or ""
+        if command == "keep-alive":
+            process.exit(0)
+            return
+        if command.startswith("cancel "):
+            process.exit(0 if cancellations.cancel(command[len("cancel "):]) else 1)
+            return
+        lines = command.split("\n", 4)
+        if len(lines) < 5:
+            process.exit(2)
+            return
+        inference_id, _, service, path, args = lines
+        if " -d " in args:
+            body = args.split(" -d ", 1)[1].encode(errors="surrogateescape")
+        elif "-X POST" in args:
+            body = b"".join([chunk async for chunk in _read_all(process.stdin)])
+        else:
+            body = b""
+        status = 0
+        generated = 0
+        cancelled = cancellations.start(inference_id)
+        try:
+            if profile.delay and await pause(profile.delay, cancelled):
+                return      # Cancelled during prompt processing
+            if path.startswith("/v1/models"):
+                process.stdout.write(_head("200 OK", "application/json") + models_body([service]))
+            else:
+                model, stream, include_usage = parse_request(body)
+                outcome = profile.outcome()
+                if outcome == FAIL:
+                    process.stdout.write(_head("500 Internal Server Error", "application/json")
+                                         + error_body("Emulated failure"))
+                elif stream:
+                    process.stdout.write(_head("200 OK", "text/event-stream"))
+                    async for event in stream_events(profile, model or service, include_usage,
+                                                     abort=outcome == ABORT, completion_id=inference_id,
+                                                     cancelled=cancelled):
+                        process.stdout.write(event)
+                        await process.stdout.drain()
+                        generated += 1
+                    if outcome == ABORT:
+                        status = 18     # curl: transfer closed with outstanding data
+                else:
+                    body = await completion_body(profile, model or service, inference_id, cancelled)
+                    if body is None:
+                        return
+                    process.stdout.write(_head("200 OK", "application/json") + body)
+                    generated = profile.tokens
+            await process.stdout.drain()
+            process.exit(status)
+        except (BrokenPipeError, ConnectionError, asyncssh.Error):
+            # The proxy closed the channel; a real curl only notices when writing the next token
+            if not cancelled.is_set():
+                cancellations.record(inference_id, "disconnect", max(0, generated - 1), profile.tokens)
+        finally:
+            cancellations.finish(inference_id)
+            if cancelled.is_set():
+                cancellations.record(inference_id, "cancel", max(0, generated - 1), profile.tokens)
+                process.exit(143)
+    return handle
+
+
+async def _read_all(stdin):
+    while True:
+        chunk = await stdin.read(65536)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def start_server(host="127.0.0.1", port=8022, interface=DEFAULT_INTERFACE, env=None, profile=None,
+                       reuse_port=False, cancel_log=None):
+    """Starts the stand-in server and returns the asyncssh acceptor.
+
+    If profile is given, sessions are emulated in-process instead of running
+    interface, and generations that end early are logged to cancel_log.
+    With reuse_port, several processes can serve the same port.
+    """
+    if profile:
+        handler = make_emulator_handler(profile, Cancellations(cancel_log))
+    else:
+        handler = make_process_handler(interface, env)
+    return await asyncssh.create_server(
+        OpenServer, host, port,
+        server_host_keys=[asyncssh.generate_private_key("ssh-ed25519")],
+        process_factory=handler,
+        encoding=None,
+        allow_scp=False,
+        reuse_port=reuse_port,
+    )
+
+
+async def main(args):
+    profile = Profile.from_args(args) if args.emulate else None
+    server = await start_server(args.host, args.port, args.interface, profile=profile,
+                                reuse_port=args.processes > 1, cancel_log=args.cancel_log)
+    logging.info(f"Fake login node listening on {args.host}:{args.port}")
+    await server.wait_closed()
+
+
+def serve(args):
+    asyncio.run(main(args))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In-process SSH stand-in for the HPC login node")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8022)
+    parser.add_argument("--interface", default=DEFAULT_INTERFACE, help="Script run for every session")
+    parser.add_argument("--emulate", action="store_true", help="Answer in-process instead of running the script")
+    Profile.add_arguments(parser)
+    parser.add_argument("--cancel-log", help="JSONL file recording emulated generations that ended early")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Server processes sharing the port, so the emulator does not become the bottleneck")
+    logging.basicConfig(level=logging.INFO)
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))  # Exit cleanly, so daemon workers are stopped too
+    workers = [multiprocessing.Process(target=serve, args=(args,), daemon=True) for _ in range(args.processes - 1)]
+    for worker in workers:
+        worker.start()
+    serve(args)
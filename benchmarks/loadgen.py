@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+import argparse
+import asyncio
+import collections
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+
+import httpx
+import psutil
+
+from fake_backend import Profile
+
+############################################################################
+## Load generator for proxy-hpc and proxy-azure                           ##
+############################################################################
+## Runs a closed-loop load (N concurrent clients, each sending its next   ##
+## request when the previous one is done) against a proxy and reports     ##
+## TTFB and latency percentiles, tokens/s, requests/s, and CPU and RSS of ##
+## every proxy worker, as text or JSON. With --launch, the fake backend   ##
+## and the proxy are started here, so runs are reproducible:              ##
+##                                                                        ##
+##     KEY_NAME=test-key python loadgen.py --launch hpc --workers 2 \     ##
+##         -c 64 --duration 30 --rate 50 --tokens 256 --json hpc.json     ##
+##     python loadgen.py --launch azure -c 64 --baseline hpc.json         ##
+##                                                                        ##
+## proxy-hpc reads its key from /run/secrets/$KEY_NAME; proxy-azure needs ##
+## an openai_config secret whose openai_endpoint is the stub's address.   ##
+## Compare two runs with --baseline, or diff the JSON files directly.     ##
+############################################################################
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SAMPLE_INTERVAL = 0.5               # Seconds between CPU/RSS samples of the proxy workers
+DEFAULT_SERVICES = {'hpc': 'bench-model', 'azure': 'openai-gpt4o-mini'}
+COMPARED = ('requests_per_s', 'tokens_per_s', 'ttfb_p50', 'ttfb_p99', 'latency_p50', 'latency_p99', 'error_rate')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+class Result:
+    __slots__ = ('status', 'ttfb', 'latency', 'tokens', 'usage', 'size', 'error')
+
+    def __init__(self):
+        self.status = None
+        self.ttfb = None
+        self.latency = None
+        self.tokens = 0             # Content deltas seen
+        self.usage = None           # Completion tokens reported by the backend, if any
+        self.size = 0
+        self.error = None
+
+
+def count_tokens(lines, result):
+    """Counts content deltas of SSE lines; a usage object, if present, takes precedence"""
+    for line in lines:
+        if not line.startswith(b'data: {'):
+            continue
+        if b'"usage": {' in line or b'"usage":{' in line:
+            usage = json.loads(line[6:]).get('usage') or {}
+            if 'completion_tokens' in usage:
+                result.usage = usage['completion_tokens']
+                continue
+        if b'"content":' in line and b'"content": ""' not in line \
+                and b'"content":""' not in line and b'"content": null' not in line:
+            result.tokens += 1
+
+
+async def send(client, url, headers, body):
+    result = Result()
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", url, content=body, headers=headers) as response:
+            result.status = response.status_code
+            pending = b''
+            async for chunk in response.aiter_raw():
+                if result.ttfb is None:
+                    result.ttfb = time.perf_counter() - started
+                result.size += len(chunk)
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                count_tokens(lines, result)
+            count_tokens([pending], result)
+    except httpx.HTTPError as e:
+        result.error = type(e).__name__
+    result.latency = time.perf_counter() - started
+    if result.usage is not None:
+        result.tokens = result.usage
+    return result
+
+
+def request_body(args):
+    body = {
+        'model': args.service,
+        'stream': not args.no_stream,
+        'messages': [{'role': 'user', 'content': 'x' * args.prompt_size}],
+    }
+    return json.dumps(body).encode()
+
+
+async def client_loop(client, url, body, index, args, deadline, results, remaining):
+    headers = {
+        'content-type': 'application/json',
+        'inference-service': args.service,
+        'X-Consumer-Custom-ID': f"loadgen-{index % args.users}",
+    }
+    while time.monotonic() < deadline:
+        if remaining is not None:
+            if remaining[0] <= 0:
+                return
+            remaining[0] -= 1
+        results.append(await send(client, url, headers, body))
+
+
+class WorkerSampler:
+    """Samples CPU and RSS of the proxy process and its worker processes"""
+
+    def __init__(self, pid):
+        self.root = psutil.Process(pid)
+        self.samples = collections.defaultdict(lambda: {'cpu': [], 'rss': []})
+        self._processes = {}
+
+    def _workers(self):
+        children = self.root.children(recursive=True)
+        workers = [p for p in children if 'python' in (p.name() or '')] or [self.root]
+        for p in workers:
+            if p.pid not in self._processes:
+                p.cpu_percent(None)     # First call only sets the reference point
+                self._processes[p.pid] = p
+        return workers
+
+    def prime(self):
+        self._workers()
+
+    def sample(self):
+        for p in self._workers():
+            try:
+                cpu = self._processes[p.pid].cpu_percent(None)
+                rss = p.memory_info().rss
+            except psutil.Error:
+                continue
+            self.samples[p.pid]['cpu'].append(cpu)
+            self.samples[p.pid]['rss'].append(rss)
+
+    async def run(self, stop):
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(stop.wait(), SAMPLE_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.sample()
+
+    def report(self):
+        return {
+            str(pid): {
+                'cpu_avg': round(sum(s['cpu']) / len(s['cpu']), 1) if s['cpu'] else None,
+                'cpu_max': round(max(s['cpu']), 1) if s['cpu'] else None,
+                'rss_max_mb': round(max(s['rss']) / 2**20, 1) if s['rss'] else None,
+            } for pid, s in self.samples.items()
+        }
+
+
+def summarize(results, elapsed, workers):
+    ok = [r for r in results if r.status == 200 and r.error is None]
+    ttfb = [r.ttfb for r in ok if r.ttfb is not None]
+    latency = [r.latency for r in ok]
+    statuses = collections.Counter(str(r.status) if r.error is None else r.error for r in results)
+    tokens = sum(r.tokens for r in ok)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 2)
+
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else None,
+        'statuses': dict(statuses),
+        'elapsed_s': round(elapsed, 3),
+        'requests_per_s': round(len(ok) / elapsed, 2) if elapsed else None,
+        'tokens': tokens,
+        'tokens_per_s': round(tokens / elapsed, 1) if elapsed else None,
+        'bytes_per_s': round(sum(r.size for r in ok) / elapsed) if elapsed else None,
+        'ttfb_p50': ms(percentile(ttfb, 50)),
+        'ttfb_p95': ms(percentile(ttfb, 95)),
+        'ttfb_p99': ms(percentile(ttfb, 99)),
+        'latency_p50': ms(percentile(latency, 50)),
+        'latency_p95': ms(percentile(latency, 95)),
+        'latency_p99': ms(percentile(latency, 99)),
+        'workers': workers,
+    }
+
+
+async def wait_for_http(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up")
+
+
+def profile_arguments(args):
+    return ["--tokens", str(args.tokens), "--rate", str(args.rate), "--delay", str(args.delay),
+            "--failure-rate", str(args.failure_rate), "--abort-rate", str(args.abort_rate)]
+
+
+def launch(args):
+    """Starts the fake backend and the proxy; returns (processes, proxy pid)"""
+    if args.launch == 'hpc':
+        backend = [sys.executable, os.path.join(HERE, "fake_sshd.py"), "--emulate", "--port", str(args.backend_port),
+                   "--processes", str(args.backend_processes), *profile_arguments(args)]
+        proxy_dir = os.path.join(ROOT, "proxy-hpc")
+        env = {**os.environ, 'HPC_HOST': '127.0.0.1', 'HPC_PORT': str(args.backend_port), 'HPC_USER': 'loadgen'}
+    else:
+        backend = [sys.executable, os.path.join(HERE, "fake_openai.py"),
+                   "--port", str(args.backend_port), *profile_arguments(args)]
+        proxy_dir = os.path.join(ROOT, "proxy-azure")
+        env = dict(os.environ)
+    processes = [subprocess.Popen(backend, cwd=HERE, stderr=subprocess.DEVNULL)]
+    processes.append(subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "proxy:app", "--port", str(args.port), "--workers", str(args.workers),
+         "--log-level", "warning", *(["--loop", "uvloop"] if args.uvloop else [])],
+        cwd=proxy_dir, env=env, stdout=subprocess.DEVNULL,
+    ))
+    return processes, processes[-1].pid
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def run(args):
+    processes = []
+    pid = args.pid
+    try:
+        if args.launch:
+            processes, pid = launch(args)
+            await wait_for_http(f"http://127.0.0.1:{args.port}/metrics")
+            await asyncio.sleep(args.warmup)
+        base = args.url or f"http://127.0.0.1:{args.port}"
+        url = f"{base}/passthrough/{args.path.lstrip('/')}"
+        body = request_body(args)
+        sampler = WorkerSampler(pid) if pid else None
+        if sampler:
+            sampler.prime()
+        stop = asyncio.Event()
+        sampling = asyncio.create_task(sampler.run(stop)) if sampler else None
+        results = []
+        remaining = [args.requests] if args.requests else None
+        deadline = time.monotonic() + (args.duration if not args.requests else 1e9)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits, timeout=args.timeout) as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(client_loop(client, url, body, i, args, deadline, results, remaining)
+                                   for i in range(args.concurrency)))
+            elapsed = time.perf_counter() - started
+        stop.set()
+        if sampling:
+            await sampling
+        summary = summarize(results, elapsed, sampler.report() if sampler else {})
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            process.wait()
+    return {
+        'target': args.launch or args.url,
+        'revision': git_revision(),
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': {
+            'concurrency': args.concurrency, 'workers': args.workers, 'duration': args.duration,
+            'requests': args.requests, 'service': args.service, 'stream': not args.no_stream,
+            'prompt_size': args.prompt_size, 'tokens': args.tokens, 'rate': args.rate, 'delay': args.delay,
+            'failure_rate': args.failure_rate, 'abort_rate': args.abort_rate,
+        },
+        'results': summary,
+    }
+
+
+def print_report(report, baseline=None):
+    r = report['results']
+    print(f"{report['target']} @ {report['revision']}: {r['ok']}/{r['requests']} ok in {r['elapsed_s']} s"
+          f" {r['statuses']}")
+    print(f"  throughput {r['requests_per_s']} req/s, {r['tokens_per_s']} tokens/s")
+    print(f"  TTFB    p50 {r['ttfb_p50']} ms, p95 {r['ttfb_p95']} ms, p99 {r['ttfb_p99']} ms")
+    print(f"  latency p50 {r['latency_p50']} ms, p95 {r['latency_p95']} ms, p99 {r['latency_p99']} ms")
+    for pid, w in r['workers'].items():
+        print(f"  worker {pid}: CPU avg {w['cpu_avg']}% max {w['cpu_max']}%, RSS max {w['rss_max_mb']} MB")
+    if baseline:
+        b = baseline['results']
+        print(f"  compared to {baseline['target']} @ {baseline['revision']}:")
+        for key in COMPARED:
+            if b.get(key) and r.get(key) is not None:
+                print(f"    {key:<15} {b[key]:>10} -> {r[key]:>10} ({(r[key] - b[key]) / b[key]:+.1%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for proxy-hpc and proxy-azure")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--launch", choices=('hpc', 'azure'), help="Start fake backend and proxy here")
+    target.add_argument("--url", help="Base URL of a running proxy")
+    parser.add_argument("--pid", type=int, help="Proxy process to sample when using --url")
+    parser.add_argument("--port", type=int, default=8781, help="Proxy port with --launch")
+    parser.add_argument("--backend-port", type=int, help="Fake backend port (default 8782 for hpc, 8999 for azure)")
+    parser.add_argument("--workers", type=int, default=1, help="Proxy workers with --launch")
+    parser.add_argument("--backend-processes", type=int, default=4, help="Processes of the fake SSH server")
+    parser.add_argument("--uvloop", action="store_true", help="Run the proxy on uvloop, like proxy.py does")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--users", type=int, default=32, help="Distinct consumer IDs to spread the clients over")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to run")
+    parser.add_argument("-n", "--requests", type=int, help="Total requests instead of a duration")
+    parser.add_argument("--warmup", type=float, default=1, help="Seconds to wait after launching")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--path", default="v1/chat/completions")
+    parser.add_argument("--service", help="Service/model name (default depends on the target)")
+    parser.add_argument("--no-stream", action="store_true", help="Send non-streaming requests")
+    parser.add_argument("--prompt-size", type=int, default=256, help="Characters of the user message")
+    Profile.add_arguments(parser)
+    parser.add_argument("--json", help="Write the report as JSON to this file, - for stdout")
+    parser.add_argument("--baseline", help="JSON report of a previous run to compare with")
+    args = parser.parse_args()
+    args.service = args.service or DEFAULT_SERVICES.get(args.launch or 'hpc')
+    args.backend_port = args.backend_port or (8999 if args.launch == 'azure' else 8782)
+
+    report = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if args.json == '-':
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report, baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
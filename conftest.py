@@ -0,0 +1,36 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+SIBLINGS = ('proxy-hpc', 'proxy-azure', 'tools')
+
+
+def pytest_collect_file(file_path, parent):
+    """Imports modules by name from the directory under test, as the proxies run.
+
+    The proxies share module names such as ledger and metrics, so when the
+    whole repository is tested at once, those of another directory are
+    dropped before the tests of a directory import theirs, and so are the
+    metrics they registered with prometheus_client.
+    """
+    here = os.path.dirname(os.path.dirname(str(file_path)))
+    if os.path.basename(here) not in SIBLINGS or os.path.dirname(here) != ROOT or sys.path[0] == here:
+        return None
+    sys.path[:] = [path for path in sys.path if os.path.basename(path) not in SIBLINGS]
+    sys.path.insert(0, here)
+    for name, module in list(sys.modules.items()):
+        directory = os.path.dirname(getattr(module, '__file__', None) or '')
+        if os.path.basename(directory) in SIBLINGS and directory != here:
+            unregister_metrics(module)
+            del sys.modules[name]
+    return None
+
+
+def unregister_metrics(module):
+    if 'prometheus_client' not in sys.modules:
+        return
+    from prometheus_client import REGISTRY
+    from prometheus_client.metrics import MetricWrapperBase
+    for value in vars(module).values():
+        if isinstance(value, MetricWrapperBase):
+            REGISTRY.unregister(value)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+import base64
+import binascii
+import io
+import struct
+
+############################################################################
+## Image dimensions from data URLs                                        ##
+############################################################################
+## Vision requests are billed by the size of their images. PNG, GIF and   ##
+## WebP keep width and height in their first 30 bytes and JPEG in the     ##
+## frame header, which follows the metadata segments. So only the start   ##
+## of the base64 data is decoded, up to 1 MiB for JPEGs with large        ##
+## metadata, and the header is read directly. Images whose header cannot  ##
+## be read this way are decoded in full and opened with PIL.              ##
+############################################################################
+
+PROBE_SIZES = (4096, 65536, 1048576)    # Decoded bytes tried in turn
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# JPEG start-of-frame markers; C4, C8 and CC share the range but are other segments
+JPEG_FRAMES = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def png_size(data):
+    if data[12:16] == b'IHDR' and len(data) >= 24:
+        return struct.unpack('>II', data[16:24])
+    return None
+
+
+def gif_size(data):
+    if len(data) >= 10:
+        return struct.unpack('<HH', data[6:10])
+    return None
+
+
+def webp_size(data):
+    if len(data) < 30:
+        return None
+    chunk = data[12:16]
+    if chunk == b'VP8 ' and data[23:26] == b'\x9d\x01\x2a':
+        width, height = struct.unpack('<HH', data[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+    if chunk == b'VP8L' and data[20] == 0x2F:
+        bits = int.from_bytes(data[21:25], 'little')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X':
+        return int.from_bytes(data[24:27], 'little') + 1, int.from_bytes(data[27:30], 'little') + 1
+    return None
+
+
+def jpeg_size(data):
+    """Walks the segments up to the frame header; None if it lies beyond data"""
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:          # Fill byte
+            i += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2                  # Segments without a length
+            continue
+        if marker in JPEG_FRAMES:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return None
+
+
+def header_size(data):
+    """(width, height) from the header of an image, or None"""
+    if data.startswith(PNG_SIGNATURE):
+        return png_size(data)
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return gif_size(data)
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return webp_size(data)
+    if data[:2] == b'\xff\xd8':
+        return jpeg_size(data)
+    return None
+
+
+def image_size(url):
+    """(width, height) of the image in a base64 data URL; raises ValueError if it cannot be read"""
+    if not url.startswith('data:'):
+        raise ValueError("Not a data URL")
+    start = url.find(',') + 1       # The data is sliced from the URL as needed, never copied whole
+    if not start or not url[:start - 1].endswith(';base64'):
+        raise ValueError("Not a base64 data URL")
+    try:
+        for size in PROBE_SIZES:
+            end = start + (size + 2) // 3 * 4
+            # Wrapped base64 has line breaks that would shift the 4-character groups
+            probe = ''.join(url[start:end].split())
+            data = base64.b64decode(probe[:len(probe) // 4 * 4])
+            found = header_size(data)
+            if found and found[0] > 0 and found[1] > 0:
+                return found
+            if end >= len(url) or not data.startswith(b'\xff\xd8'):
+                break               # Whole image read, or more data would not help
+        from PIL import Image
+        with Image.open(io.BytesIO(base64.b64decode(url[start:]))) as image:
+            return image.size
+    except (binascii.Error, OSError, SyntaxError) as e:
+        raise ValueError(f"Unreadable image: {str(e)}") from None
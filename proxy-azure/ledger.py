@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+
+############################################################################
+## Usage ledger                                                           ##
+############################################################################
+## Non-blocking writer for inference records, shared by proxy-hpc and     ##
+## proxy-azure. Each proxy directory is mounted alone into its container, ##
+## so the module cannot be imported from a common place: keep both copies ##
+## identical. Records are queued on the event loop and appended in        ##
+## batches by a background task to                                        ##
+##     <directory>/usage-YYYY-MM.jsonl                                    ##
+## one JSON object per line, in the file of the month they were logged.   ##
+## Unless legacy_log is off, every record is also logged as the           ##
+## "Inference Request: " / "Inference Response: " line with the JSON of   ##
+## the inference that the proxies wrote before the ledger existed.        ##
+##                                                                        ##
+## Record schema (version 1):                                             ##
+##   v, event ("request" | "response"), logged_at, then the inference     ##
+##   fields id, uid, o, ou, service, portal, status, input_size,          ##
+##   start_timestamp, and for responses end_timestamp, output_size,       ##
+##   input_tokens, output_tokens. Additional inference fields follow.     ##
+############################################################################
+
+SCHEMA_VERSION = 1
+RECORD_FIELDS = ('id', 'uid', 'o', 'ou', 'service', 'portal', 'status', 'input_size', 'start_timestamp',
+                 'end_timestamp', 'output_size', 'input_tokens', 'output_tokens')
+LEGACY_MARKERS = {'request': "Inference Request: ", 'response': "Inference Response: "}
+
+
+def make_record(event, inference, now=None):
+    """Builds a ledger record with the shared field order"""
+    now = now or datetime.datetime.now()
+    record = {'v': SCHEMA_VERSION, 'event': event, 'logged_at': now.isoformat()}
+    for field in RECORD_FIELDS:
+        if field in inference:
+            record[field] = inference[field]
+    for field, value in inference.items():
+        if field not in record:
+            record[field] = value
+    return record
+
+
+class UsageLedger:
+    """Queues inference records and batch-writes them as monthly JSONL files.
+
+    The queue is bounded. When it is full, the "block" policy waits up to
+    put_timeout seconds for space and then writes the record itself, off
+    the event loop, so no record is lost. The "drop" policy discards the
+    new record right away. Records lost to a full queue or a failed write
+    are counted, reported in the log and passed to observer(reason, count).
+    """
+
+    def __init__(self, directory, prefix="usage", max_queue=10000, batch_size=1000,
+                 policy="block", put_timeout=1.0, legacy_log=True, observer=None):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown ledger policy: {policy}")
+        self.directory = directory
+        self.prefix = prefix
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.policy = policy
+        self.put_timeout = put_timeout
+        self.legacy_log = legacy_log
+        self.observer = observer
+        self.written = 0
+        self.spilled = 0            # Records written past the full queue
+        self.dropped = 0
+        self._queue = None
+        self._writer = None
+        self._last_drop_warning = 0
+
+    def path_for(self, month):
+        return os.path.join(self.directory, f"{self.prefix}-{month}.jsonl")
+
+    async def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._queue = asyncio.Queue(self.max_queue)
+        self._writer = asyncio.create_task(self._write_loop())
+
+    async def close(self):
+        """Flushes all queued records and stops the writer"""
+        if self._writer is None:
+            return
+        await self._queue.put(None)
+        await self._writer
+        self._writer = None
+
+    async def record(self, event, inference):
+        """Queues a snapshot of the inference record without touching the disk"""
+        now = datetime.datetime.now()
+        item = (now.strftime("%Y-%m"), make_record(event, inference, now))
+        if self._queue is None:
+            # Not started (e.g. during startup or in scripts): write synchronously
+            self._write_batch([item])
+            return
+        try:
+            if self.policy == "block":
+                await asyncio.wait_for(self._queue.put(item), self.put_timeout)
+            else:
+                self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self._drop(1, "queue full")
+        except asyncio.TimeoutError:
+            try:
+                await asyncio.to_thread(self._write_batch, [item])
+                self.spilled += 1
+            except Exception as e:
+                logging.error(f"Usage ledger failed to write a record: {str(e)}")
+                self._drop(1, "write error")
+
+    def _drop(self, count, reason):
+        self.dropped += count
+        if self.observer:
+            self.observer(reason, count)
+        now = time.monotonic()
+        if now - self._last_drop_warning > 10:
+            self._last_drop_warning = now
+            logging.warning(f"Usage ledger dropped records ({reason}), {self.dropped} dropped so far")
+
+    async def _write_loop(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            batch = []
+            while True:
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size or self._queue.empty():
+                    break
+                item = self._queue.get_nowait()
+            if not batch:
+                continue
+            try:
+                await asyncio.to_thread(self._write_batch, batch)
+            except Exception as e:
+                logging.error(f"Usage ledger failed to write {len(batch)} records: {str(e)}")
+                self._drop(len(batch), "write error")
+
+    def _write_batch(self, batch):
+        """Appends a batch with one write per monthly file"""
+        by_month = {}
+        for month, record in batch:
+            by_month.setdefault(month, []).append(json.dumps(record) + "\n")
+        for month, lines in by_month.items():
+            # A single O_APPEND write keeps batches of concurrent workers from interleaving
+            data = "".join(lines).encode("utf-8")
+            fd = os.open(self.path_for(month), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        self.written += len(batch)
+        if self.legacy_log:
+            for _, record in batch:
+                inference = {key: value for key, value in record.items() if key not in ('v', 'event', 'logged_at')}
+                logging.info(LEGACY_MARKERS[record['event']] + json.dumps(inference))
+
+
+class MonthlyFileHandler(logging.FileHandler):
+    """Log handler writing to <directory>/<prefix>-YYYY-MM.log, switching files when the month changes"""
+
+    def __init__(self, directory, prefix="proxy", encoding=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.month = time.strftime("%Y-%m")
+        super().__init__(self.path_for(self.month), encoding=encoding)
+
+    def path_for(self, month):
+        return os.path.join(self.directory, f"{self.prefix}-{month}.log")
+
+    def emit(self, record):
+        month = time.strftime("%Y-%m", time.localtime(record.created))
+        if month != self.month:
+            # Called with the handler's lock held; the new file is opened by FileHandler.emit
+            if self.stream:
+                self.stream.close()
+                self.stream = None
+            self.month = month
+            self.baseFilename = os.path.abspath(self.path_for(month))
+        super().emit(record)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+############################################################################
+## Prometheus metrics                                                     ##
+############################################################################
+## All uvicorn workers write their samples to memory-mapped files in      ##
+## PROMETHEUS_MULTIPROC_DIR, and /metrics aggregates them, so counters    ##
+## stay correct no matter which worker serves the scrape. Samples of      ##
+## previous runs are removed by the process that starts the workers,      ##
+## before prometheus_client has opened any file in the directory.         ##
+############################################################################
+
+MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-proxy-azure")
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+if multiprocessing.current_process().name == 'MainProcess' and 'prometheus_client' not in sys.modules:
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.db")):
+        os.remove(path)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+MAX_SERVICE_LABELS = 256            # Unknown model names beyond this are reported as "other"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUESTS = Counter('proxy_requests_total', 'Requests by service and HTTP status', ['service', 'status'])
+IN_FLIGHT = Gauge('proxy_requests_in_flight', 'Requests currently being served', ['service'],
+                  multiprocess_mode='livesum')
+TTFB = Histogram('proxy_time_to_first_byte_seconds', 'Time until the first response body byte', ['service'],
+                 buckets=LATENCY_BUCKETS)
+DURATION = Histogram('proxy_request_duration_seconds', 'Time until the response is complete', ['service'],
+                     buckets=LATENCY_BUCKETS)
+TOKENS = Counter('proxy_tokens_total', 'Tokens from the inference records', ['service', 'portal', 'direction'])
+LEDGER_DROPS = Counter('proxy_ledger_dropped_total', 'Inference records lost by the usage ledger', ['reason'])
+STREAM_CHUNKS = Counter('proxy_stream_chunks_total', 'Chunks of streamed responses read from upstream')
+STREAM_WRITES = Counter('proxy_stream_writes_total', 'Writes of streamed responses to clients')
+STREAM_STALLS = Counter('proxy_stream_stalls_total',
+                        'Times reading from upstream paused for a client that did not keep up')
+STREAM_STALL_TIME = Counter('proxy_stream_stall_seconds_total',
+                            'Time reading from upstream was paused for slow clients')
+STREAM_DROPS = Counter('proxy_stream_drops_total', 'Streams whose upstream response was closed for a stalled client')
+AZURE_CLIENT = Histogram('proxy_azure_client_seconds', 'Time until Azure OpenAI returns a response object',
+                         ['service'], buckets=LATENCY_BUCKETS)
+UPSTREAM_REQUESTS = Counter('proxy_upstream_requests_total', 'HTTP requests sent to upstream endpoints', ['endpoint'])
+UPSTREAM_CONNECTIONS = Counter('proxy_upstream_connections_total',
+                               'Connections opened to upstream endpoints; the rest of the requests reused one',
+                               ['endpoint'])
+UPSTREAM_CONNECT = Histogram('proxy_upstream_connect_seconds', 'Time to open an upstream connection incl. TLS',
+                             ['endpoint'], buckets=LATENCY_BUCKETS)
+UPSTREAM_ATTEMPTS = Counter('proxy_upstream_attempts_total',
+                            'Requests sent to the targets of a service by outcome: ok, throttled or failed',
+                            ['service', 'target', 'outcome'])
+QUOTA_WAIT = Histogram('proxy_quota_wait_seconds', 'Time requests waited for deployment quota', ['service'],
+                       buckets=LATENCY_BUCKETS)
+QUOTA_REFUSED = Counter('proxy_quota_refused_total', 'Requests refused because quota was not available in time',
+                        ['service'])
+
+_services = set()
+
+
+def service_label(service):
+    """Bounds label cardinality, since the service comes from the request body"""
+    service = str(service)
+    if service in _services:
+        return service
+    if len(_services) < MAX_SERVICE_LABELS:
+        _services.add(service)
+        return service
+    return "other"
+
+
+def mark_worker_dead():
+    """Drops this worker's live gauges; call on worker shutdown"""
+    multiprocess.mark_process_dead(os.getpid())
+
+
+def render():
+    """Returns (body, content type) with samples of all workers"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_request(request, service):
+    """Marks a request as in flight once its service is known"""
+    service = service_label(service)
+    request.state.metrics_service = service
+    IN_FLIGHT.labels(service).inc()
+
+
+def observe_inference(inference):
+    """Counts tokens of a finished inference record"""
+    service = service_label(inference.get('service'))
+    portal = str(inference.get('portal'))
+    TOKENS.labels(service, portal, 'input').inc(inference.get('input_tokens') or 0)
+    TOKENS.labels(service, portal, 'output').inc(inference.get('output_tokens') or 0)
+
+
+def observe_ledger_drop(reason, count):
+    LEDGER_DROPS.labels(reason).inc(count)
+
+
+def observe_upstream_request(endpoint):
+    UPSTREAM_REQUESTS.labels(endpoint).inc()
+
+
+def observe_upstream_connect(endpoint, seconds):
+    UPSTREAM_CONNECTIONS.labels(endpoint).inc()
+    UPSTREAM_CONNECT.labels(endpoint).observe(seconds)
+
+
+def observe_upstream_attempt(service, target, outcome):
+    UPSTREAM_ATTEMPTS.labels(service_label(service), target.name, outcome).inc()
+
+
+def observe_quota_wait(service, seconds):
+    """Records the wait of a request for quota; None if it was refused"""
+    if seconds is None:
+        QUOTA_REFUSED.labels(service_label(service)).inc()
+    else:
+        QUOTA_WAIT.labels(service_label(service)).observe(seconds)
+
+
+def observe_stream(stats):
+    """Counts reads, writes and stalls of a finished streamed response"""
+    STREAM_CHUNKS.inc(stats.chunks)
+    STREAM_WRITES.inc(stats.writes)
+    if stats.stalls:
+        STREAM_STALLS.inc(stats.stalls)
+        STREAM_STALL_TIME.inc(stats.stall_time)
+    if stats.dropped:
+        STREAM_DROPS.inc()
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring status, TTFB and duration of each request.
+
+    Only requests whose handler called start_request() are measured, which
+    leaves out /metrics itself and requests rejected before the service was
+    known.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+        first_byte = False
+
+        async def send_wrapper(message):
+            nonlocal status, first_byte
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body' and not first_byte and message.get('body'):
+                first_byte = True
+                service = scope.get('state', {}).get('metrics_service')
+                if service:
+                    TTFB.labels(service).observe(time.perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            service = scope.get('state', {}).get('metrics_service')
+            if service:
+                IN_FLIGHT.labels(service).dec()
+                REQUESTS.labels(service, str(status)).inc()
+                DURATION.labels(service).observe(time.perf_counter() - start)
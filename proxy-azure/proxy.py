@@ -1,28 +1,31 @@
 #!/usr/bin/env python3
 import os
-import sys
 import time
 import signal
 from fastapi import FastAPI, HTTPException
 from starlette.requests import Request
-from fastapi.responses import JSONResponse, StreamingResponse, Response, HTMLResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
 import asyncio
 import logging
-import paramiko
-from uuid import uuid4
-from threading import Lock
 import datetime
-import select
-from openai import AsyncAzureOpenAI as AzureOpenAI
 import json
-import threading
 import uuid
-import tiktoken
 import uvicorn
-import base64
-from PIL import Image
-import io
-import re
+import math
+import httpx
+import openai
+from concurrent.futures import ThreadPoolExecutor
+from ledger import MonthlyFileHandler, UsageLedger
+from tokenizer import EncodingCache, OutputCounter
+from upstream import ClientPool, UpstreamStatusError
+from images import image_size
+from rechunk import ChunkTemplate, parse_chunking, WORD
+from sse import SSEParser
+from routing import DeploymentRouter, parse_routes, NON_RETRYABLE
+from quota import QuotaExceeded
+from output_stage import OutputStage
+import metrics
 
 
 ############################################################################
@@ -36,21 +39,51 @@ import re
 testing_mode = False                # If true, only test message is displayed
 use_openai = True                   # If True, enables OpenAI service
 enable_accounting = True            # If True, counts tokens
+ACCOUNTING_THREADS = int(os.environ.get("ACCOUNTING_THREADS", 2))  # Threads counting tokens where Azure reports no usage
 
 ## Log configuration
 system_log = True                   # If True, log is written to syslog
 file_log   = True                   # If True, log is written to file (both can be True)
-# Get the current month and year
-current_month = datetime.datetime.now().strftime("%Y-%m")
-log_path = f"/root/log/proxy-{current_month}.log"     # If file_log = True, write log to this file
+log_dir = "/root/log"               # If file_log = True, write log to proxy-YYYY-MM.log in this directory
 log_format = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
 syslog_format = logging.Formatter('mediator: %(asctime)s.%(msecs)03d %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
 log_level = logging.INFO
+ledger_dir = "/root/log"            # Inference records are written to usage-YYYY-MM.jsonl in this directory
+ledger_policy = os.environ.get("LEDGER_POLICY", "block")  # "block" or "drop" when the record queue is full
+legacy_inference_log = os.environ.get("LEGACY_INFERENCE_LOG", "1") == "1"  # If True, records also go to the log as "Inference Request/Response:" lines
+
+## Output configuration
+STREAM_FLUSH_MS = float(os.environ.get("STREAM_FLUSH_MS", 15))        # Streamed responses are written at most this often, batching what arrives meanwhile
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER_KB", 1024)) * 1024  # Bytes buffered per response before reading from upstream pauses
+slow_client_policy = os.environ.get("SLOW_CLIENT_POLICY", "wait")     # "wait" for slow clients, or "drop" their upstream response after SLOW_CLIENT_TIMEOUT
+SLOW_CLIENT_TIMEOUT = int(os.environ.get("SLOW_CLIENT_TIMEOUT", 60))  # Seconds a full buffer is tolerated under the "drop" policy
+PSEUDO_STREAM_CHUNK = parse_chunking(os.environ.get("PSEUDO_STREAM_CHUNK", WORD))  # Chunks of pseudo-streamed completions: "word" or a number of bytes
+
+## Upstream connections
+openai_http2 = os.environ.get("OPENAI_HTTP2", "0") == "1"                  # If True, talks HTTP/2 to Azure (needs the h2 package)
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", 100))  # Connections per endpoint and worker
+OPENAI_KEEPALIVE = int(os.environ.get("OPENAI_KEEPALIVE", 100))             # Idle connections kept open per endpoint and worker
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", 30))  # Seconds an idle connection stays open
+OPENAI_ATTEMPTS = int(os.environ.get("OPENAI_ATTEMPTS", 3))                 # Attempts per request, but at least one per target of the service
+OPENAI_PASSTHROUGH = os.environ.get("OPENAI_PASSTHROUGH", "1") == "1"       # If True, streams pass through as Azure's SSE bytes instead of OpenAI client objects
+
+## Deployment quotas
+OPENAI_QUEUE_BUDGET = float(os.environ.get("OPENAI_QUEUE_BUDGET", 5))       # Seconds a request may wait for deployment quota before it is refused with 429
+OPENAI_OUTPUT_ESTIMATE = int(os.environ.get("OPENAI_OUTPUT_ESTIMATE", 500))  # Output tokens reserved per request until its usage is known
+CHARS_PER_TOKEN = 4                                                          # Prompt estimate while no tokenizer encoding is loaded
 
 ## Reserved variables
 app = FastAPI(debug=False)
-openai_services = ['openai-gpt41', 'openai-gpt41-mini', 'openai-gpt4o-mini', 'openai-gpt4o', 'openai-o1', 'openai-o3', 'openai-o1-mini', 'openai-o3-mini', 'openai-o4-mini']
+app.add_middleware(metrics.MetricsMiddleware)
+ledger = UsageLedger(ledger_dir, policy=ledger_policy, legacy_log=legacy_inference_log,
+                     observer=metrics.observe_ledger_drop)
+encodings = EncodingCache()
+accounting_pool = ThreadPoolExecutor(ACCOUNTING_THREADS, thread_name_prefix="accounting")
+prewarm_task = None                 # Creates the OpenAI clients and loads the encodings in the background
+ready = False                       # Set once prewarming is done, whether or not every encoding loaded
+prewarm_error = None                # Why prewarming failed, if it did
 openai_api_version = "2024-12-01-preview"  # OpenAI API version
+TOKENIZER_MODELS = ("gpt-3.5-turbo-0613", "gpt-4-0613", "gpt-4o", "o1")  # Models extract_tokens falls back to, prewarmed with the deployments
 openai_system_prompt =  """You are an intelligent chatbot hosted by GWDG to help users answer their scientific questions.
     Instructions: 
     - Only respond to scientific or serious requests where you can actually provide assistance. Avoid sensitive topics.
@@ -72,16 +105,23 @@ def get_secret(secret_name):
 if use_openai:
     openai_config = json.loads(get_secret('openai_config'))
     openai_key = openai_config["openai_key"]
-    openai_endpoint = openai_config["openai_endpoint"]
-    openai_deployment_name_gpt41_mini = openai_config['openai_deployment_name_gpt41_mini']
-    openai_deployment_name_gpt41 = openai_config['openai_deployment_name_gpt41']
-    openai_deployment_name_gpt4o_mini = openai_config['openai_deployment_name_gpt4o_mini']
-    openai_deployment_name_gpt4o = openai_config['openai_deployment_name_gpt4o']
-    openai_deployment_name_o1_mini = openai_config['openai_deployment_name_o1_mini']
-    openai_deployment_name_o1 = openai_config['openai_deployment_name_o1']
-    openai_deployment_name_o3 = openai_config['openai_deployment_name_o3']
-    openai_deployment_name_o3_mini = openai_config['openai_deployment_name_o3_mini']
-    openai_deployment_name_o4_mini = openai_config['openai_deployment_name_o4_mini']
+    openai_endpoint = openai_config.get("openai_endpoint")
+    # Service -> targets (endpoint, deployment, weight) from "routes" and the openai_deployment_name_* keys
+    # Each worker gets an equal share of the deployments' rpm and tpm quotas
+    quota_share = 1 / int(os.environ.get("WORKERS", 1))
+    openai_routes = DeploymentRouter(parse_routes(openai_config, openai_endpoint, openai_key, quota_share),
+                                     max_attempts=OPENAI_ATTEMPTS, observer=metrics.observe_upstream_attempt)
+    openai_clients = ClientPool(
+        openai_key,
+        openai_api_version,
+        http2=openai_http2,
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive=OPENAI_KEEPALIVE,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+        max_retries=0,              # The router fails over to another target instead
+        request_observer=metrics.observe_upstream_request,
+        connect_observer=metrics.observe_upstream_connect,
+    )
 
 @app.on_event("startup")
 async def startup_event():
@@ -90,7 +130,7 @@ async def startup_event():
     ## Create log handlers
     handlers = []
     if file_log:
-        f_handler = logging.FileHandler(log_path)
+        f_handler = MonthlyFileHandler(log_dir)
         f_handler.setFormatter(log_format)
         handlers.append(f_handler)
     # if system_log:
@@ -99,15 +139,31 @@ async def startup_event():
     #     handlers.append(s_handler)
     # ## Initialize logging
     logging.basicConfig(handlers = handlers, level=log_level)
+    await ledger.start()
+    # Heavy imports and tokenizer files load in the background; /ready reports when they are done
+    global prewarm_task
+    prewarm_task = asyncio.create_task(prewarm())
     logging.info("Startup complete.")
-    logging.debug("Secrets:")
-    logging.debug(openai_key)
-    logging.debug(openai_deployment_name_gpt41_mini)
-    logging.debug(openai_deployment_name_gpt41)
-    logging.debug(openai_deployment_name_gpt4o)
-    logging.debug(openai_deployment_name_o1)
-    logging.debug(openai_deployment_name_o1_mini)
-    
+    if use_openai:
+        for service, targets in openai_routes.routes.items():
+            logging.debug(f"Service {service}: {', '.join(f'{t.name} ({t.weight})' for t in targets)}")
+
+
+async def prewarm():
+    """Creates the shared OpenAI clients and loads the encodings of all services off the event loop"""
+    global ready, prewarm_error
+    started = time.monotonic()
+    try:
+        targets = openai_routes.targets() if use_openai else []
+        for endpoint, api_key in {t.endpoint: t.api_key for t in targets}.items():
+            await openai_clients.add(endpoint, await asyncio.to_thread(openai_clients.create, endpoint, api_key))
+        deployments = {t.deployment for t in targets}
+        await encodings.load([*deployments, *TOKENIZER_MODELS])
+    except Exception as e:
+        prewarm_error = str(e)
+        logging.error(f"Prewarm failed: {str(e)}")
+    ready = True
+    logging.info(f"Ready after {time.monotonic() - started:.2f} s of prewarming")
 
 ############################################################################
 ## Shutdown                                                               ##
@@ -118,6 +174,17 @@ def shutdown():
     logging.info("Shutting down...")
     os.kill(os.getpid(), signal.SIGTERM)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Close upstream connections and flush pending inference records"""
+    if prewarm_task:
+        prewarm_task.cancel()
+    if use_openai:
+        await openai_clients.close()
+    accounting_pool.shutdown(wait=False, cancel_futures=True)
+    await ledger.close()
+    metrics.mark_worker_dead()
+
 ############################################################################
 ## Accounting                                                             ##
 ############################################################################
@@ -138,16 +205,35 @@ def calculate_image_token(width, height):#https://platform.openai.com/docs/guide
     tiles = (final_width + 511) // 512 * (final_height + 511) // 512
     return tiles * 170 + 85
 
+def image_tokens(image_url):
+    """Tokens of an image_url part, read from the image's header"""
+    if image_url.get('detail') == 'low':
+        return 85
+    try:
+        width, height = image_size(image_url['url'])
+    except ValueError as e:
+        # Remote URLs are not fetched; they are counted as a 1024 x 1024 image
+        logging.debug(f"Image size unknown: {str(e)}")
+        width, height = 1024, 1024
+    logging.debug(f"Image dimensions: {width}x{height}")
+    return calculate_image_token(width, height)
+
+def content_tokens(parts, encoding):
+    """Tokens of a content list with any number of text and image parts"""
+    num_tokens = 0
+    for part in parts:
+        if part.get('type') == 'text':
+            num_tokens += len(encoding.encode(part['text']))
+        elif part.get('type') == 'image_url':
+            num_tokens += image_tokens(part['image_url'])
+    return num_tokens
+
 def extract_tokens(messages, model="gpt-3.5-turbo-0613"):
     """
     Return the number of tokens used by a list of messages.
     """
     
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+    encoding = encodings.get(model)
 
     if model in {
         "gpt-3.5-turbo-0613",
@@ -193,29 +279,15 @@ def extract_tokens(messages, model="gpt-3.5-turbo-0613"):
 
     if type(messages) == list:
         for message in messages:
-            if type(message['content'])==list: #list sizs is always 2: [{'type': 'text', 'text': 'hi\n'}, {'type': 'image_url', 'image_url': {'url': 'da
-                if message['content'][1]['type']=='image_url':
-                    logging.debug("----------image detected and base64 is: ")
-                    logging.debug(message['content'][1]['image_url']['url'])
-                    image_seg=message['content'][1]['image_url']['url']
-                    match = re.search(r"data:image/(.*);base64,(.*)", image_seg)
-                    image_type = match.group(1)
-                    base64_image = match.group(2)
-                    logging.debug(base64_image)
-                    decoded_image = base64.b64decode(base64_image)
-                    image = io.BytesIO(decoded_image)
-                    image = Image.open(image)
-                    width, height = image.size
-                    logging.debug(f"Image dimensions: {width}x{height}")
-                    num_tokens=calculate_image_token(width, height)
-                    return num_tokens
-            else:
-                num_tokens += tokens_per_message
-                for key, value in message.items():
+            num_tokens += tokens_per_message
+            for key, value in message.items():
+                if type(value) == list:
+                    num_tokens += content_tokens(value, encoding)
+                else:
                     num_tokens += len(encoding.encode(value))
-                    if key == "name":
-                        num_tokens += tokens_per_name
-                num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+                if key == "name":
+                    num_tokens += tokens_per_name
+            num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
     elif type(messages) == str:
         num_tokens += len(encoding.encode(messages))
     return num_tokens
@@ -224,6 +296,150 @@ def extract_tokens(messages, model="gpt-3.5-turbo-0613"):
 ## Passthrough                                                            ##
 ############################################################################
 
+def output_stage(body):
+    """Wraps a streamed response body in the batching output stage with a bounded buffer"""
+    return OutputStage(body, max_delay=STREAM_FLUSH_MS / 1000, buffer_limit=STREAM_BUFFER, policy=slow_client_policy,
+                       stall_timeout=SLOW_CLIENT_TIMEOUT, observer=metrics.observe_stream)
+
+def upstream_messages(deployment, history):
+    """The request's messages with the system prompt, which o1 deployments take as part of the first message"""
+    if "o1" not in deployment:
+        return [{"role": "system", "content": openai_system_prompt}, *history]
+    return [{"role": "user", "content": openai_system_prompt + "\n" + history[0]["content"]}, *(history[1:])]
+
+async def count_prompt(deployment, history):
+    """Tokens of the messages sent to a deployment, counted in the accounting pool; None if they cannot be counted"""
+    if not enable_accounting:
+        return None
+    await encodings.wait()
+    try:
+        encodings.get(deployment)   # Raises here, and schedules a retry, while the encoding is missing
+        return await asyncio.get_running_loop().run_in_executor(
+            accounting_pool, extract_tokens, upstream_messages(deployment, history), deployment)
+    except Exception as e:
+        logging.warning("Failed to extract tokens: " + str(e))
+        return None
+
+def output_counter(deployment):
+    """Counts a deployment's output in the accounting pool; None while its encoding is missing"""
+    try:
+        return OutputCounter(encodings.get(deployment), accounting_pool)
+    except LookupError:
+        return None
+
+async def estimate_tokens(prompt_count, input_size):
+    """Tokens a request counts against the quota of its deployment: (prompt, output it may generate)"""
+    prompt = await prompt_count
+    return (prompt if prompt is not None else input_size // CHARS_PER_TOKEN), OPENAI_OUTPUT_ESTIMATE
+
+def reconcile_quota(quota, estimated, counts):
+    """Corrects the prompt and output parts of a reservation by the counts that are known; None keeps the estimate"""
+    for estimate, count in zip(estimated, counts):
+        if count is not None:
+            quota.reconcile(estimate, count)
+
+def usage_dict(chunk):
+    """The usage of a streamed chunk as a dict, or None.
+
+    openai 1.12 does not know the usage field of chunks and keeps it as the
+    plain dict it received; newer versions parse it into a model.
+    """
+    usage = getattr(chunk, 'usage', None)
+    if usage is None or isinstance(usage, dict):
+        return usage
+    return usage.model_dump()
+
+async def open_upstream(service, history, tokens):
+    """Sends the request to a target of the service, failing over to the others on throttling and errors.
+
+    A target with a quota first reserves tokens and waits for them within
+    OPENAI_QUEUE_BUDGET. Returns the target and the response; raises an
+    HTTPException once the attempts are used up, every target is
+    throttled or the quota cannot be met in time.
+    """
+    tried = []
+    for _ in range(openai_routes.attempts(service)):
+        target = openai_routes.pick(service, exclude=tried, tokens=tokens)
+        if target is None:
+            break
+        tried.append(target)
+        if target.quota:
+            try:
+                metrics.observe_quota_wait(service, await target.quota.acquire(tokens, OPENAI_QUEUE_BUDGET))
+            except QuotaExceeded as e:
+                metrics.observe_quota_wait(service, None)
+                retry_after = max(1, math.ceil(e.retry_after))
+                raise HTTPException(429, "Rate limit of the service exceeded", headers={'Retry-After': str(retry_after)})
+        messages = upstream_messages(target.deployment, history)
+        started = time.monotonic()
+        try:
+            if target.stream and OPENAI_PASSTHROUGH:
+                body = json.dumps({'model': target.deployment, 'messages': messages, 'stream': True,
+                                   'stream_options': {'include_usage': True}})
+                response = await openai_clients.stream(target.endpoint, target.deployment, body, target.api_key)
+                headers = response.headers
+            else:
+                client = openai_clients.get(target.endpoint, target.api_key)
+                raw = await client.chat.completions.with_raw_response.create(
+                    model=target.deployment,
+                    messages=messages,
+                    stream=target.stream,
+                    # The usage in the last chunk saves counting the tokens here; openai 1.12 has no
+                    # stream_options parameter, so it goes into the body as is
+                    **({'extra_body': {'stream_options': {'include_usage': True}}} if target.stream else {}),
+                )
+                headers, response = raw.headers, raw.parse()
+        except (openai.APIStatusError, UpstreamStatusError) as e:
+            if target.quota:
+                target.quota.release(tokens)
+            if e.status_code in NON_RETRYABLE:
+                raise HTTPException(e.status_code, e.message)
+            if e.status_code == 429:
+                openai_routes.record_throttled(service, target, e.response.headers)
+            else:
+                openai_routes.record_failure(service, target, f"HTTP {e.status_code}")
+            logging.warning(f"{target.name} answered {e.status_code} for {service}, attempt {len(tried)}")
+            continue
+        except (openai.APIError, httpx.HTTPError) as e:
+            if target.quota:
+                target.quota.release(tokens)
+            openai_routes.record_failure(service, target, str(e))
+            logging.warning(f"{target.name} failed for {service}, attempt {len(tried)}: {str(e)}")
+            continue
+        metrics.AZURE_CLIENT.labels(service).observe(time.monotonic() - started)
+        openai_routes.record_success(service, target, headers)
+        return target, response
+    if openai_routes.is_throttled(service):
+        retry_after = max(1, math.ceil(openai_routes.retry_after(service)))
+        raise HTTPException(429, "Rate limit of all deployments exceeded", headers={'Retry-After': str(retry_after)})
+    raise HTTPException(502, "OpenAI error")
+
+async def close_upstream(response):
+    """Releases the connection of a streamed response, also if the client left before it was read"""
+    close = getattr(response, 'aclose', None) or getattr(response, 'close', None)
+    if close:
+        await close()
+
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """Prometheus metrics aggregated over all workers"""
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+@app.get("/ready")
+async def get_ready() -> Response:
+    """Readiness: 200 once prewarming is done and every encoding loaded, 503 while starting or degraded"""
+    if not ready:
+        status = 'starting'
+    elif prewarm_error or encodings.missing:
+        status = 'degraded'
+        encodings.retry()           # Requests may not come while the worker is reported as not ready
+    else:
+        status = 'ready'
+    state = {'ready': status == 'ready', 'status': status, 'error': prewarm_error, 'encodings': encodings.stats(),
+             'routes': openai_routes.health() if use_openai else {}}
+    return JSONResponse(state, status_code=200 if status == 'ready' else 503)
+
 @app.post("/passthrough/{path:path}", status_code=200)
 async def get_openai_response(path: str, request: Request = None) -> StreamingResponse:
     """Send message and history to and get response from OpenAI"""
@@ -262,57 +478,70 @@ async def get_openai_response(path: str, request: Request = None) -> StreamingRe
         'portal': "Chat AI",
         'status': "PENDING",
     }
-    logging.info("Inference Request: " + json.dumps(inference))
+    await ledger.record("request", inference)
 
-    if inference['service'] not in openai_services:
+    service = inference['service']
+    if service not in openai_routes:
         raise HTTPException(404, "Service not found")
+    metrics.start_request(request, service)
+    history = [m for m in data['messages'] if m["role"] != "system"]
+    # The usage chunk the proxy asks for is only passed on to clients that asked for it too
+    forward_usage = bool((data.get('stream_options') or {}).get('include_usage'))
+    # Counting the prompt overlaps with the upstream request, unless the quota needs the count first. It
+    # is skipped once the service's deployments are known to report usage, and only done if one does not.
+    counted_deployment = openai_routes.routes[service][0].deployment
+    prompt_count = None
+    if openai_routes.has_quota(service) or not all(t.reports_usage for t in openai_routes.routes[service]):
+        prompt_count = asyncio.ensure_future(count_prompt(counted_deployment, history))
+    estimated_tokens = (0, 0)
+    if openai_routes.has_quota(service):
+        estimated_tokens = await estimate_tokens(prompt_count, inference['input_size'])
+    try:
+        target, response = await open_upstream(service, history, sum(estimated_tokens))
+    except HTTPException:
+        inference['status'] = 'FAILED'
+        inference['end_timestamp'] = datetime.datetime.now().isoformat()
+        inference['output_size'] = 0
+        await ledger.record("response", inference)
+        raise
+    model = target.deployment
     async def stream():
+        full_response = ''
+        usage = None
+        counter = None
+        parser = None
+        prompt_tokens, completion_tokens = None, None
         try:
-            logging.debug("Activating OpenAI client")
-            client = AzureOpenAI(
-                api_key=openai_key,
-                api_version=openai_api_version,
-                azure_endpoint=openai_endpoint,
-            )
-        except Exception as e:
-            logging.error("Could not activate OpenAI client: " + str(e))
-            return
-        try:
-            logging.debug(f"inference service is: {inference['service']}")
-            if inference['service'] == 'openai-gpt41':
-                model = openai_deployment_name_gpt41
-            elif inference['service'] == 'openai-gpt41-mini':
-                model = openai_deployment_name_gpt41_mini
-            elif inference['service'] == 'openai-gpt4o-mini':
-                model = openai_deployment_name_gpt4o_mini
-            elif inference['service'] == 'openai-gpt4o':
-                model = openai_deployment_name_gpt4o
-            elif inference['service'] == 'openai-o1-mini':
-                model = openai_deployment_name_o1_mini
-            elif inference['service'] == 'openai-o1':
-                model = openai_deployment_name_o1
-            elif inference['service'] == 'openai-o3':
-                model = openai_deployment_name_o3
-            elif inference['service'] == 'openai-o3-mini':
-                model = openai_deployment_name_o3_mini
-            elif inference['service'] == 'openai-o4-mini':
-                model = openai_deployment_name_o4_mini
-            else:
-                raise HTTPException(404, "Model not found")
-            full_response = ''
-            history = [m for m in data['messages'] if m["role"] != "system"]
-            if "o1" not in model:
-                messages=[{"role": "system", "content": openai_system_prompt},*history]
-                response = await client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=True
-                )
+            logging.debug(f"inference service {service} is served by {target.name}")
+            if target.stream and OPENAI_PASSTHROUGH:
+                if enable_accounting and not target.reports_usage:
+                    counter = output_counter(model)
+                # The content is only kept to be counted at the end if its encoding is still missing
+                parser = SSEParser(forward_usage=forward_usage, on_content=counter.add if counter else None,
+                                   keep_content=enable_accounting and not target.reports_usage and counter is None)
+                try:
+                    async for chunk in response.aiter_bytes():
+                        if data := parser.feed(chunk):
+                            yield data
+                    if data := parser.finish():
+                        yield data
+                    inference['status'] = 'COMPLETED'
+                except Exception as e:
+                    inference['status'] = 'FAILED'
+                usage = parser.usage
+                full_response = ''.join(parser.content or ())
+            elif target.stream:
+                if enable_accounting and not target.reports_usage:
+                    counter = output_counter(model)
                 try:
                     async for r in response:
+                        if chunk_usage := usage_dict(r):
+                            usage = chunk_usage
                         if not len(r.choices) > 0 or not r.choices[0].delta or not r.choices[0].delta.content:
                             continue
                         full_response += r.choices[0].delta.content
+                        if counter:
+                            counter.add(r.choices[0].delta.content)
                         response_str = 'data: ' + json.dumps(r.dict()) + '\n'
                         yield response_str
                         #yield r.choices[0].delta.content
@@ -321,63 +550,40 @@ async def get_openai_response(path: str, request: Request = None) -> StreamingRe
                     inference['status'] = 'FAILED'
                     pass # logging.error(e)
             else:
-                messages=[{"role": "user", "content": openai_system_prompt + "\n" + history[0]["content"]}, *(history[1:])]
-                response = await client.chat.completions.create(
-                    model=model,
-                    messages=messages,
-                    stream=False
-                )
                 try:
-                    message = response.choices[0].message.dict()
-                    full_response = message["content"]
-                    choice = response.choices[0].dict()
-                    response = response.dict()
-                    completion_tokens = response["usage"]["completion_tokens"]
-                    prompt_tokens = response["usage"]["prompt_tokens"]
-                    total_tokens = response["usage"]["total_tokens"]
-                    for r_char in full_response:
-                        r = {"id": response["id"],
-                            "choices": [{"delta": {"content": str(r_char),
-                                                    "function_call": message["function_call"],
-                                                    "role": None,
-                                                    "tool_calls": message["tool_calls"]},
-                                            "finish_reason": None,
-                                            "index": choice["index"],
-                                            "logprobs": choice["logprobs"],
-                                            "content_filter_results":choice["content_filter_results"]}],
-                            "created": response["created"],
-                            "model": response["model"],
-                            "object": "chat.completion.chunk",
-                            "system_fingerprint": response["system_fingerprint"]
-                        }
-                        response_str = 'data: ' + json.dumps(r) + '\n'
-                        yield response_str
-                        #yield r.choices[0].delta.content
+                    completion = response.dict()
+                    full_response = completion["choices"][0]["message"]["content"]
+                    completion_tokens = completion["usage"]["completion_tokens"]
+                    prompt_tokens = completion["usage"]["prompt_tokens"]
+                    for events in ChunkTemplate(completion).events(full_response, PSEUDO_STREAM_CHUNK):
+                        yield events
                     inference['status'] = 'COMPLETED'
                 except Exception as e:
                     inference['status'] = 'FAILED'
                     #logging.error(e)
-        except Exception as e:
-            #logging.error(e)
-            inference['status'] = 'FAILED'
-            raise HTTPException(500, "OpenAI error")
         finally:
             inference['end_timestamp'] = datetime.datetime.now().isoformat()
-            inference['output_size'] = len(full_response)
-            if "o1" not in model:
-                input_tokens, output_tokens = 0,0
-                try:
-                    input_tokens = extract_tokens(messages, model) if enable_accounting else 0
-                    output_tokens = extract_tokens(full_response, model) if enable_accounting else 0
-                except Exception as e:
-                    logging.warning("Failed to extract tokens: " + str(e))
-                inference['input_tokens'] = input_tokens
-                inference['output_tokens'] = output_tokens
-            else:
-                inference['input_tokens'] = prompt_tokens
-                inference['output_tokens'] = completion_tokens
-            logging.info("Inference Response: " + json.dumps(inference))
-    return StreamingResponse(stream())
+            inference['output_size'] = parser.content_size if parser else len(full_response)
+            if target.stream:
+                if usage:
+                    target.reports_usage = True
+                    prompt_tokens, completion_tokens = usage['prompt_tokens'], usage['completion_tokens']
+                elif enable_accounting:
+                    counted = prompt_count and model == counted_deployment
+                    prompt_tokens = await (prompt_count if counted else count_prompt(model, history))
+                    if counter is None and (counter := output_counter(model)):
+                        counter.add(full_response)
+                    try:
+                        completion_tokens = await counter.total() if counter else None
+                    except Exception as e:
+                        logging.warning("Failed to extract tokens: " + str(e))
+            inference['input_tokens'] = prompt_tokens or 0
+            inference['output_tokens'] = completion_tokens or 0
+            if target.quota:
+                reconcile_quota(target.quota, estimated_tokens, (prompt_tokens, completion_tokens))
+            await ledger.record("response", inference)
+            metrics.observe_inference(inference)
+    return StreamingResponse(output_stage(stream()), background=BackgroundTask(close_upstream, response))
 
 if __name__ == '__main__':
     uvicorn.run(
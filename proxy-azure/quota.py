@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+import asyncio
+import time
+
+############################################################################
+## Deployment quotas                                                      ##
+############################################################################
+## Azure limits every deployment to a number of requests and tokens per   ##
+## minute and answers 429 once either is used up. A token bucket per      ##
+## limit tracks the quota on this side, so requests are spread out before ##
+## Azure throttles them. A request reserves one request and its estimated ##
+## tokens, prompt plus expected output, and waits until the buckets have  ##
+## refilled enough. Reservations queue up in order of arrival, since each ##
+## one lowers the level the next one waits on. A request that would wait  ##
+## longer than its budget is refused at once. Once the usage is known,    ##
+## the estimate is corrected by the difference.                           ##
+############################################################################
+
+REQUEST_WINDOW = 10                 # Azure evaluates requests per minute over 10 s windows
+TOKEN_WINDOW = 60                   # and tokens per minute over the whole minute
+
+
+class QuotaExceeded(Exception):
+    """The quota cannot admit a request within its budget"""
+
+    def __init__(self, retry_after):
+        super().__init__(f"Quota exceeded, retry after {retry_after:.1f} s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills at per_minute / 60 per second up to window seconds worth; the level goes negative for reservations"""
+
+    def __init__(self, per_minute, window):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * window
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount, now):
+        """Seconds until amount fits; amounts beyond the capacity wait for a full bucket"""
+        self._refill(now)
+        return max(0.0, (min(amount, self.capacity) - self.level) / self.rate)
+
+    def available(self, now):
+        self._refill(now)
+        return self.level
+
+    def take(self, amount, now):
+        self._refill(now)
+        self.level -= amount
+
+    def give(self, amount, now):
+        self._refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+
+class DeploymentQuota:
+    """Requests and tokens per minute of one deployment, either of which may be unlimited"""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm, REQUEST_WINDOW) if rpm else None
+        self.tokens = TokenBucket(tpm, TOKEN_WINDOW) if tpm else None
+        self.waiting = 0
+        self.refused = 0
+
+    def delay(self, tokens):
+        """Seconds a request of tokens would wait now"""
+        now = time.monotonic()
+        return max(self.requests.delay(1, now) if self.requests else 0.0,
+                   self.tokens.delay(tokens, now) if self.tokens else 0.0)
+
+    async def acquire(self, tokens, budget):
+        """Reserves a request of tokens and waits for it; raises QuotaExceeded if that takes longer than budget"""
+        delay = self.delay(tokens)
+        if delay > budget:
+            self.refused += 1
+            raise QuotaExceeded(delay)
+        now = time.monotonic()
+        if self.requests:
+            self.requests.take(1, now)
+        if self.tokens:
+            self.tokens.take(tokens, now)
+        if delay > 0:
+            self.waiting += 1
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release(tokens)
+                raise
+            finally:
+                self.waiting -= 1
+        return delay
+
+    def release(self, tokens):
+        """Returns a reservation that upstream did not count, such as a throttled or failed request"""
+        now = time.monotonic()
+        if self.requests:
+            self.requests.give(1, now)
+        if self.tokens:
+            self.tokens.give(tokens, now)
+
+    def reconcile(self, estimated, actual):
+        """Corrects a reservation of estimated tokens by the tokens actually used"""
+        if self.tokens:
+            now = time.monotonic()
+            if actual > estimated:
+                self.tokens.take(actual - estimated, now)
+            else:
+                self.tokens.give(estimated - actual, now)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'rpm': self.rpm,
+            'tpm': self.tpm,
+            'requests_left': round(self.requests.available(now), 1) if self.requests else None,
+            'tokens_left': round(self.tokens.available(now)) if self.tokens else None,
+            'waiting': self.waiting,
+            'refused': self.refused,
+        }
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+import json
+import re
+
+############################################################################
+## Pseudo-streaming of complete responses                                 ##
+############################################################################
+## Deployments that cannot stream, such as o1, answer with the whole      ##
+## completion, which is passed on as a stream of chunks so clients need   ##
+## not tell the difference. Every chunk is the same JSON object except    ##
+## for its content, so the object is serialized once with a placeholder   ##
+## and each event is the template's prefix, the JSON-quoted content and   ##
+## its suffix. The text is cut into words, keeping their trailing         ##
+## whitespace, or into pieces of about a given number of UTF-8 bytes      ##
+## that never split a character.                                          ##
+############################################################################
+
+WORD = "word"
+PLACEHOLDER = "\0content\0"
+WORDS = re.compile(r"\s*\S+\s*|\s+")
+BATCH_BYTES = 16 * 1024             # Events yielded together, the output stage's write size
+
+
+def word_pieces(text):
+    return WORDS.findall(text)
+
+
+def byte_pieces(text, size):
+    """Pieces of at most size UTF-8 bytes, or one character if that is longer"""
+    data = text.encode()
+    pieces = []
+    start = 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1                # Back to the first byte of the character
+        if end == start:
+            end = start + 1
+            while end < len(data) and data[end] & 0xC0 == 0x80:
+                end += 1
+        pieces.append(data[start:end].decode())
+        start = end
+    return pieces
+
+
+def parse_chunking(value):
+    """WORD or a positive number of bytes from a PSEUDO_STREAM_CHUNK setting"""
+    if value == WORD:
+        return WORD
+    size = int(value)
+    if size <= 0:
+        raise ValueError(f"Chunk size must be positive, got {size}")
+    return size
+
+
+class ChunkTemplate:
+    """The SSE event of a chunk of a completion, with the content left open"""
+
+    def __init__(self, completion):
+        choice = completion["choices"][0]
+        message = choice["message"]
+        chunk = {
+            "id": completion["id"],
+            "choices": [{"delta": {"content": PLACEHOLDER,
+                                   "function_call": message.get("function_call"),
+                                   "role": None,
+                                   "tool_calls": message.get("tool_calls")},
+                         "finish_reason": None,
+                         "index": choice["index"],
+                         "logprobs": choice.get("logprobs"),
+                         "content_filter_results": choice.get("content_filter_results")}],
+            "created": completion["created"],
+            "model": completion["model"],
+            "object": "chat.completion.chunk",
+            "system_fingerprint": completion.get("system_fingerprint"),
+        }
+        self.prefix, self.suffix = ('data: ' + json.dumps(chunk) + '\n').split(json.dumps(PLACEHOLDER))
+
+    def event(self, piece):
+        return self.prefix + json.dumps(piece) + self.suffix
+
+    def events(self, text, chunking=WORD):
+        """Yields the events of text in batches of about BATCH_BYTES"""
+        pieces = word_pieces(text) if chunking == WORD else byte_pieces(text, chunking)
+        batch = []
+        size = 0
+        for piece in pieces:
+            event = self.event(piece)
+            batch.append(event)
+            size += len(event)
+            if size >= BATCH_BYTES:
+                yield ''.join(batch)
+                batch = []
+                size = 0
+        if batch:
+            yield ''.join(batch)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+import logging
+import random
+import time
+
+from quota import DeploymentQuota
+
+############################################################################
+## Deployment routing                                                     ##
+############################################################################
+## Each service maps to one or more targets, an Azure endpoint with a     ##
+## deployment and a weight, so quota split across regions and deployments ##
+## can be used as one. Requests go to a target at random by weight,       ##
+## scaled by the share of its rate limit left according to the latest     ##
+## x-ratelimit-* headers. A target answering 429 is skipped until its     ##
+## Retry-After has passed, and a target failing repeatedly is ejected for ##
+## a while, for twice as long on every consecutive ejection. The caller   ##
+## fails over to the next target in both cases, and retries a target      ##
+## once all have been tried, for services with a single target.           ##
+############################################################################
+
+RATE_LIMIT_COOLDOWN = 10            # Seconds a throttled target is skipped if it sent no Retry-After
+HEADER_TTL = 60                     # Seconds the remaining quota of a target's headers is trusted
+MIN_SHARE = 0.05                    # Least share of its weight a target with little quota left keeps
+NON_RETRYABLE = (400, 413, 422)     # Statuses caused by the request itself, which every target would return
+
+
+def parse_routes(config, default_endpoint=None, default_key=None, quota_share=1.0):
+    """Targets per service from openai_config.
+
+    Services are listed under "routes" as
+        {"openai-gpt4o": [{"endpoint": ..., "deployment": ..., "weight": 2, "key": ...}, ...]}
+    where endpoint and key default to openai_endpoint and openai_key. The
+    older openai_deployment_name_<name> keys still define openai-<name> on
+    the default endpoint for services without a route. Targets take their
+    "rpm" and "tpm" quota from their entry or from "limits" by deployment
+    name, and keep quota_share of it, the share of this worker. Whether
+    a deployment streams comes from "stream" in its entry or "streaming" by
+    deployment name; o1 deployments default to pseudo-streaming.
+    """
+    limits = config.get('limits', {})
+    streaming = config.get('streaming', {})
+
+    def quota(entry, deployment):
+        rpm = entry.get('rpm', limits.get(deployment, {}).get('rpm'))
+        tpm = entry.get('tpm', limits.get(deployment, {}).get('tpm'))
+        if not rpm and not tpm:
+            return None
+        return DeploymentQuota(rpm * quota_share if rpm else None, tpm * quota_share if tpm else None)
+
+    def stream(entry, deployment):
+        return entry.get('stream', streaming.get(deployment))
+
+    routes = {}
+    for service, targets in config.get('routes', {}).items():
+        routes[service] = [
+            Target(target.get('endpoint', default_endpoint), target['deployment'],
+                   float(target.get('weight', 1)), target.get('key', default_key),
+                   quota(target, target['deployment']), stream(target, target['deployment']))
+            for target in targets
+        ]
+    for key, deployment in config.items():
+        if key.startswith('openai_deployment_name_') and deployment:
+            service = 'openai-' + key[len('openai_deployment_name_'):].replace('_', '-')
+            if service not in routes:
+                routes[service] = [Target(default_endpoint, deployment, 1.0, default_key, quota({}, deployment),
+                                          stream({}, deployment))]
+    for service, targets in routes.items():
+        if not targets:
+            raise ValueError(f"Service {service} has no targets")
+        for target in targets:
+            if not target.endpoint:
+                raise ValueError(f"Target {target.deployment} of {service} has no endpoint")
+            if target.weight <= 0:
+                raise ValueError(f"Weight of {target.name} must be positive")
+    return routes
+
+
+def header_seconds(headers):
+    """Retry-After of an Azure response in seconds, or None"""
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class Target:
+    """One deployment on one endpoint serving a service"""
+
+    def __init__(self, endpoint, deployment, weight=1.0, api_key=None, quota=None, stream=None):
+        self.endpoint = endpoint
+        self.deployment = deployment
+        self.weight = weight
+        self.api_key = api_key
+        self.quota = quota          # DeploymentQuota, if the deployment's limits are configured
+        # If False, the deployment is asked for whole completions, which are pseudo-streamed
+        self.stream = stream if stream is not None else "o1" not in deployment
+        self.reports_usage = False  # Set once a stream of the deployment ended with its usage
+        self.name = f"{endpoint}/{deployment}"
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.consecutive_errors = 0
+        self.ejections = 0          # Consecutive ejections, for the backoff
+        self.ejected_until = 0.0
+        self.throttled_until = 0.0
+        self.share = 1.0            # Share of the rate limit left after the latest response
+        self.share_at = 0.0
+        self._peaks = {}            # Most remaining requests and tokens seen, where Azure sends no limit
+
+    def is_available(self, now):
+        return now >= self.throttled_until and now >= self.ejected_until
+
+    def effective_weight(self, now):
+        share = self.share if now - self.share_at < HEADER_TTL else 1.0
+        return self.weight * max(share, MIN_SHARE)
+
+    def observe_headers(self, headers):
+        """Remembers the least share left of the request and token limits"""
+        shares = []
+        for kind in ('requests', 'tokens'):
+            try:
+                remaining = float(headers[f'x-ratelimit-remaining-{kind}'])
+            except (KeyError, ValueError):
+                continue
+            try:
+                limit = float(headers[f'x-ratelimit-limit-{kind}'])
+            except (KeyError, ValueError):
+                limit = self._peaks[kind] = max(self._peaks.get(kind, 0.0), remaining)
+            if limit > 0:
+                shares.append(remaining / limit)
+        if shares:
+            self.share = min(shares)
+            self.share_at = time.monotonic()
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'weight': self.weight,
+            'stream': self.stream,
+            'share': round(self.share, 3) if now - self.share_at < HEADER_TTL else None,
+            'requests': self.requests,
+            'errors': self.errors,
+            'throttled': self.throttled,
+            'available': self.is_available(now),
+            'quota': self.quota.stats() if self.quota else None,
+        }
+
+
+class DeploymentRouter:
+    """Chooses targets of a service and keeps track of their health.
+
+    After failure_threshold consecutive failures a target is ejected for
+    base_ejection seconds, doubling with every consecutive ejection up to
+    max_ejection. A successful request resets both counters.
+    """
+
+    def __init__(self, routes, max_attempts=3, failure_threshold=3, base_ejection=10, max_ejection=300,
+                 observer=None):
+        self.routes = routes
+        self.max_attempts = max_attempts
+        self.failure_threshold = failure_threshold
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.observer = observer    # Called with the service, the target and the outcome of every attempt
+
+    def __contains__(self, service):
+        return service in self.routes
+
+    def services(self):
+        return list(self.routes)
+
+    def targets(self):
+        return [target for targets in self.routes.values() for target in targets]
+
+    def has_quota(self, service):
+        return any(t.quota for t in self.routes[service])
+
+    def attempts(self, service):
+        """Attempts a request of the service gets: every target once, and at least max_attempts"""
+        return max(self.max_attempts, len(self.routes[service]))
+
+    def pick(self, service, exclude=(), tokens=0):
+        """Returns the target for the next attempt, or None if every target is throttled.
+
+        Targets in exclude are only picked again once every other one has
+        been tried. Targets with quota left for a request of tokens come
+        first; if none has, the one that has soonest is returned.
+        """
+        now = time.monotonic()
+        candidates = [t for t in self.routes[service] if now >= t.throttled_until]
+        candidates = [t for t in candidates if t not in exclude] or candidates
+        healthy = [t for t in candidates if now >= t.ejected_until]
+        # If every unthrottled target is ejected, trying one still beats refusing the request
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        delays = {t: t.quota.delay(tokens) if t.quota else 0.0 for t in candidates}
+        if all(delays.values()):
+            return min(candidates, key=delays.get)
+        candidates = [t for t in candidates if not delays[t]]
+        weights = [t.effective_weight(now) for t in candidates]
+        return random.choices(candidates, weights)[0]
+
+    def retry_after(self, service):
+        """Seconds until the first target of the service takes requests again"""
+        now = time.monotonic()
+        return max(0.0, min(max(t.throttled_until, t.ejected_until) - now for t in self.routes[service]))
+
+    def is_throttled(self, service):
+        """True while every target of the service is throttled"""
+        now = time.monotonic()
+        return all(now < t.throttled_until for t in self.routes[service])
+
+    def record_success(self, service, target, headers):
+        target.requests += 1
+        target.consecutive_errors = 0
+        target.ejections = 0
+        target.observe_headers(headers)
+        if self.observer:
+            self.observer(service, target, 'ok')
+
+    def record_throttled(self, service, target, headers):
+        target.requests += 1
+        target.throttled += 1
+        seconds = header_seconds(headers)
+        target.throttled_until = time.monotonic() + (seconds if seconds is not None else RATE_LIMIT_COOLDOWN)
+        target.observe_headers(headers)
+        if self.observer:
+            self.observer(service, target, 'throttled')
+
+    def record_failure(self, service, target, reason):
+        target.requests += 1
+        target.errors += 1
+        target.consecutive_errors += 1
+        if self.observer:
+            self.observer(service, target, 'failed')
+        if target.consecutive_errors < self.failure_threshold or time.monotonic() < target.ejected_until:
+            return
+        duration = min(self.max_ejection, self.base_ejection * 2 ** target.ejections)
+        target.ejections += 1
+        target.consecutive_errors = 0
+        target.ejected_until = time.monotonic() + duration
+        logging.warning(f"Ejecting deployment {target.name} for {duration} s: {reason}")
+
+    def health(self):
+        """Per-service state of the targets"""
+        return {service: {t.name: t.stats() for t in targets} for service, targets in self.routes.items()}
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import json
+
+############################################################################
+## Side parser for passed-through completion streams                      ##
+############################################################################
+## Streamed completions are forwarded as the SSE bytes Azure sends, cut   ##
+## only at line ends, instead of being parsed into OpenAI client objects  ##
+## and serialized again. The parser reads each data line on the side for  ##
+## the accounting: the usage in the last chunk, and the content, which    ##
+## is counted for deployments that do not report usage. Chunks without    ##
+## choices, Azure's prompt filter results and the usage the proxy asked   ##
+## for, are left out, the latter unless the client asked for it too.      ##
+##                                                                        ##
+## Only the chunk with the usage is decoded in full. Of the others, the   ##
+## parser finds the choices and the content with bytes.find and decodes   ##
+## just the content string; chunks it cannot read that way are decoded.   ##
+############################################################################
+
+DATA = b'data: '
+DONE = b'data: [DONE]'
+WHITESPACE = b' \t\r\n'
+
+
+class SSEParser:
+    """Passes a chat completion stream through line by line and keeps its usage and content size.
+
+    on_content, if given, is called with the content of every chunk, and
+    keep_content keeps it in content for later.
+    """
+
+    def __init__(self, forward_usage=False, on_content=None, keep_content=False):
+        self.forward_usage = forward_usage
+        self.on_content = on_content
+        self.content = [] if keep_content else None
+        self.content_size = 0       # Characters of content
+        self.usage = None           # Dict of the usage chunk, if one arrived
+        self.events = 0             # Chunks with choices
+        self._partial = b''         # Bytes after the last line end
+
+    def feed(self, chunk):
+        """Bytes of chunk to forward: those up to its last line end, after what was held back before"""
+        if self._partial:
+            chunk = self._partial + chunk
+        end = chunk.rfind(b'\n') + 1
+        self._partial = chunk[end:]
+        kept = []                   # Spans of chunk to forward, if any line is left out
+        start = pos = 0
+        while pos < end:
+            line_end = chunk.index(b'\n', pos) + 1
+            if chunk.startswith(DATA, pos) and not chunk.startswith(DONE, pos) and not self._keep(chunk[pos + 6:line_end]):
+                kept.append(chunk[start:pos])
+                # The blank line that ends the event goes with it
+                for blank in (b'\n', b'\r\n'):
+                    if chunk.startswith(blank, line_end):
+                        line_end += len(blank)
+                        break
+                start = line_end
+            pos = line_end
+        if not kept:
+            return chunk[:end]
+        kept.append(chunk[start:end])
+        return b''.join(kept)
+
+    def _keep(self, data):
+        """Reads a data line; False for chunks that are not forwarded"""
+        usage = _value_start(data, b'usage')
+        choices = _value_start(data, b'choices')
+        if (usage < 0 or data[usage] == 0x6e) and choices >= 0 and data[choices] == 0x5b:  # null, [
+            if data[_skip_whitespace(data, choices + 1):][:1] == b']':
+                return False
+            try:
+                content = _content(data)
+            except ValueError:
+                return self._keep_parsed(data)
+            self._add(content)
+            return True
+        return self._keep_parsed(data)
+
+    def _keep_parsed(self, data):
+        """Reads the JSON of a data line in full"""
+        try:
+            payload = json.loads(data)
+        except ValueError:
+            return True
+        if payload.get('usage'):
+            self.usage = payload['usage']
+        choices = payload.get('choices')
+        if not choices:
+            return self.forward_usage and payload.get('usage') is not None
+        self._add((choices[0].get('delta') or {}).get('content'))
+        return True
+
+    def _add(self, content):
+        self.events += 1
+        if content:
+            self.content_size += len(content)
+            if self.on_content:
+                self.on_content(content)
+            if self.content is not None:
+                self.content.append(content)
+
+    def finish(self):
+        """Bytes held back after the last line end, once the stream has ended"""
+        partial, self._partial = self._partial, b''
+        if partial.startswith(DATA) and not partial.startswith(DONE) and not self._keep(partial[6:]):
+            return b''
+        return partial
+
+
+def _skip_whitespace(data, pos):
+    while pos < len(data) and data[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _value_start(data, key):
+    """Index of the value of the first "key": in data, or -1.
+
+    A quote inside a JSON string is escaped, so the unescaped key followed
+    by a colon is always an object key.
+    """
+    quoted = b'"' + key + b'"'
+    pos = 0
+    while (pos := data.find(quoted, pos)) >= 0:
+        pos += len(quoted)
+        colon = _skip_whitespace(data, pos)
+        if colon < len(data) and data[colon] == 0x3a:  # :
+            value = _skip_whitespace(data, colon + 1)
+            return value if value < len(data) else -1
+    return -1
+
+
+def _content(data):
+    """The content of the first delta, or None; raises ValueError if it is not a string or null"""
+    start = _value_start(data, b'content')
+    if start < 0 or data.startswith(b'null', start):
+        return None
+    if data[start] != 0x22:  # "
+        raise ValueError("Content is not a string")
+    end = data.find(b'"', start + 1)
+    if end < 0:
+        raise ValueError("Unterminated content")
+    raw = data[start + 1:end]
+    if b'\\' in raw:
+        # Escaped characters, possibly quotes, need the JSON decoder
+        return json.JSONDecoder().raw_decode(data[start:].decode())[0]
+    return raw.decode()
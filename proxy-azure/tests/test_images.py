@@ -0,0 +1,58 @@
+import base64
+import io
+
+import pytest
+from PIL import Image
+
+import images
+from images import image_size
+
+
+def data_url(size, fmt, **options):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, fmt, **options)
+    return f"data:image/{fmt.lower()};base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+@pytest.mark.parametrize('fmt, options', [
+    ('PNG', {}), ('GIF', {}), ('JPEG', {}), ('WEBP', {}), ('WEBP', {'lossless': True}),
+])
+def test_sizes_are_read_from_the_header(monkeypatch, fmt, options):
+    # Failing PIL proves the header was enough
+    monkeypatch.setattr(Image, "open", None)
+    assert image_size(data_url((321, 123), fmt, **options)) == (321, 123)
+
+
+def test_jpeg_metadata_beyond_the_first_probe(monkeypatch):
+    url = data_url((64, 48), 'JPEG', icc_profile=b'\0' * 20000)
+    monkeypatch.setattr(Image, "open", None)
+    assert image_size(url) == (64, 48)
+
+
+@pytest.mark.parametrize('fmt, options', [('PNG', {}), ('JPEG', {'icc_profile': b'\0' * 20000})])
+def test_wrapped_base64_is_read_from_the_header(monkeypatch, fmt, options):
+    url = data_url((321, 123), fmt, **options)
+    prefix, payload = url.split(',')
+    wrapped = prefix + ',' + '\r\n'.join(payload[i:i + 76] for i in range(0, len(payload), 76))
+    monkeypatch.setattr(Image, "open", None)
+    assert image_size(wrapped) == (321, 123)
+
+
+def test_other_formats_are_opened_with_pil():
+    assert image_size(data_url((17, 9), 'BMP')) == (17, 9)
+
+
+def test_webp_extended_header():
+    header = b'RIFF\0\0\0\0WEBPVP8X' + b'\0' * 8 + (639).to_bytes(3, 'little') + (479).to_bytes(3, 'little')
+    assert images.header_size(header) == (640, 480)
+
+
+@pytest.mark.parametrize('url', [
+    "https://example.com/cat.png",
+    "data:image/png,rawbytes",
+    "data:image/png;base64,!!!!",
+    "data:image/png;base64," + base64.b64encode(b'not an image').decode(),
+])
+def test_unreadable_images_raise_value_error(url):
+    with pytest.raises(ValueError):
+        image_size(url)
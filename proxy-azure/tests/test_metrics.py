@@ -0,0 +1,82 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import metrics
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sample(metric, name, **labels):
+    for family in metric.collect():
+        for s in family.samples:
+            if s.name == name and s.labels == labels:
+                return s.value
+    return 0
+
+
+class Request:
+    def __init__(self, scope):
+        self.state = type('State', (), {})()
+        scope['state'] = self.state.__dict__
+
+
+def test_middleware_measures_requests_with_a_service():
+    async def app(scope, receive, send):
+        if scope['path'] == '/chat':
+            metrics.start_request(Request(scope), 'test-middleware')
+        await send({'type': 'http.response.start', 'status': 429})
+        await send({'type': 'http.response.body', 'body': b'busy'})
+
+    async def send(message):
+        pass
+
+    before = sample(metrics.REQUESTS, 'proxy_requests_total', service='test-middleware', status='429')
+    middleware = metrics.MetricsMiddleware(app)
+    for path in ('/chat', '/metrics'):
+        asyncio.run(middleware({'type': 'http', 'path': path}, None, send))
+    assert sample(metrics.REQUESTS, 'proxy_requests_total', service='test-middleware', status='429') == before + 1
+    assert sample(metrics.IN_FLIGHT, 'proxy_requests_in_flight', service='test-middleware') == 0
+
+
+def test_quota_waits_and_refusals():
+    before = sample(metrics.QUOTA_REFUSED, 'proxy_quota_refused_total', service='test-quota')
+    metrics.observe_quota_wait('test-quota', 0.2)
+    metrics.observe_quota_wait('test-quota', None)
+    assert sample(metrics.QUOTA_REFUSED, 'proxy_quota_refused_total', service='test-quota') == before + 1
+    assert sample(metrics.QUOTA_WAIT, 'proxy_quota_wait_seconds_count', service='test-quota') >= 1
+
+
+LAUNCHER = """
+import multiprocessing
+import sys
+
+import metrics
+
+
+def worker():
+    metrics.observe_upstream_request('worker')
+
+
+if __name__ == '__main__':
+    metrics.observe_upstream_request('launcher')
+    process = multiprocessing.get_context('spawn').Process(target=worker)
+    process.start()
+    process.join()
+    sys.stdout.buffer.write(metrics.render()[0])
+"""
+
+
+def test_launcher_keeps_its_own_samples(tmp_path):
+    # With WORKERS=1, uvicorn serves from the process that cleaned up the directory
+    directory = tmp_path / "metrics"
+    directory.mkdir()
+    (directory / "counter_1.db").write_bytes(b"stale")
+    script = tmp_path / "launcher.py"
+    script.write_text(LAUNCHER)
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(directory), 'PYTHONPATH': HERE}
+    body = subprocess.run([sys.executable, str(script)], env=env, capture_output=True, check=True).stdout
+    assert b'proxy_upstream_requests_total{endpoint="launcher"} 1.0' in body
+    assert b'proxy_upstream_requests_total{endpoint="worker"} 1.0' in body
+    assert not (directory / "counter_1.db").exists()
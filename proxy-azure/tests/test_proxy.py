@@ -0,0 +1,146 @@
+import asyncio
+import json
+
+import pytest
+import tiktoken
+
+import proxy
+from quota import DeploymentQuota
+from tokenizer import EncodingCache
+
+
+def ready_state(monkeypatch, ready, error=None, missing=()):
+    async def run():
+        cache = EncodingCache(retry_interval=3600)
+        cache._missing = set(missing)
+        monkeypatch.setattr(proxy, "encodings", cache)
+        monkeypatch.setattr(proxy, "ready", ready)
+        monkeypatch.setattr(proxy, "prewarm_error", error)
+        response = await proxy.get_ready()
+        return response.status_code, json.loads(response.body)
+    return asyncio.run(run())
+
+
+def test_ready_before_prewarming(monkeypatch):
+    status, state = ready_state(monkeypatch, False)
+    assert status == 503 and state['status'] == 'starting'
+
+
+def test_ready_after_prewarming(monkeypatch):
+    status, state = ready_state(monkeypatch, True)
+    assert status == 200 and state['status'] == 'ready'
+
+
+def test_ready_is_degraded_while_an_encoding_is_missing(monkeypatch):
+    status, state = ready_state(monkeypatch, True, missing={"o200k_base"})
+    assert status == 503 and state['status'] == 'degraded'
+    assert state['encodings']['missing'] == ["o200k_base"]
+
+
+def test_ready_is_degraded_after_a_failed_prewarm(monkeypatch):
+    status, state = ready_state(monkeypatch, True, error="no route to host")
+    assert status == 503 and state['error'] == "no route to host"
+
+
+def test_degraded_ready_retries_the_encodings(monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", lambda name: object())
+
+    async def run():
+        cache = EncodingCache(retry_interval=0)
+        cache._missing = {"o200k_base"}
+        monkeypatch.setattr(proxy, "encodings", cache)
+        monkeypatch.setattr(proxy, "ready", True)
+        assert (await proxy.get_ready()).status_code == 503
+        await cache._retry
+        return (await proxy.get_ready()).status_code
+    assert asyncio.run(run()) == 200
+
+
+class FakeUsage:
+    def model_dump(self):
+        return {'prompt_tokens': 3, 'completion_tokens': 4, 'total_tokens': 7}
+
+
+class FakeChunk:
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def test_usage_dict_of_old_and_new_sdk_chunks():
+    assert proxy.usage_dict(FakeChunk()) is None
+    assert proxy.usage_dict(FakeChunk(usage=None)) is None
+    assert proxy.usage_dict(FakeChunk(usage={'prompt_tokens': 3})) == {'prompt_tokens': 3}
+    assert proxy.usage_dict(FakeChunk(usage=FakeUsage()))['total_tokens'] == 7
+
+
+class RawResponse:
+    headers = {}
+
+    def parse(self):
+        return "parsed"
+
+
+class FakeCompletions:
+    """chat.completions.with_raw_response of openai 1.12, whose create() has no stream_options"""
+
+    def __init__(self):
+        self.with_raw_response = self
+        self.calls = []
+
+    async def create(self, *, messages, model, stream=None, extra_body=None):
+        self.calls.append({'model': model, 'stream': stream, 'extra_body': extra_body})
+        return RawResponse()
+
+
+class FakeClient:
+    def __init__(self):
+        self.chat = FakeChunk(completions=FakeCompletions())
+
+
+class FakeClients:
+    def __init__(self):
+        self.client = FakeClient()
+
+    def get(self, endpoint, api_key=None):
+        return self.client
+
+
+def sdk_request(monkeypatch, stream):
+    routes = proxy.parse_routes({'routes': {'svc': [{'endpoint': 'http://azure', 'deployment': 'gpt4o',
+                                                     'stream': stream}]}}, default_key='key')
+    clients = FakeClients()
+    monkeypatch.setattr(proxy, "openai_routes", proxy.DeploymentRouter(routes))
+    monkeypatch.setattr(proxy, "openai_clients", clients)
+    monkeypatch.setattr(proxy, "OPENAI_PASSTHROUGH", False)
+    history = [{'role': 'user', 'content': 'Hello'}]
+    target, response = asyncio.run(proxy.open_upstream('svc', history, 10))
+    assert response == "parsed"
+    return clients.client.chat.completions.calls
+
+
+def test_sdk_requests_usage_in_the_body(monkeypatch):
+    [call] = sdk_request(monkeypatch, stream=True)
+    assert call['extra_body'] == {'stream_options': {'include_usage': True}}
+
+
+def test_sdk_does_not_request_usage_without_streaming(monkeypatch):
+    [call] = sdk_request(monkeypatch, stream=False)
+    assert call['stream'] is False and call['extra_body'] is None
+
+
+def test_quota_is_reconciled_per_count():
+    quota = DeploymentQuota(tpm=6000)
+    now = quota.tokens.updated
+
+    def reserve_and_reconcile(counts):
+        quota.tokens.take(1500, now)                # A prompt of 1000 and 500 output tokens
+        proxy.reconcile_quota(quota, (1000, 500), counts)
+        return quota.tokens.available(now)
+
+    # An answer without output tokens gives back the whole output estimate
+    assert reserve_and_reconcile((900, 0)) == pytest.approx(6000 - 900, abs=1)
+    quota.tokens.give(900, now)
+    # Without usage, only the counts that are known correct their estimates
+    assert reserve_and_reconcile((None, 20)) == pytest.approx(6000 - 1020, abs=1)
+    quota.tokens.give(1020, now)
+    assert reserve_and_reconcile((None, None)) == pytest.approx(6000 - 1500, abs=1)
@@ -0,0 +1,78 @@
+import asyncio
+
+import pytest
+
+from quota import DeploymentQuota, QuotaExceeded, TokenBucket
+
+
+def test_bucket_refills_at_its_rate_up_to_the_window():
+    bucket = TokenBucket(600, 10)               # 10 per second, 100 at most
+    now = bucket.updated
+    assert bucket.available(now) == 100
+    bucket.take(130, now)
+    assert bucket.available(now) == -30
+    assert bucket.delay(10, now) == pytest.approx(4.0)
+    assert bucket.available(now + 2) == pytest.approx(-10)
+    assert bucket.available(now + 60) == 100
+    # An amount beyond the capacity waits for a full bucket instead of forever
+    assert bucket.delay(1000, now + 60) == 0
+
+
+def test_give_never_exceeds_the_capacity():
+    bucket = TokenBucket(60, 60)
+    now = bucket.updated
+    bucket.take(10, now)
+    bucket.give(50, now)
+    assert bucket.available(now) == 60
+
+
+def test_reservations_queue_in_order_of_arrival():
+    quota = DeploymentQuota(rpm=None, tpm=60)     # One token per second, 60 at most
+
+    async def run():
+        first = await quota.acquire(60, budget=5)
+        # Each reservation lowers the level the next one waits on
+        return [first, *await asyncio.gather(quota.acquire(0.02, budget=5), quota.acquire(0.02, budget=5))]
+    first, second, third = asyncio.run(run())
+    assert first == 0
+    assert 0 < second < third < 0.1
+    assert third - second == pytest.approx(0.02, abs=0.005)
+
+
+def test_requests_beyond_the_budget_are_refused_without_reserving():
+    quota = DeploymentQuota(rpm=6, tpm=None)      # A window of 10 s holds one request
+
+    async def run():
+        await quota.acquire(0, budget=1)
+        with pytest.raises(QuotaExceeded) as refused:
+            await quota.acquire(0, budget=1)
+        return refused.value
+    refused = asyncio.run(run())
+    assert 9 < refused.retry_after <= 10
+    assert quota.stats()['refused'] == 1 and quota.stats()['requests_left'] == 0
+
+
+def test_cancelled_waiters_give_their_reservation_back():
+    quota = DeploymentQuota(tpm=60)
+
+    async def run():
+        await quota.acquire(60, budget=5)
+        waiter = asyncio.create_task(quota.acquire(30, budget=60))
+        await asyncio.sleep(0.01)
+        assert quota.stats()['waiting'] == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return quota.stats()
+    stats = asyncio.run(run())
+    assert stats['waiting'] == 0 and stats['tokens_left'] == 0
+
+
+def test_reconcile_and_release_correct_the_estimate():
+    quota = DeploymentQuota(rpm=60, tpm=6000)
+    asyncio.run(quota.acquire(1000, budget=1))
+    quota.reconcile(1000, 400)
+    assert quota.stats()['tokens_left'] == 5600
+    quota.reconcile(400, 1400)
+    assert quota.stats()['tokens_left'] == 4600
+    quota.release(1400)
+    assert quota.stats()['tokens_left'] == 6000 and quota.stats()['requests_left'] == 10
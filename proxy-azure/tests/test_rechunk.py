@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+from rechunk import BATCH_BYTES, WORD, ChunkTemplate, byte_pieces, parse_chunking, word_pieces
+
+COMPLETION = {
+    'id': 'chatcmpl-1', 'created': 1700000000, 'model': 'o1', 'object': 'chat.completion',
+    'system_fingerprint': 'fp', 'usage': {'prompt_tokens': 3, 'completion_tokens': 5},
+    'choices': [{'index': 0, 'finish_reason': 'stop', 'content_filter_results': {'hate': {'filtered': False}},
+                 'message': {'role': 'assistant', 'content': 'ignored'}}],
+}
+TEXT = 'Grüße,  "world"\n\tback\\slash 😀 end '
+
+
+def parse_events(batches):
+    events = ''.join(batches).split('\n')
+    assert events.pop() == ''
+    return [json.loads(event[len('data: '):]) for event in events]
+
+
+def test_word_pieces_keep_all_whitespace():
+    pieces = word_pieces(TEXT)
+    assert ''.join(pieces) == TEXT
+    assert pieces[:2] == ['Grüße,  ', '"world"\n\t']
+    assert word_pieces('') == [] and word_pieces('  ') == ['  ']
+
+
+def test_byte_pieces_never_split_a_character():
+    for size in (1, 2, 3, 5, 100):
+        pieces = byte_pieces(TEXT, size)
+        assert ''.join(pieces) == TEXT
+        assert all(len(piece.encode()) <= size or len(piece) == 1 for piece in pieces)
+
+
+def test_events_match_serialized_chunks():
+    template = ChunkTemplate(COMPLETION)
+    for chunking in (WORD, 4):
+        chunks = parse_events(template.events(TEXT, chunking))
+        assert ''.join(chunk['choices'][0]['delta']['content'] for chunk in chunks) == TEXT
+        first = chunks[0]
+        assert first['object'] == 'chat.completion.chunk' and first['id'] == 'chatcmpl-1'
+        assert first['choices'][0]['content_filter_results'] == {'hate': {'filtered': False}}
+        assert first['choices'][0]['finish_reason'] is None
+
+
+def test_events_are_batched():
+    batches = list(ChunkTemplate(COMPLETION).events('word ' * 10000))
+    assert len(batches) > 1
+    assert all(len(batch) >= BATCH_BYTES for batch in batches[:-1])
+    assert len(parse_events(batches)) == 10000
+
+
+def test_parse_chunking():
+    assert parse_chunking('word') == WORD and parse_chunking('64') == 64
+    for value in ('0', '-1', 'lines'):
+        with pytest.raises(ValueError):
+            parse_chunking(value)
@@ -0,0 +1,82 @@
+import collections
+import random
+
+import pytest
+
+from routing import DeploymentRouter, Target, header_seconds, parse_routes
+
+
+def router(*targets, **options):
+    return DeploymentRouter({'svc': list(targets)}, **options)
+
+
+def test_parse_routes_and_legacy_deployment_keys():
+    config = {
+        'routes': {'openai-gpt4o': [{'deployment': 'gpt4o-eu', 'weight': 2},
+                                    {'endpoint': 'https://us', 'deployment': 'gpt4o-us', 'key': 'k2', 'rpm': 60}]},
+        'limits': {'gpt4o-eu': {'tpm': 1000}},
+        'streaming': {'o3': False},
+        'openai_deployment_name_gpt4o': 'ignored',
+        'openai_deployment_name_o1_mini': 'o1-mini',
+        'openai_deployment_name_o3': 'o3',
+    }
+    routes = parse_routes(config, 'https://eu', 'k1', quota_share=0.5)
+    eu, us = routes['openai-gpt4o']
+    assert (eu.endpoint, eu.weight, eu.api_key, eu.quota.tpm, eu.quota.rpm) == ('https://eu', 2.0, 'k1', 500, None)
+    assert (us.endpoint, us.api_key, us.quota.rpm) == ('https://us', 'k2', 30)
+    assert routes['openai-o1-mini'][0].stream is False and routes['openai-o3'][0].stream is False
+    assert eu.stream is True
+    with pytest.raises(ValueError):
+        parse_routes({'routes': {'svc': [{'deployment': 'd', 'weight': 0}]}}, 'https://eu')
+    with pytest.raises(ValueError):
+        parse_routes({'routes': {'svc': [{'deployment': 'd'}]}})
+
+
+def test_header_seconds():
+    assert header_seconds({'retry-after-ms': '1500', 'retry-after': '9'}) == 1.5
+    assert header_seconds({'retry-after': '3'}) == 3.0
+    assert header_seconds({'retry-after': 'Wed, 21 Oct 2015 07:28:00 GMT'}) is None
+
+
+def test_picks_by_weight_scaled_by_the_remaining_rate_limit():
+    random.seed(1)
+    heavy, light = Target('https://a', 'd', weight=3), Target('https://b', 'd', weight=1)
+    routing = router(heavy, light)
+    counts = collections.Counter(routing.pick('svc').endpoint for _ in range(4000))
+    assert 2700 < counts['https://a'] < 3300
+    routing.record_success('svc', heavy, {'x-ratelimit-remaining-requests': '1',
+                                          'x-ratelimit-limit-requests': '100'})
+    counts = collections.Counter(routing.pick('svc').endpoint for _ in range(4000))
+    assert counts['https://b'] > counts['https://a']
+
+
+def test_throttled_targets_are_skipped_until_retry_after():
+    first, second = Target('https://a', 'd'), Target('https://b', 'd')
+    routing = router(first, second)
+    routing.record_throttled('svc', first, {'retry-after': '30'})
+    assert all(routing.pick('svc') is second for _ in range(20))
+    routing.record_throttled('svc', second, {})
+    assert routing.is_throttled('svc') and routing.pick('svc') is None
+    assert 9 < routing.retry_after('svc') <= 10
+
+
+def test_failover_excludes_tried_targets_until_all_were_tried():
+    first, second = Target('https://a', 'd'), Target('https://b', 'd')
+    routing = router(first, second, max_attempts=3)
+    assert routing.attempts('svc') == 3
+    assert routing.pick('svc', exclude=[first]) is second
+    assert routing.pick('svc', exclude=[first, second]) in (first, second)
+
+
+def test_failing_targets_are_ejected_and_still_used_as_a_last_resort():
+    outcomes = []
+    first, second = Target('https://a', 'd'), Target('https://b', 'd')
+    routing = router(first, second, failure_threshold=2, observer=lambda s, t, outcome: outcomes.append(outcome))
+    for _ in range(2):
+        routing.record_failure('svc', first, "HTTP 500")
+    assert first.ejections == 1 and all(routing.pick('svc') is second for _ in range(20))
+    assert routing.pick('svc', exclude=[second]) is first
+    routing.record_success('svc', first, {})
+    assert (first.ejections, first.consecutive_errors) == (0, 0)
+    assert outcomes == ['failed', 'failed', 'ok']
+    assert routing.health()['svc']['https://a/d']['errors'] == 2
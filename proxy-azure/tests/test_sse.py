@@ -0,0 +1,80 @@
+import json
+
+import pytest
+
+from sse import SSEParser
+
+
+def event(payload, separators=(',', ':')):
+    return b'data: ' + json.dumps(payload, separators=separators).encode() + b'\n\n'
+
+
+def chunk(content, **delta):
+    return {'id': 'c', 'object': 'chat.completion.chunk', 'usage': None,
+            'choices': [{'index': 0, 'content_filter_results': {'hate': {'filtered': False}},
+                         'delta': {'content': content, **delta}, 'finish_reason': None}]}
+
+
+PROMPT_FILTER = {'id': '', 'choices': [], 'prompt_filter_results': [{'prompt_index': 0}]}
+USAGE = {'id': 'c', 'choices': [], 'usage': {'prompt_tokens': 5, 'completion_tokens': 3, 'total_tokens': 8}}
+CONTENTS = ['Hello', ' wörld', ' "quoted"', ' back\\slash', '\n', 'emoji \U0001f600', '']
+
+
+def stream(separators=(',', ':')):
+    events = [event(PROMPT_FILTER, separators), event(chunk(None, role='assistant'), separators)]
+    events += [event(chunk(content), separators) for content in CONTENTS]
+    return b''.join(events + [event(USAGE, separators), b'data: [DONE]\n\n'])
+
+
+def run(data, size=7, **options):
+    parser = SSEParser(keep_content=True, **options)
+    forwarded = b''.join(parser.feed(data[i:i + size]) for i in range(0, len(data), size)) + parser.finish()
+    return parser, forwarded
+
+
+@pytest.mark.parametrize('separators', [(',', ':'), (', ', ': ')])
+def test_content_and_usage_are_read(separators):
+    parser, forwarded = run(stream(separators))
+    assert parser.usage == USAGE['usage']
+    assert ''.join(parser.content) == ''.join(CONTENTS)
+    assert parser.content_size == len(''.join(CONTENTS))
+    assert parser.events == len(CONTENTS) + 1
+    assert b'prompt_filter_results' not in forwarded and b'prompt_tokens' not in forwarded
+    assert forwarded.endswith(b'data: [DONE]\n\n')
+
+
+def test_usage_is_forwarded_if_the_client_asked_for_it():
+    _, forwarded = run(stream(), forward_usage=True)
+    assert event(USAGE) in forwarded and b'prompt_filter_results' not in forwarded
+
+
+def test_on_content_sees_every_delta():
+    seen = []
+    run(stream(), on_content=seen.append)
+    assert seen == [content for content in CONTENTS if content]
+
+
+def test_content_key_inside_a_string_is_not_taken_for_the_delta():
+    payload = chunk('x')
+    payload['choices'][0]['delta'] = {'role': 'assistant', 'tool_calls': [{'arguments': '{"content": "no"}'}]}
+    parser, _ = run(event(payload))
+    assert parser.content == [] and parser.events == 1
+
+
+def test_lines_that_are_not_json_are_forwarded():
+    parser, forwarded = run(b'data: not json\n\n' + event(chunk('a')))
+    assert forwarded.startswith(b'data: not json\n\n') and parser.content == ['a']
+
+
+def test_unusual_chunks_match_a_full_decode():
+    lines = [
+        event({'choices': [{'logprobs': {'content': [{'token': 'a'}]}, 'delta': {'content': 'a'}}]}),
+        event({'usage': {'total_tokens': 1}}),
+        event({'object': 'ping'}),
+    ]
+    for line in lines:
+        fast = SSEParser(keep_content=True)
+        full = SSEParser(keep_content=True)
+        data = line[6:-1]
+        assert fast._keep(data) == full._keep_parsed(data)
+        assert (fast.content, fast.usage, fast.events) == (full.content, full.usage, full.events)
@@ -0,0 +1,81 @@
+import asyncio
+
+import tiktoken
+
+import tokenizer
+from tokenizer import EncodingCache, OutputCounter, split_point
+
+
+class FakeEncoding:
+    """Counts words instead of tokens"""
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def fake_get_encoding(available):
+    def get_encoding(name):
+        if name not in available:
+            raise OSError(f"cannot download {name}")
+        return FakeEncoding()
+    return get_encoding
+
+
+def test_split_point_is_before_a_word():
+    assert split_point("hello world again") == 11
+    assert split_point("nospaces") == 0
+
+
+def test_output_counter_counts_all_chunks():
+    async def run():
+        counter = OutputCounter(FakeEncoding(), chunk=10)
+        for word in ["alpha ", "beta ", "gamma ", "delta ", "epsilon"]:
+            counter.add(word)
+        return await counter.total()
+    assert asyncio.run(run()) == 5
+
+
+def test_missing_encoding_is_reported_and_retried(monkeypatch):
+    available = set()
+    monkeypatch.setattr(tiktoken, "get_encoding", fake_get_encoding(available))
+
+    async def run():
+        cache = EncodingCache(retry_interval=0)
+        # The first load runs in its own task, as prewarm() does
+        assert await asyncio.create_task(cache.load(names={"cl100k_base"})) is False
+        assert cache.missing == {"cl100k_base"}
+        assert cache.stats()["error"] == "cannot download cl100k_base"
+        available.add("cl100k_base")
+        cache.retry()
+        await cache._retry
+        return cache
+    cache = asyncio.run(run())
+    assert cache.missing == set()
+    assert cache.stats() == {'loaded': ["cl100k_base"], 'missing': [], 'error': None}
+
+
+def test_retry_waits_for_the_interval(monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", fake_get_encoding(set()))
+
+    async def run():
+        cache = EncodingCache(retry_interval=3600)
+        await asyncio.create_task(cache.load(names={"cl100k_base"}))
+        cache.retry()
+        return cache
+    assert asyncio.run(run())._retry is None
+
+
+def test_get_schedules_a_retry_for_an_unloaded_model(monkeypatch):
+    monkeypatch.setattr(tiktoken, "get_encoding", fake_get_encoding({tokenizer.FALLBACK_ENCODING}))
+
+    async def run():
+        cache = EncodingCache(retry_interval=0)
+        try:
+            cache.get("some-deployment")
+        except LookupError:
+            pass
+        else:
+            raise AssertionError("encoding should not be loaded yet")
+        await cache._retry
+        return cache.get("some-deployment")
+    assert isinstance(asyncio.run(run()), FakeEncoding)
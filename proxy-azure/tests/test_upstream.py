@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pytest
+
+from upstream import ClientPool, UpstreamStatusError
+
+
+async def handle(reader, writer):
+    """A keep-alive HTTP/1.1 server answering chat completions, with 429 for the deployment "busy" """
+    while True:
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode().split('\r\n')
+        length = next((int(line.split(':')[1]) for line in lines if line.lower().startswith('content-length')), 0)
+        await reader.readexactly(length)
+        if '/deployments/busy/' in lines[0]:
+            status, body = "429 Too Many Requests", json.dumps({'error': {'message': "Slow down"}})
+        else:
+            status, body = "200 OK", 'data: {"choices": []}\n\ndata: [DONE]\n\n'
+        writer.write(f"HTTP/1.1 {status}\r\ncontent-length: {len(body)}\r\n\r\n{body}".encode())
+        await writer.drain()
+
+
+async def serve():
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    return server, f"http://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+
+
+def test_requests_share_the_connections_of_one_client():
+    requests, connects = [], []
+
+    async def run():
+        server, endpoint = await serve()
+        pool = ClientPool("key", "2024-06-01", request_observer=requests.append,
+                          connect_observer=lambda host, seconds: connects.append(host))
+        try:
+            assert pool.get(endpoint) is pool.get(endpoint)
+            bodies = []
+            for _ in range(3):
+                response = await pool.stream(endpoint, "gpt4o", b'{}')
+                bodies.append(await response.aread())
+                await response.aclose()
+            return bodies
+        finally:
+            await pool.close()
+            server.close()
+    bodies = asyncio.run(run())
+    assert bodies == [b'data: {"choices": []}\n\ndata: [DONE]\n\n'] * 3
+    assert requests == ["127.0.0.1"] * 3
+    assert connects == ["127.0.0.1"]
+
+
+def test_error_statuses_raise_with_the_message():
+    async def run():
+        server, endpoint = await serve()
+        pool = ClientPool("key", "2024-06-01")
+        try:
+            await pool.stream(endpoint, "busy", b'{}')
+        finally:
+            await pool.close()
+            server.close()
+    with pytest.raises(UpstreamStatusError) as error:
+        asyncio.run(run())
+    assert (error.value.status_code, error.value.message) == (429, "Slow down")
+
+
+def test_clients_made_by_a_request_win_over_prewarmed_ones():
+    async def run():
+        pool = ClientPool("key", "2024-06-01")
+        first = pool.get("http://azure")
+        prewarmed = pool.create("http://azure", "other-key")
+        await pool.add("http://azure", prewarmed)
+        try:
+            return first, pool.get("http://azure"), prewarmed[1].is_closed
+        finally:
+            await pool.close()
+    first, current, closed = asyncio.run(run())
+    assert current is first and closed
+
+
+def test_http2_needs_h2(monkeypatch):
+    monkeypatch.setattr("importlib.util.find_spec", lambda name: None)
+    assert ClientPool("key", "2024-06-01", http2=True).http2 is False
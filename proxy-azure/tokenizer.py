@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import time
+
+############################################################################
+## Tokenizer encodings                                                    ##
+############################################################################
+## tiktoken reads the BPE ranks of an encoding on first use and downloads ##
+## them unless TIKTOKEN_CACHE_DIR holds a copy. Done inline, this stalled ##
+## the event loop on the first request, and on every request while the    ##
+## download failed. Encodings are therefore loaded in a thread at startup ##
+## and counting only uses loaded ones; failed loads are retried in the    ##
+## background at most every retry_interval seconds. Counting itself runs  ##
+## in a thread pool, where tiktoken releases the GIL, and streamed output ##
+## is counted a chunk at a time while it arrives.                         ##
+############################################################################
+
+FALLBACK_ENCODING = "cl100k_base"   # For models tiktoken does not know, such as deployment names
+RETRY_INTERVAL = 60                 # Seconds between attempts to load a failed encoding
+COUNT_CHUNK = 4096                  # Characters of streamed output counted at once
+
+
+def encoding_name(model):
+    import tiktoken
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        return FALLBACK_ENCODING
+
+
+def count_tokens(encoding, text):
+    return len(encoding.encode_ordinary(text))
+
+
+def split_point(text):
+    """Index of the last space before a word, where tiktoken splits the text anyway; 0 if there is none"""
+    i = len(text) - 1
+    while (i := text.rfind(' ', 0, i)) > 0:
+        if not text[i - 1].isspace() and text[i + 1].isalpha():
+            return i
+    return 0
+
+
+class OutputCounter:
+    """Counts the tokens of streamed output in an executor, a chunk at a time, as deltas arrive"""
+
+    def __init__(self, encoding, executor=None, chunk=COUNT_CHUNK):
+        self.encoding = encoding
+        self.executor = executor
+        self.chunk = chunk
+        self._pending = []
+        self._size = 0
+        self._counts = []           # Futures of the chunks handed to the executor
+
+    def add(self, text):
+        self._pending.append(text)
+        self._size += len(text)
+        if self._size >= self.chunk:
+            text = ''.join(self._pending)
+            i = split_point(text)
+            if i:
+                self._submit(text[:i])
+                text = text[i:]
+            self._pending = [text]
+            self._size = len(text)
+
+    def _submit(self, text):
+        loop = asyncio.get_running_loop()
+        self._counts.append(loop.run_in_executor(self.executor, count_tokens, self.encoding, text))
+
+    async def total(self):
+        """Counts what is left and returns the tokens of all output"""
+        if self._size:
+            self._submit(''.join(self._pending))
+            self._pending = []
+            self._size = 0
+        return sum(await asyncio.gather(*self._counts))
+
+
+class EncodingCache:
+    """tiktoken encodings of a set of models, loaded off the event loop"""
+
+    def __init__(self, retry_interval=RETRY_INTERVAL):
+        self.retry_interval = retry_interval
+        self.error = None           # Last load error, if an encoding is missing
+        self._encodings = {}        # Encoding name -> tiktoken Encoding
+        self._missing = set()       # Encoding names that failed to load
+        self._initial = None        # Task of the first load
+        self._retry = None
+        self._failed_at = 0.0
+
+    async def load(self, models=(), names=()):
+        """Loads the encodings of models and encodings by name; returns True if all of them are available"""
+        if self._initial is None:
+            self._initial = asyncio.current_task()
+        started = time.monotonic()
+        missing = await asyncio.to_thread(self._load, list(models), set(names))
+        self._missing = missing
+        if missing:
+            self._failed_at = time.monotonic()
+            logging.warning(f"Could not load tokenizer encodings {', '.join(sorted(missing))}, "
+                            f"token counts will be 0 until a retry succeeds: {self.error}")
+            return False
+        self.error = None
+        logging.info(f"Loaded tokenizer encodings {', '.join(sorted(self._encodings))} "
+                     f"in {time.monotonic() - started:.2f} s")
+        return True
+
+    def _load(self, models, names):
+        """Loads each needed encoding once; returns the names that failed"""
+        import tiktoken
+        missing = set()
+        for name in sorted(names.union(map(encoding_name, models)) - set(self._encodings)):
+            try:
+                self._encodings[name] = tiktoken.get_encoding(name)
+            except Exception as e:
+                self.error = str(e)
+                missing.add(name)
+        return missing
+
+    async def wait(self):
+        """Waits for the first load, if it is still running"""
+        if self._initial and not self._initial.done():
+            await asyncio.shield(self._initial)
+
+    def get(self, model):
+        """The loaded encoding for model; raises LookupError and schedules a retry if it is missing.
+
+        Safe to call from threads, which only skip scheduling the retry.
+        """
+        name = encoding_name(model)
+        encoding = self._encodings.get(name)
+        if encoding is not None:
+            return encoding
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            raise LookupError(f"Tokenizer encoding for {model} is not loaded") from None
+        self.retry({name})
+        raise LookupError(f"Tokenizer encoding for {model} is not loaded")
+
+    def retry(self, names=()):
+        """Loads the missing encodings and names again in the background, at most every retry_interval seconds"""
+        loading = any(task and not task.done() for task in (self._initial, self._retry))
+        wanted = self._missing.union(names)
+        if wanted and not loading and time.monotonic() - self._failed_at > self.retry_interval:
+            self._retry = asyncio.get_running_loop().create_task(self.load(names=wanted))
+
+    @property
+    def missing(self):
+        """Names of the encodings that failed to load"""
+        return set(self._missing)
+
+    def stats(self):
+        return {
+            'loaded': sorted(self._encodings),
+            'missing': sorted(self._missing),
+            'error': self.error,
+        }
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+import importlib.util
+import logging
+import time
+
+import httpx
+from openai import AsyncAzureOpenAI
+
+############################################################################
+## Upstream clients                                                       ##
+############################################################################
+## One AsyncAzureOpenAI client per endpoint, shared by all requests of a  ##
+## worker, so connections (and their TCP and TLS handshakes) are reused   ##
+## across requests instead of being opened by a fresh client each time.   ##
+## Requests are traced through httpcore to count the connections that     ##
+## had to be opened and how long connecting took. Streamed completions    ##
+## can also be sent over the same connections without the OpenAI client,  ##
+## so their SSE bytes pass through unparsed.                              ##
+############################################################################
+
+MAX_CONNECTIONS = 100               # Concurrent connections per endpoint
+MAX_KEEPALIVE = 100                 # Idle connections kept open per endpoint
+KEEPALIVE_EXPIRY = 30               # Seconds an idle connection is kept open
+CONNECT_TIMEOUT = 5                 # Seconds to open a connection
+READ_TIMEOUT = 600                  # Seconds to wait for a response, like the OpenAI client's default
+
+
+class UpstreamStatusError(Exception):
+    """An error status answered to a request sent without the OpenAI client"""
+
+    def __init__(self, response, message):
+        super().__init__(f"HTTP {response.status_code}: {message}")
+        self.response = response
+        self.status_code = response.status_code
+        self.message = message
+
+
+class ClientPool:
+    """Creates and caches one client per endpoint; close() on shutdown.
+
+    Endpoints without a key of their own use api_key. request_observer is
+    called with the endpoint's host for every request sent,
+    connect_observer with the host and the seconds spent opening a new
+    connection.
+    """
+
+    def __init__(self, api_key, api_version, http2=False, max_connections=MAX_CONNECTIONS,
+                 max_keepalive=MAX_KEEPALIVE, keepalive_expiry=KEEPALIVE_EXPIRY, max_retries=None,
+                 request_observer=None, connect_observer=None):
+        self.api_key = api_key
+        self.api_version = api_version
+        self.max_retries = max_retries  # None keeps the OpenAI client's default
+        if http2 and importlib.util.find_spec("h2") is None:
+            logging.error("HTTP/2 to upstream endpoints needs the h2 package, using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.request_observer = request_observer
+        self.connect_observer = connect_observer
+        self._clients = {}
+
+    def create(self, endpoint, api_key=None):
+        """Builds a client and its HTTP client for endpoint without registering them; safe to call from a thread"""
+        host = httpx.URL(endpoint).host
+        tls = httpx.URL(endpoint).scheme == "https"
+        request_observer = self.request_observer
+        connect_observer = self.connect_observer
+
+        async def on_request(request):
+            connecting = None
+
+            async def trace(event, info):
+                nonlocal connecting
+                if event == "connection.connect_tcp.started":
+                    connecting = time.monotonic()
+                elif connecting is not None and (event == "connection.start_tls.complete"
+                                                 or event == "connection.connect_tcp.complete" and not tls):
+                    if connect_observer:
+                        connect_observer(host, time.monotonic() - connecting)
+                    connecting = None
+
+            request.extensions['trace'] = trace
+            if request_observer:
+                request_observer(host)
+
+        http_client = httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(max_connections=self.max_connections,
+                                max_keepalive_connections=self.max_keepalive,
+                                keepalive_expiry=self.keepalive_expiry),
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            follow_redirects=True,
+            event_hooks={'request': [on_request]},
+        )
+        options = {} if self.max_retries is None else {'max_retries': self.max_retries}
+        client = AsyncAzureOpenAI(api_key=api_key or self.api_key, api_version=self.api_version,
+                                  azure_endpoint=endpoint, http_client=http_client, **options)
+        return client, http_client
+
+    async def add(self, endpoint, clients):
+        """Registers the clients built by create(), unless a request already made some"""
+        if self._clients.setdefault(endpoint, clients) is not clients:
+            await clients[0].close()
+
+    def _get(self, endpoint, api_key):
+        clients = self._clients.get(endpoint)
+        if clients is None:
+            clients = self._clients[endpoint] = self.create(endpoint, api_key)
+        return clients
+
+    def get(self, endpoint, api_key=None):
+        return self._get(endpoint, api_key)[0]
+
+    async def stream(self, endpoint, deployment, body, api_key=None):
+        """Posts a chat completion request body to a deployment and returns the response with its body unread.
+
+        Raises UpstreamStatusError for error statuses and httpx errors if
+        the request fails. The caller closes the response with aclose().
+        """
+        http_client = self._get(endpoint, api_key)[1]
+        request = http_client.build_request(
+            "POST", f"{endpoint.rstrip('/')}/openai/deployments/{deployment}/chat/completions",
+            params={'api-version': self.api_version}, content=body,
+            headers={'api-key': api_key or self.api_key, 'content-type': 'application/json'},
+        )
+        response = await http_client.send(request, stream=True)
+        if response.status_code >= 400:
+            try:
+                await response.aread()
+                message = response.json()['error']['message']
+            except Exception:
+                message = response.reason_phrase
+            finally:
+                await response.aclose()
+            raise UpstreamStatusError(response, message)
+        return response
+
+    async def close(self):
+        clients, self._clients = self._clients, {}
+        for client, _ in clients.values():
+            try:
+                await client.close()
+            except Exception as e:
+                logging.warning(f"Failed to close upstream client: {str(e)}")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+import json
+import logging
+
+############################################################################
+## Accounting                                                             ##
+############################################################################
+## Token usage is read from the "usage" object that vLLM (and any other   ##
+## OpenAI-compatible server) appends to a response: the last SSE event of ##
+## a stream with include_usage, or the tail of a plain JSON body.         ##
+############################################################################
+
+USAGE_KEY = b'"usage"'
+EVENT_PREFIX = b'data:'
+MAX_USAGE_SIZE = 4096               # Largest usage object we wait for before giving up on a candidate
+WHITESPACE = b' \t\r\n'
+COLON = ord(':')
+OPEN_BRACE = ord('{')
+
+
+class UsageExtractor:
+    """Incrementally extracts token usage from a response as it streams by.
+
+    Only a small window of not yet scanned bytes is kept, plus at most one
+    partially received usage object, so memory stays bounded no matter how
+    large the response is. The last complete usage object wins, like in
+    the reverse scan over all events this replaces.
+    """
+
+    def __init__(self, scan=True):
+        self.scan = scan            # If False, only counts bytes
+        self.output_size = 0
+        self.events = 0             # SSE events seen, about one per generated token until usage arrives
+        self.usage = None
+        self._buffer = bytearray()
+
+    def feed(self, chunk):
+        self.output_size += len(chunk)
+        if not self.scan or not chunk:
+            return
+        buffer = self._buffer
+        scanned = len(buffer)
+        buffer += chunk
+        # Prefixes split across chunks count once, since the kept tail is at least as long
+        self.events += buffer.count(EVENT_PREFIX, max(0, scanned - len(EVENT_PREFIX) + 1))
+        start = 0
+        while True:
+            idx = buffer.find(USAGE_KEY, start)
+            if idx < 0:
+                # Keep just enough bytes to match a key split across chunks
+                del buffer[:max(0, len(buffer) - len(USAGE_KEY) + 1)]
+                return
+            complete, end = self._parse_usage(buffer, idx + len(USAGE_KEY))
+            if not complete:
+                if len(buffer) - idx > MAX_USAGE_SIZE:
+                    start = idx + len(USAGE_KEY)
+                    continue
+                # Wait for the rest of this usage object
+                del buffer[:idx]
+                return
+            start = end
+
+    def _parse_usage(self, buffer, pos):
+        """Tries to decode the value after a usage key; returns (complete, end)"""
+        n = len(buffer)
+        while pos < n and buffer[pos] in WHITESPACE:
+            pos += 1
+        if pos < n and buffer[pos] == COLON:
+            pos += 1
+            while pos < n and buffer[pos] in WHITESPACE:
+                pos += 1
+        elif pos < n:
+            return True, pos        # Not a key, e.g. the word inside a string
+        if pos >= n:
+            return False, pos
+        if buffer[pos] != OPEN_BRACE:
+            return True, pos        # e.g. "usage": null in intermediate chunks
+        end = buffer.find(b'}', pos)
+        while end >= 0 and end - pos < MAX_USAGE_SIZE:
+            try:
+                usage = json.loads(buffer[pos:end + 1])
+            except ValueError:
+                end = buffer.find(b'}', end + 1)    # Nested object, extend to the next brace
+                continue
+            if isinstance(usage, dict):
+                self.usage = usage
+            return True, end + 1
+        return end >= 0 or n - pos >= MAX_USAGE_SIZE, pos
+
+    def tokens(self):
+        """Returns (input_tokens, output_tokens) of the last usage object seen"""
+        if self.usage is None:
+            logging.error("No usage data found.")
+            return 0, 0
+        return self.usage.get('prompt_tokens', 0), self.usage.get('completion_tokens', 0)
+
+
+def extract_tokens(response):
+    """Returns (input_tokens, output_tokens) from a complete response body"""
+    extractor = UsageExtractor()
+    extractor.feed(response)
+    return extractor.tokens()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+import asyncio
+import collections
+import json
+import logging
+import time
+
+from shared_state import InFlightRegistry
+
+############################################################################
+## Admission control                                                      ##
+############################################################################
+## Every service has a concurrency limit and a bounded wait queue. When a ##
+## slot frees up, it goes to the next waiter in round-robin order, first  ##
+## across organizations (o/ou) and then across users within the chosen    ##
+## organization, so a burst from one API user cannot starve the others.   ##
+## Limits and queue sizes hold for the whole host: running and waiting    ##
+## requests are counted in shared_state registries, and workers with      ##
+## waiters poll for slots freed by other workers. The round-robin order   ##
+## holds within a worker.                                                 ##
+############################################################################
+
+DEFAULT_LIMITS = {
+    'limit': 64,                    # Concurrent requests per service
+    'queue': 256,                   # Waiting requests per service
+    'queue_per_consumer': 32,       # Waiting requests per user of a service
+    'timeout': 60,                  # Seconds a request may wait for a slot
+}
+POLL_INTERVAL = 0.025               # Seconds between checks for slots freed by other workers
+MAX_QUEUES = 256                    # Idle service queues are dropped beyond this, as services come from the request
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request can neither run nor wait; carries a Retry-After hint"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Permit:
+    """A granted slot; release() is idempotent"""
+
+    def __init__(self, queue, user, queue_depth=0, queue_wait=0.0):
+        self._queue = queue
+        self._user = user
+        self._granted = time.monotonic()
+        self.queue_depth = queue_depth
+        self.queue_wait = queue_wait
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._queue.observe_hold(time.monotonic() - self._granted)
+            self._queue.release(self._user)
+
+
+class _Waiter:
+    __slots__ = ('future', 'group', 'user')
+
+    def __init__(self, future, group, user):
+        self.future = future
+        self.group = group
+        self.user = user
+
+
+class ServiceQueue:
+    """Concurrency limit and two-level fair wait queue of one service.
+
+    running and queued are the host-wide InFlightRegistries of admitted and
+    waiting requests; active and waiting count this worker's share.
+    """
+
+    def __init__(self, service, limit, queue, queue_per_consumer, timeout, running, queued):
+        self.service = service
+        self.running = running
+        self.queued = queued
+        self.limit = limit
+        self.max_queue = queue
+        self.queue_per_consumer = queue_per_consumer
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        # group -> user -> deque of waiters; OrderedDicts double as round-robin rings
+        self._groups = collections.OrderedDict()
+        self._avg_hold = 1.0
+        self._poller = None
+
+    def retry_after(self):
+        """Rough estimate of when a slot will be free for a new request"""
+        backlog = (self.queued.count(self.service) + 1) / max(1, self.limit)
+        return max(1, int(backlog * self._avg_hold + 0.5))
+
+    async def acquire(self, group, user):
+        waiting = self.queued.count(self.service)
+        if waiting == 0 and await self.running.enter(self.service, user, self.limit):
+            self.active += 1
+            return Permit(self, user)
+        if waiting >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"Too many queued requests for {self.service}", self.retry_after())
+        if self.queued.count(self.service, user) >= self.queue_per_consumer:
+            self.rejected += 1
+            raise AdmissionRejected(f"Too many queued requests for {self.service} from this user",
+                                    self.retry_after())
+        users = self._groups.setdefault(group, collections.OrderedDict())
+        waiters = users.setdefault(user, collections.deque())
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), group, user)
+        waiters.append(waiter)
+        self.waiting += 1
+        await self.queued.enter(self.service, user)
+        if self._poller is None or self._poller.done():
+            self._poller = asyncio.create_task(self._poll())
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as we gave up: hand the slot on
+                self.release(user)
+            else:
+                waiter.future.cancel()
+                self._remove(waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise AdmissionRejected(f"Timed out waiting for {self.service}", self.retry_after())
+            raise
+        return Permit(self, user, queue_depth=waiting, queue_wait=time.monotonic() - started)
+
+    def _remove(self, waiter):
+        users = self._groups.get(waiter.group)
+        waiters = users.get(waiter.user) if users else None
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        self.waiting -= 1
+        self.queued.leave(self.service, waiter.user)
+        if not waiters:
+            del users[waiter.user]
+            if not users:
+                del self._groups[waiter.group]
+
+    def _next_waiter(self):
+        """Pops the head of the next user's queue in the next group, rotating both rings"""
+        if not self._groups:
+            return None
+        group, users = next(iter(self._groups.items()))
+        self._groups.move_to_end(group)
+        user, waiters = next(iter(users.items()))
+        users.move_to_end(user)
+        waiter = waiters.popleft()
+        self.waiting -= 1
+        self.queued.leave(self.service, user)
+        if not waiters:
+            del users[user]
+            if not users:
+                del self._groups[group]
+        return waiter
+
+    def _peek_waiter(self):
+        """The waiter _next_waiter() would return"""
+        users = next(iter(self._groups.values()))
+        return next(iter(users.values()))[0]
+
+    def release(self, user):
+        """Hands the slot of user to the next waiter, or frees it"""
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self.active -= 1
+                self.running.leave(self.service, user)
+                return
+            if not waiter.future.done():
+                self.running.transfer(self.service, user, waiter.user)
+                waiter.future.set_result(None)
+                return
+
+    async def _poll(self):
+        """Grants slots freed by other workers while this one has waiters"""
+        while self.waiting:
+            await asyncio.sleep(POLL_INTERVAL)
+            while self.waiting:
+                waiter = self._peek_waiter()
+                if waiter.future.done():
+                    self._next_waiter()
+                    continue
+                if not await self.running.enter(self.service, waiter.user, self.limit):
+                    break
+                if not self._groups or self._peek_waiter() is not waiter or waiter.future.done():
+                    # The waiter gave up while the host lock was taken
+                    self.running.leave(self.service, waiter.user)
+                    continue
+                self._next_waiter()
+                self.active += 1
+                waiter.future.set_result(None)
+
+    def observe_hold(self, seconds):
+        self._avg_hold = 0.9 * self._avg_hold + 0.1 * seconds
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'active': self.running.count(self.service),
+            'waiting': self.queued.count(self.service),
+            'rejected': self.rejected,
+        }
+
+
+class AdmissionController:
+    """Per-service admission control, configured from a JSON file.
+
+    The file maps service names (or "default") to any of the keys of
+    DEFAULT_LIMITS, e.g. {"default": {"limit": 32}, "my-model": {"limit": 8}}.
+    Requests are counted in the SharedState of the host.
+    """
+
+    def __init__(self, shared, config=None):
+        self.running = InFlightRegistry(shared, 'running')
+        self.queued = InFlightRegistry(shared, 'queued')
+        config = config or {}
+        default = {**DEFAULT_LIMITS, **self._validate('default', config.get('default', {}))}
+        self.config = {'default': default}
+        for service, limits in config.items():
+            if service != 'default':
+                self.config[service] = {**default, **self._validate(service, limits)}
+        self._queues = {}
+
+    @staticmethod
+    def _validate(service, limits):
+        unknown = set(limits) - set(DEFAULT_LIMITS)
+        if unknown:
+            logging.warning(f"Ignoring unknown admission settings for {service}: {', '.join(sorted(unknown))}")
+        return {key: value for key, value in limits.items() if key in DEFAULT_LIMITS}
+
+    @classmethod
+    def from_file(cls, shared, path):
+        try:
+            with open(path) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = None
+        except (OSError, ValueError) as e:
+            logging.error(f"Invalid admission config {path}, using defaults: {str(e)}")
+            config = None
+        return cls(shared, config)
+
+    def queue(self, service):
+        queue = self._queues.get(service)
+        if queue is None:
+            if len(self._queues) >= MAX_QUEUES:
+                self._drop_idle()
+            limits = self.config.get(service, self.config['default'])
+            queue = self._queues[service] = ServiceQueue(service, **limits, running=self.running,
+                                                         queued=self.queued)
+        return queue
+
+    def _drop_idle(self):
+        """Forgets queues without running or waiting requests; their counts live on in the shared state"""
+        for service in [service for service, queue in self._queues.items() if not queue.active and not queue.waiting]:
+            del self._queues[service]
+
+    async def acquire(self, service, uid, o=None, ou=None):
+        """Waits for a slot of the service; raises AdmissionRejected if that is not possible"""
+        return await self.queue(service).acquire((o, ou), uid)
+
+    def stats(self):
+        return {service: queue.stats() for service, queue in self._queues.items()}
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+
+############################################################################
+## Request coalescing                                                     ##
+############################################################################
+## Identical idempotent requests that arrive while one of them is still   ##
+## in flight share its SSH session instead of opening their own. The      ##
+## response of the leading request is pumped from the cloud interface by  ##
+## a task of its own and fanned out chunk by chunk to every waiter, the   ##
+## leader's client included, so no single client that disconnects cuts    ##
+## off the others. Late waiters replay the chunks received so far; once   ##
+## these exceed max_buffer, the flight stops taking waiters and drops     ##
+## chunks as soon as every waiter has received them. The pump then holds  ##
+## at most max_buffer bytes: it pauses while the slowest waiter lags      ##
+## behind, until that waiter catches up or is dropped by its own output   ##
+## stage. When the last waiter leaves, before or after the response head, ##
+## the upstream call is cancelled.                                        ##
+############################################################################
+
+MAX_BUFFER = 1024 * 1024            # Bytes kept for waiters that join after the response started
+
+
+class Flight:
+    """One upstream call shared by all identical requests that joined it"""
+
+    def __init__(self, key, table, max_buffer=MAX_BUFFER):
+        self.key = key
+        self.max_buffer = max_buffer
+        self.status_code = None
+        self.headers = None
+        self.inference = None       # Record of the leading request, with token counts once done
+        self.joinable = True
+        self.done = False
+        self.complete = False
+        self.waiters = 0            # Requests that joined, the leader included
+        self._table = table
+        self._head = asyncio.get_running_loop().create_future()
+        self._chunks = []
+        self._base = 0              # Index of the first chunk still held
+        self._size = 0              # Bytes held
+        self._positions = {}        # Index of the next chunk for each waiter
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Event()   # Set when held chunks are dropped
+        self._leader = None
+        self._pump = None
+
+    def join(self):
+        """Registers a waiter; returns the token for stream() and leave()"""
+        token = object()
+        self._positions[token] = self._base
+        self.waiters += 1
+        return token
+
+    def leave(self, token):
+        """Unregisters a waiter; the upstream call is cancelled when the last one leaves"""
+        if self._positions.pop(token, None) is None:
+            return
+        if not self._positions:
+            if self._pump and not self._pump.done():
+                self._pump.cancel()
+            elif self._pump is None and self._leader and not self._leader.done():
+                self._leader.cancel()
+        self._trim()
+
+    def lead(self, task):
+        """Sets the task running the upstream call until start(), to cancel it if every waiter leaves before"""
+        self._leader = task
+
+    async def head(self):
+        """Waits for the status and headers, raising what the leading request raised"""
+        await asyncio.shield(self._head)
+
+    def start(self, status_code, headers, body, inference):
+        """Publishes the response head and starts pumping the body iterator to the waiters"""
+        self.status_code = status_code
+        self.headers = headers
+        self.inference = inference
+        self._head.set_result(None)
+        self._pump = asyncio.create_task(self._run(body))
+
+    def fail(self, exc):
+        """Ends the flight before the response head, passing exc on to the waiters"""
+        if not self._head.done():
+            self._head.set_exception(exc)
+            self._head.exception()  # Retrieved here, in case nobody else was waiting
+        self._finish(False)
+
+    async def stream(self, token):
+        """Yields the response body for one waiter, from the first chunk on"""
+        while True:
+            position = self._positions.get(token)
+            if position is None:
+                return
+            index = position - self._base
+            if index < len(self._chunks):
+                self._positions[token] = position + 1
+                chunk = self._chunks[index]
+                if not self.joinable:
+                    self._trim()
+                yield chunk
+            elif self.done:
+                return
+            else:
+                await self._wakeup.wait()
+
+    async def _run(self, body):
+        complete = False
+        try:
+            async for chunk in body:
+                self._publish(chunk)
+                while self._size > self.max_buffer and self._positions:
+                    self._space.clear()
+                    await self._space.wait()
+            complete = True
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f"Coalesced request failed: {str(e)}")
+        finally:
+            self._finish(complete)
+
+    def _publish(self, chunk):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        if self.joinable and self._size > self.max_buffer:
+            self.joinable = False
+            self._table.discard(self)
+        if not self.joinable:
+            self._trim()
+        self._notify()
+
+    def _finish(self, complete):
+        self.done = True
+        self.complete = complete
+        self._table.discard(self)
+        self._notify()
+
+    def _notify(self):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+
+    def _trim(self):
+        """Drops the chunks every waiter has received, unless new waiters may still need them"""
+        if self.joinable:
+            return
+        lowest = min(self._positions.values(), default=self._base + len(self._chunks))
+        drop = lowest - self._base
+        if drop > 0:
+            self._size -= sum(len(chunk) for chunk in self._chunks[:drop])
+            del self._chunks[:drop]
+            self._base = lowest
+            self._space.set()
+
+
+class FlightTable:
+    """In-flight upstream calls of this worker by request key"""
+
+    def __init__(self, max_buffer=MAX_BUFFER):
+        self.max_buffer = max_buffer
+        self._flights = {}
+
+    def get(self, key):
+        """Returns the flight a request with this key can join, if any"""
+        return self._flights.get(key)
+
+    def open(self, key):
+        flight = Flight(key, self, self.max_buffer)
+        self._flights[key] = flight
+        return flight
+
+    def discard(self, flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self):
+        return len(self._flights)
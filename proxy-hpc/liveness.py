@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import os
+import time
+
+############################################################################
+## Liveness of the HPC login node                                         ##
+############################################################################
+## One uvicorn worker per host is elected through a shared_state lock     ##
+## file and runs the keep-alive probe; it publishes the result to a small ##
+## state file that every worker reads, so all of them can fail fast while ##
+## the login node is unreachable. If the leader dies, the kernel releases ##
+## its lock and another worker takes over on its next attempt.            ##
+############################################################################
+
+UP, DOWN, UNKNOWN = "up", "down", "unknown"
+
+
+class LivenessManager:
+    """Runs keep-alive probes once per host and tracks the health of the login node.
+
+    probe is a coroutine function returning True if the login node answered.
+    The node is considered down after failure_threshold consecutive failed
+    probes; a state older than stale_after seconds is treated as unknown, so
+    a missing leader never blocks requests.
+    """
+
+    def __init__(self, probe, state_path, leadership, interval=5, timeout=10,
+                 failure_threshold=3, stale_after=30, observer=None, name="HPC login node"):
+        self.probe = probe
+        self.name = name                # Used in log messages
+        self.state_path = state_path
+        self.leadership = leadership    # shared_state.Leadership of the keep-alive role
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.stale_after = stale_after
+        self.observer = observer        # Called with (success, rtt seconds) after each probe
+        self._task = None
+        self._closing = False
+        self._state = self._initial_state()
+        self._cached_at = 0
+
+    @staticmethod
+    def _initial_state():
+        return {
+            'status': UNKNOWN,
+            'updated_at': 0,
+            'last_success': None,
+            'last_failure': None,
+            'consecutive_failures': 0,
+            'rtt': None,
+            'rtt_avg': None,
+        }
+
+    async def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        # wait_for of Python 3.11 may swallow the cancellation if the probe ends at the same time
+        self._closing = True
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self.leadership.release()
+
+    @property
+    def is_leader(self):
+        return self.leadership.is_leader
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                was_leader = self.leadership.is_leader
+                if self.leadership.try_lead():
+                    if not was_leader:
+                        logging.info(f"Worker {os.getpid()} now runs the keep-alive routine for {self.name}")
+                    await self._probe_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Keep-alive of {self.name} failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+    async def _probe_once(self):
+        started = time.monotonic()
+        try:
+            success = await asyncio.wait_for(self.probe(), self.timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Keep-alive of {self.name} timed out after {self.timeout} s")
+            success = False
+        except Exception as e:
+            logging.warning(f"Keep-alive of {self.name} failed: {str(e)}")
+            success = False
+        rtt = time.monotonic() - started
+        state = dict(self._state)
+        now = time.time()
+        if success:
+            state['last_success'] = now
+            state['consecutive_failures'] = 0
+            state['rtt'] = rtt
+            state['rtt_avg'] = rtt if state['rtt_avg'] is None else 0.8 * state['rtt_avg'] + 0.2 * rtt
+            if state['status'] == DOWN:
+                logging.info(f"{self.name} reachable again")
+            state['status'] = UP
+        else:
+            state['last_failure'] = now
+            state['consecutive_failures'] += 1
+            if state['consecutive_failures'] >= self.failure_threshold:
+                if state['status'] != DOWN:
+                    logging.error(f"{self.name} unreachable after {state['consecutive_failures']} keep-alive failures")
+                state['status'] = DOWN
+        state['updated_at'] = now
+        self._state = state
+        if self.observer:
+            self.observer(success, rtt)
+        await asyncio.to_thread(self._publish, state)
+
+    def _publish(self, state):
+        tmp_path = f"{self.state_path}.{os.getpid()}"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def state(self):
+        """Current health state; followers re-read the leader's file at most once per second"""
+        if not self.is_leader and time.monotonic() - self._cached_at > 1:
+            self._cached_at = time.monotonic()
+            try:
+                with open(self.state_path) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                pass
+        state = dict(self._state)
+        if time.time() - state['updated_at'] > self.stale_after:
+            state['status'] = UNKNOWN
+        return state
+
+    def is_down(self):
+        return self.state()['status'] == DOWN
+
+    def retry_after(self):
+        """Seconds until the next probe may have brought the node back"""
+        return max(1, int(self.interval))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import glob
+import multiprocessing
+import os
+import sys
+import time
+
+############################################################################
+## Prometheus metrics                                                     ##
+############################################################################
+## All uvicorn workers write their samples to memory-mapped files in      ##
+## PROMETHEUS_MULTIPROC_DIR, and /metrics aggregates them, so counters    ##
+## stay correct no matter which worker serves the scrape. Samples of      ##
+## previous runs are removed by the process that starts the workers,      ##
+## before prometheus_client has opened any file in the directory.         ##
+############################################################################
+
+MULTIPROC_DIR = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus-proxy-hpc")
+os.makedirs(MULTIPROC_DIR, exist_ok=True)
+if multiprocessing.current_process().name == 'MainProcess' and 'prometheus_client' not in sys.modules:
+    for path in glob.glob(os.path.join(MULTIPROC_DIR, "*.db")):
+        os.remove(path)
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from prometheus_client import multiprocess
+
+MAX_SERVICE_LABELS = 256            # Unknown model names beyond this are reported as "other"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUESTS = Counter('proxy_requests_total', 'Requests by service and HTTP status', ['service', 'status'])
+IN_FLIGHT = Gauge('proxy_requests_in_flight', 'Requests currently being served', ['service'],
+                  multiprocess_mode='livesum')
+TTFB = Histogram('proxy_time_to_first_byte_seconds', 'Time until the first response body byte', ['service'],
+                 buckets=LATENCY_BUCKETS)
+DURATION = Histogram('proxy_request_duration_seconds', 'Time until the response is complete', ['service'],
+                     buckets=LATENCY_BUCKETS)
+TOKENS = Counter('proxy_tokens_total', 'Tokens from the inference records', ['service', 'portal', 'direction'])
+LEDGER_DROPS = Counter('proxy_ledger_dropped_total', 'Inference records lost by the usage ledger', ['reason'])
+SSH_SPAWN = Histogram('proxy_ssh_spawn_seconds', 'Time to start a remote command', buckets=LATENCY_BUCKETS)
+SSH_CONNECT = Histogram('proxy_ssh_connect_seconds', 'Time to establish a pooled SSH connection',
+                        buckets=LATENCY_BUCKETS)
+KEEP_ALIVE = Counter('proxy_keep_alive_total', 'Keep-alive probes by login node and result', ['node', 'result'])
+KEEP_ALIVE_RTT = Histogram('proxy_keep_alive_rtt_seconds', 'Round-trip time of keep-alive probes', ['node'],
+                           buckets=LATENCY_BUCKETS)
+HPC_UP = Gauge('proxy_hpc_up', 'Whether the last keep-alive probe of a login node succeeded', ['node'],
+               multiprocess_mode='livemax')
+NODE_EJECTIONS = Counter('proxy_node_ejections_total', 'Login nodes ejected after failed requests', ['node'])
+DISCONNECTS = Counter('proxy_client_disconnects_total',
+                      'Inferences abandoned by their client, by whether the login node cancelled them',
+                      ['service', 'cancelled'])
+SAVED_TOKENS = Counter('proxy_saved_tokens_total', 'Requested output tokens not generated thanks to cancellation',
+                       ['service'])
+STREAM_CHUNKS = Counter('proxy_stream_chunks_total', 'Chunks of streamed responses read from upstream')
+STREAM_WRITES = Counter('proxy_stream_writes_total', 'Writes of streamed responses to clients')
+STREAM_STALLS = Counter('proxy_stream_stalls_total',
+                        'Times reading from upstream paused for a client that did not keep up')
+STREAM_STALL_TIME = Counter('proxy_stream_stall_seconds_total',
+                            'Time reading from upstream was paused for slow clients')
+STREAM_DROPS = Counter('proxy_stream_drops_total', 'Streams whose upstream response was closed for a stalled client')
+COALESCED = Counter('proxy_coalesced_requests_total', 'Requests served by the upstream call of an identical one',
+                    ['service'])
+
+_services = set()
+
+
+def service_label(service):
+    """Bounds label cardinality, since the service comes from the request body"""
+    service = str(service)
+    if service in _services:
+        return service
+    if len(_services) < MAX_SERVICE_LABELS:
+        _services.add(service)
+        return service
+    return "other"
+
+
+def mark_worker_dead():
+    """Drops this worker's live gauges; call on worker shutdown"""
+    multiprocess.mark_process_dead(os.getpid())
+
+
+def render():
+    """Returns (body, content type) with samples of all workers"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def start_request(request, service):
+    """Marks a request as in flight once its service is known"""
+    service = service_label(service)
+    request.state.metrics_service = service
+    IN_FLIGHT.labels(service).inc()
+
+
+def observe_inference(inference):
+    """Counts tokens of a finished inference record"""
+    service = service_label(inference.get('service'))
+    portal = str(inference.get('portal'))
+    TOKENS.labels(service, portal, 'input').inc(inference.get('input_tokens') or 0)
+    TOKENS.labels(service, portal, 'output').inc(inference.get('output_tokens') or 0)
+
+
+def observe_ledger_drop(reason, count):
+    LEDGER_DROPS.labels(reason).inc(count)
+
+
+def observe_disconnect(inference, cancelled):
+    """Counts an inference abandoned by its client"""
+    service = service_label(inference.get('service'))
+    DISCONNECTS.labels(service, 'yes' if cancelled else 'no').inc()
+    SAVED_TOKENS.labels(service).inc(inference.get('saved_tokens') or 0)
+
+
+def observe_stream(stats):
+    """Counts reads, writes and stalls of a finished streamed response"""
+    STREAM_CHUNKS.inc(stats.chunks)
+    STREAM_WRITES.inc(stats.writes)
+    if stats.stalls:
+        STREAM_STALLS.inc(stats.stalls)
+        STREAM_STALL_TIME.inc(stats.stall_time)
+    if stats.dropped:
+        STREAM_DROPS.inc()
+
+
+def observe_keep_alive(node, success, rtt):
+    KEEP_ALIVE.labels(node, 'success' if success else 'failure').inc()
+    HPC_UP.labels(node).set(1 if success else 0)
+    if success:
+        KEEP_ALIVE_RTT.labels(node).observe(rtt)
+
+
+def observe_ejection(node):
+    NODE_EJECTIONS.labels(node.name).inc()
+
+
+class MetricsMiddleware:
+    """ASGI middleware measuring status, TTFB and duration of each request.
+
+    Only requests whose handler called start_request() are measured, which
+    leaves out /metrics itself and requests rejected before the service was
+    known.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = 500
+        first_byte = False
+
+        async def send_wrapper(message):
+            nonlocal status, first_byte
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body' and not first_byte and message.get('body'):
+                first_byte = True
+                service = scope.get('state', {}).get('metrics_service')
+                if service:
+                    TTFB.labels(service).observe(time.perf_counter() - start)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            service = scope.get('state', {}).get('metrics_service')
+            if service:
+                IN_FLIGHT.labels(service).dec()
+                REQUESTS.labels(service, str(status)).inc()
+                DURATION.labels(service).observe(time.perf_counter() - start)
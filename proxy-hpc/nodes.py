@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+import logging
+import random
+import time
+
+############################################################################
+## Login node routing                                                     ##
+############################################################################
+## The proxy can reach the cluster through several login nodes. Each node ##
+## has its own SSH pool and keep-alive routine; requests go to the node   ##
+## with the fewest outstanding requests per unit of weight, counted over  ##
+## all workers of the host. Nodes that fail repeatedly are ejected for a  ##
+## while, for twice as long on every consecutive ejection, and nodes      ##
+## whose keep-alive reports them down are skipped until it succeeds again ##
+############################################################################
+
+LATENCY_SMOOTHING = 0.2             # Weight of the newest sample in the latency moving average
+
+
+class LoginNode:
+    """One HPC login node with its SSH pool, liveness and load statistics"""
+
+    def __init__(self, host, port=22, user=None, weight=1.0):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.weight = weight
+        self.name = f"{host}:{port}"
+        self.pool = None            # SSHConnectionPool, if pooled sessions are used
+        self.liveness = None        # LivenessManager running keep-alive against this node
+        self.shared = None          # SharedState counting outstanding requests of all workers
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.ejections = 0          # Consecutive ejections, for the backoff
+        self.ejected_until = 0.0
+        self.latency = None         # Moving average of the time to response headers
+
+    def is_down(self):
+        return bool(self.liveness and self.liveness.is_down())
+
+    def is_connected(self):
+        """False while none of the pooled connections is up, so a channel would only wait"""
+        return self.pool is None or self.pool.healthy_connections() > 0
+
+    def is_ejected(self, now=None):
+        return (now or time.monotonic()) < self.ejected_until
+
+    def begin(self):
+        self.outstanding += 1
+        self.requests += 1
+        if self.shared:
+            self.shared.add(f"node:{self.name}")
+
+    def end(self):
+        self.outstanding -= 1
+        if self.shared:
+            self.shared.add(f"node:{self.name}", -1)
+
+    def load(self):
+        """Outstanding requests of all workers"""
+        return self.shared.value(f"node:{self.name}") if self.shared else self.outstanding
+
+    def record_success(self, latency):
+        self.consecutive_errors = 0
+        self.ejections = 0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += LATENCY_SMOOTHING * (latency - self.latency)
+
+    def stats(self):
+        return {
+            'weight': self.weight,
+            'outstanding': self.load(),
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency': round(self.latency, 4) if self.latency is not None else None,
+            'ejected': self.is_ejected(),
+        }
+
+
+def parse_nodes(spec, default_user=None, default_port=22):
+    """Parses "[user@]host[:port][=weight], ..." into LoginNodes"""
+    nodes = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        weight = 1.0
+        if '=' in entry:
+            entry, weight = entry.rsplit('=', 1)
+            weight = float(weight)
+            if weight <= 0:
+                raise ValueError(f"Weight of {entry} must be positive")
+        user = default_user
+        if '@' in entry:
+            user, entry = entry.split('@', 1)
+        port = default_port
+        if ':' in entry:
+            entry, port = entry.rsplit(':', 1)
+            port = int(port)
+        nodes.append(LoginNode(entry, port, user, weight))
+    if not nodes:
+        raise ValueError("No login nodes configured")
+    return nodes
+
+
+class NodeRouter:
+    """Chooses login nodes by least outstanding requests per weight and ejects failing ones.
+
+    After failure_threshold consecutive failures a node is ejected for
+    base_ejection seconds, doubling with every consecutive ejection up to
+    max_ejection. A successful request resets both counters.
+    """
+
+    def __init__(self, nodes, failure_threshold=3, base_ejection=10, max_ejection=300, observer=None):
+        self.nodes = list(nodes)
+        self.failure_threshold = failure_threshold
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.observer = observer    # Called with the node on every ejection
+
+    def pick(self, exclude=()):
+        """Returns the node for the next request, or None if every node is down"""
+        now = time.monotonic()
+        candidates = [n for n in self.nodes if n not in exclude and not n.is_down()]
+        healthy = [n for n in candidates if n.is_connected() and not n.is_ejected(now)]
+        # If every reachable node is ejected or reconnecting, trying one still beats refusing the request
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        return min(candidates, key=lambda n: ((n.load() + 1) / n.weight, n.latency or 0, random.random()))
+
+    def record_failure(self, node, reason):
+        node.errors += 1
+        node.consecutive_errors += 1
+        if node.consecutive_errors < self.failure_threshold or node.is_ejected():
+            return
+        duration = min(self.max_ejection, self.base_ejection * 2 ** node.ejections)
+        node.ejections += 1
+        node.consecutive_errors = 0
+        node.ejected_until = time.monotonic() + duration
+        logging.warning(f"Ejecting login node {node.name} for {duration} s: {reason}")
+        if self.observer:
+            self.observer(node)
+
+    def all_down(self):
+        return all(n.is_down() for n in self.nodes)
+
+    def retry_after(self):
+        return max(n.liveness.retry_after() if n.liveness else 1 for n in self.nodes)
+
+    def health(self):
+        """Overall status and per-node state for /health"""
+        nodes = {}
+        for node in self.nodes:
+            state = node.liveness.state() if node.liveness else {'status': 'unknown'}
+            nodes[node.name] = {**state, **node.stats()}
+        statuses = {state['status'] for state in nodes.values()}
+        if statuses == {'down'}:
+            status = 'down'
+        elif 'up' in statuses:
+            status = 'up'
+        else:
+            status = 'unknown'
+        return {'status': status, 'nodes': nodes}
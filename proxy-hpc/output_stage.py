@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+import asyncio
+import contextlib
+import logging
+import time
+
+############################################################################
+## Output stage for streamed responses                                    ##
+############################################################################
+## Sits between a response body iterator and the ASGI send loop. A pump   ##
+## task reads the body into a bounded buffer while the client receives    ##
+## batches of it: data is written at once if the stream was idle for      ##
+## max_delay, and otherwise held until max_delay after the last write or  ##
+## until max_bytes are pending. Sparse streams thus get no extra latency  ##
+## and dense ones at most max_delay, with far fewer writes. If a client   ##
+## does not keep up and the buffer reaches buffer_limit, the pump stops   ##
+## reading: with the "wait" policy until the client catches up, with      ##
+## "drop" for at most stall_timeout seconds before the upstream response  ##
+## is closed, so a stalled client cannot hold a backend slot forever.     ##
+## Identical copies live in proxy-hpc and proxy-azure.                    ##
+############################################################################
+
+MAX_DELAY = 0.015                   # Seconds data may be held back to batch it with what follows
+MAX_BYTES = 16 * 1024               # Pending bytes that are written without waiting for more
+BUFFER_LIMIT = 1024 * 1024          # Pending bytes at which reading from upstream pauses
+STALL_TIMEOUT = 60                  # Seconds a full buffer is tolerated under the "drop" policy
+WAIT, DROP = "wait", "drop"
+
+
+class StreamStats:
+    """Counters of one stream, handed to the observer when it ends"""
+    __slots__ = ('chunks', 'writes', 'bytes', 'stalls', 'stall_time', 'dropped')
+
+    def __init__(self):
+        self.chunks = 0             # Chunks read from upstream
+        self.writes = 0             # Batches handed to the ASGI server
+        self.bytes = 0
+        self.stalls = 0             # Times the buffer filled up because the client did not keep up
+        self.stall_time = 0.0
+        self.dropped = False        # Upstream closed under the "drop" policy
+
+
+class OutputStage:
+    """Async iterator batching the chunks of body for the client, see above"""
+
+    def __init__(self, body, max_delay=MAX_DELAY, max_bytes=MAX_BYTES, buffer_limit=BUFFER_LIMIT,
+                 policy=WAIT, stall_timeout=STALL_TIMEOUT, observer=None):
+        self.body = body
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.buffer_limit = buffer_limit
+        self.policy = policy
+        self.stall_timeout = stall_timeout
+        self.observer = observer    # Called with the StreamStats when the stream ends
+        self.stats = StreamStats()
+        self._pending = []
+        self._size = 0
+        self._done = False
+        self._error = None
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+
+    async def __aiter__(self):
+        pump = asyncio.create_task(self._pump())
+        timer = None
+        last_write = 0.0
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if not self._pending and not self._done:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                if not self._pending:
+                    break
+                hold_until = last_write + self.max_delay
+                if self._size < self.max_bytes and not self._done and loop.time() < hold_until:
+                    # Written recently: give the next chunks a moment to join this batch
+                    self._wakeup.clear()
+                    timer = loop.call_at(hold_until, self._wakeup.set)
+                    await self._wakeup.wait()
+                    timer.cancel()
+                pending = self._pending
+                chunk = pending[0] if len(pending) == 1 else b''.join(pending)
+                self._pending = []
+                self._size = 0
+                self._drained.set()
+                self.stats.writes += 1
+                self.stats.bytes += len(chunk)
+                yield chunk
+                last_write = loop.time()
+            if self._error is not None:
+                raise self._error
+        finally:
+            if timer:
+                timer.cancel()
+            if not pump.done():
+                pump.cancel()       # The client is gone; cancelling the read closes the upstream response
+            with contextlib.suppress(asyncio.CancelledError):
+                await pump          # Let the upstream close finish before the response ends
+            if self.observer:
+                self.observer(self.stats)
+
+    async def _pump(self):
+        stats = self.stats
+        body = self.body
+        try:
+            async for chunk in body:
+                if not chunk:
+                    continue
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                self._pending.append(chunk)
+                self._size += len(chunk)
+                stats.chunks += 1
+                if len(self._pending) == 1 or self._size >= self.max_bytes:
+                    self._wakeup.set()
+                if self._size >= self.buffer_limit and not await self._wait_for_client():
+                    break
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._wakeup.set()
+            if stats.dropped and hasattr(body, 'aclose'):
+                await body.aclose()
+
+    async def _wait_for_client(self):
+        """Pauses reading until the buffer was written; returns False if the stream is dropped instead"""
+        stats = self.stats
+        stats.stalls += 1
+        started = time.monotonic()
+        self._drained.clear()
+        try:
+            if self.policy == DROP:
+                await asyncio.wait_for(self._drained.wait(), self.stall_timeout)
+            else:
+                await self._drained.wait()
+        except asyncio.TimeoutError:
+            stats.dropped = True
+            logging.warning(f"Client did not read {self._size} buffered bytes for {self.stall_timeout} s, "
+                            f"closing the upstream response")
+            return False
+        finally:
+            stats.stall_time += time.monotonic() - started
+        return True
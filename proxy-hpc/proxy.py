@@ -1,26 +1,32 @@
 #!/usr/bin/env python3
 import os
-import sys
 import random
 import time
-import subprocess
-import threading
-import queue
-import time
 import signal
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from starlette.requests import Request
-from fastapi.responses import JSONResponse, StreamingResponse, Response, HTMLResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 import asyncio
-from threading import Thread, Event
 import logging
-from uuid import uuid4
-from threading import Lock
 import datetime
-import select
 import json
 import uvicorn
 import uuid
+import weakref
+import functools
+from ssh_pool import SSHConnectionPool, SSHUnavailableError
+from accounting import UsageExtractor
+from request_body import preprocess_body, read_body, requested_max_tokens, StreamedBody
+from ledger import MonthlyFileHandler, UsageLedger
+import metrics
+from liveness import LivenessManager
+from nodes import NodeRouter, parse_nodes
+from admission import AdmissionController, AdmissionRejected
+from response_head import HeaderParser, HeaderError, read_head
+from response_cache import ResponseCache, ResponseRecorder, cache_key, cache_directives, HIT, MISS, BYPASS
+from coalescing import FlightTable
+from output_stage import OutputStage
+from shared_state import SharedState, default_directory, reset_directory
 
 ############################################################################
 ## To run this app manually, execute the following command:               ##
@@ -29,25 +35,62 @@ import uuid
 
 ## Configuration
 ROUTINE_INTERVAL = 5                # Period in seconds of sending check_routine command
+KEEP_ALIVE_TIMEOUT = 10             # Keep-alive probes taking longer than this count as failed
+KEEP_ALIVE_FAILURES = 3             # Consecutive failed probes after which a login node is skipped, or requests fail fast with 503 if all are down
+HPC_HOSTS = os.environ.get("HPC_HOSTS") or f"{os.environ.get('HPC_HOST')}:{os.environ.get('HPC_PORT', 22)}"  # "[user@]host[:port][=weight],..." of the login nodes
+NODE_FAILURES = 3                   # Consecutive failed requests after which a login node is ejected
+NODE_EJECTION_TIME = 10             # Seconds of the first ejection, doubled on each consecutive one up to 5 minutes
+SHARED_STATE_DIR = os.environ.get("SHARED_STATE_DIR") or default_directory("proxy-hpc")  # Counters, locks and keep-alive state shared by the workers of this host
 INLINE_DATA_LIMIT = 1024            # Maximum data size for which proxy will not use stdin
 MAX_SSH_CONNECTIONS = 16
+use_ssh_pool = True                 # If True, uses persistent in-process SSH sessions instead of forking ssh per request
+SSH_POOL_SIZE = int(os.environ.get("SSH_POOL_SIZE", 4))         # Persistent SSH connections per worker
+SSH_MAX_CHANNELS = int(os.environ.get("SSH_MAX_CHANNELS", 8))   # Concurrent channels per connection, keep below sshd MaxSessions
 ssh_key_name = os.environ.get('KEY_NAME')
 ssh_key_path = "/run/secrets/" + ssh_key_name # Path to SSH config file
 parse_headers = True                # If True, assumes curl writes headers and returns them exactly
+HEADER_TIMEOUT = int(os.environ.get("HEADER_TIMEOUT", 300))  # Seconds to wait for the response headers of the service
+STREAM_FLUSH_MS = float(os.environ.get("STREAM_FLUSH_MS", 15))        # Streamed responses are written at most this often, batching what arrives meanwhile
+STREAM_BUFFER = int(os.environ.get("STREAM_BUFFER_KB", 1024)) * 1024  # Bytes buffered per response before reading from upstream pauses
+slow_client_policy = os.environ.get("SLOW_CLIENT_POLICY", "wait")     # "wait" for slow clients, or "drop" their upstream response after SLOW_CLIENT_TIMEOUT
+SLOW_CLIENT_TIMEOUT = int(os.environ.get("SLOW_CLIENT_TIMEOUT", 60))  # Seconds a full buffer is tolerated under the "drop" policy
+send_cancel = os.environ.get("CANCEL_ON_DISCONNECT", "0") == "1"     # If True, tells the login node to stop inferences whose client disconnected; needs "cancel" support in cloud_interface.sh
+CANCEL_TIMEOUT = 10                 # Seconds to wait for the cancel command to finish
+MAX_HEADER_SIZE = 64 * 1024         # Larger response heads are rejected with 502
 use_stdio = False                   # If True, sends all inputs through stdin. Required for large inputs e.g. files.
+stream_uploads = os.environ.get("STREAM_UPLOADS", "1") == "1"          # If True, large bodies are forwarded while they are received
+STREAM_UPLOAD_THRESHOLD = 256 * 1024                                   # Bodies above this size are streamed; the model must be in this prefix to avoid spooling
 enable_accounting = True            # If True, injects include_usage and counts tokens
 extract_model = True                # If True, extracts model name from JSON body
+enable_cache = os.environ.get("RESPONSE_CACHE", "0") == "1"             # If True, caches GET and temperature 0 responses
+CACHE_BUDGET = int(os.environ.get("RESPONSE_CACHE_MB", 64)) * 1024 * 1024  # Memory budget of the cache per worker
+CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", 300))              # Seconds a cached response stays valid
+enable_coalescing = os.environ.get("COALESCE_REQUESTS", "0") == "1"     # If True, identical in-flight GET and temperature 0 requests share one SSH call, across users
+COALESCE_BUFFER = 1024 * 1024       # Response bytes kept for requests joining a call that already started
 
 ## Log configuration
 file_log   = True                   # If True, log is written to file
-current_month = datetime.datetime.now().strftime("%Y-%m") # Get the current month and year
-log_path = f"/root/log/proxy-{current_month}.log"         # If file_log = True, write log to this file
+log_dir = "/root/log"               # If file_log = True, write log to proxy-YYYY-MM.log in this directory
 log_format = logging.Formatter('%(asctime)s.%(msecs)03d %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
 syslog_format = logging.Formatter('mediator: %(asctime)s.%(msecs)03d %(levelname)s - %(message)s', "%Y-%m-%d %H:%M:%S")
 log_level = logging.INFO
+ledger_dir = "/root/log"            # Inference records are written to usage-YYYY-MM.jsonl in this directory
+ledger_policy = os.environ.get("LEDGER_POLICY", "block")  # "block" or "drop" when the record queue is full
+legacy_inference_log = os.environ.get("LEGACY_INFERENCE_LOG", "1") == "1"  # If True, records also go to the log as "Inference Request/Response:" lines
 
 ## Reserved variables
 app = FastAPI(debug=False)
+app.add_middleware(metrics.MetricsMiddleware)
+shared = SharedState(SHARED_STATE_DIR)
+router = NodeRouter(parse_nodes(HPC_HOSTS, os.environ.get("HPC_USER")), failure_threshold=NODE_FAILURES,
+                    base_ejection=NODE_EJECTION_TIME, observer=metrics.observe_ejection)
+admission = AdmissionController.from_file(shared, os.environ.get("ADMISSION_CONFIG", "admission.json"))
+ledger = UsageLedger(ledger_dir, policy=ledger_policy, legacy_log=legacy_inference_log,
+                     observer=metrics.observe_ledger_drop)
+response_cache = ResponseCache(CACHE_BUDGET, ttl=CACHE_TTL) if enable_cache else None
+flights = FlightTable(COALESCE_BUFFER)
+background_tasks = set()            # Fire-and-forget tasks, referenced until they finish
+startup_complete = False            # Set at the end of the startup event
 
 ############################################################################
 ## Startup                                                                ##
@@ -65,14 +108,41 @@ async def startup_event():
     """Initialize the model when the server starts."""
     handlers = []
     if file_log:
-        f_handler = logging.FileHandler(log_path)
+        f_handler = MonthlyFileHandler(log_dir)
         f_handler.setFormatter(log_format)
         handlers.append(f_handler)
     ## Initialize logging
     logging.basicConfig(handlers = handlers, level=log_level)
     logging.info("Starting up...")
-    keep_alive_thread = KeepAliveThread()
-    keep_alive_thread.start()
+    await ledger.start()
+    shared.open()
+    for i, node in enumerate(router.nodes):
+        node.shared = shared
+        if use_ssh_pool:
+            node.pool = SSHConnectionPool(
+                host=node.host,
+                user=node.user,
+                key_path=ssh_key_path,
+                port=node.port,
+                size=SSH_POOL_SIZE,
+                max_channels=SSH_MAX_CHANNELS,
+                connect_observer=metrics.SSH_CONNECT.observe,
+            )
+            await node.pool.start()
+        # Pooled sessions belong to this event loop, so keep-alive runs here as well
+        node.liveness = LivenessManager(
+            functools.partial(keep_alive, node),
+            state_path=os.path.join(SHARED_STATE_DIR, f"liveness-{i}.json"),
+            leadership=shared.leadership(f"keep-alive-{i}"),
+            interval=ROUTINE_INTERVAL,
+            timeout=KEEP_ALIVE_TIMEOUT,
+            failure_threshold=KEEP_ALIVE_FAILURES,
+            observer=functools.partial(metrics.observe_keep_alive, node.name),
+            name=f"HPC login node {node.name}",
+        )
+        await node.liveness.start()
+    global startup_complete
+    startup_complete = True
     logging.info("Startup complete.")
 
 
@@ -85,144 +155,135 @@ def shutdown():
     logging.info("Shutting down...")
     os.kill(os.getppid(), signal.SIGTERM)
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop background tasks and close pooled SSH connections"""
+    for node in router.nodes:
+        if node.liveness:
+            await node.liveness.close()
+        if node.pool:
+            await node.pool.close()
+    await ledger.close()
+    shared.close()
+    metrics.mark_worker_dead()
+
 ############################################################################
 ## Interacting with the HPC cluster                                       ##
 ############################################################################
 
-keep_alive_event = asyncio.Event()
-keep_alive_event.set()
-
-async def keep_alive():
-    while True:
-        try:
-            proc = await run_ssh_command("keep-alive")
-            await proc.wait()
-            await asyncio.sleep(ROUTINE_INTERVAL)
-        except Exception as e:
-            logging.error(f"Keep-alive failed: {str(e)}")
-            await asyncio.sleep(5)
-
-class KeepAliveThread(Thread):
-    def __init__(self):
-        super().__init__()
-        self._stop_event = threading.Event()
-
-    def stop(self):
-        self._stop_event.set()
-
-    def stopped(self):
-        return self._stop_event.is_set()
-
-    def run(self):
-        loop = asyncio.new_event_loop()  # New event loop for this thread
-        asyncio.set_event_loop(loop)
-        try:
-            # while keep_alive_event.is_set():
-            while not self._stop_event.is_set():
-                logging.info("Starting keep-alive loop")
-                loop.run_until_complete(keep_alive())  # Run keep_alive in this thread's event loop
-        except asyncio.TimeoutError:
-            logging.error("Timeout 3 occurred while waiting for keep-alive command to complete")
-        except Exception as e:
-            logging.error(f"Exception: {e}")
-        finally:
-            loop.close()
-
-def parse_headers_curl(channel: bytes) -> tuple:
-    """Reads headers, HTTP version and status code from channel response body is reached"""
-    # Initialize variables
-    headers = {}
-    http_version, status_code, reason_phrase = (None, 500, "Bad response from cloud interface")
-    headers_part = channel  # Treat channel as the entire response bytes
-    reached_body = False
-    chunk = b''
-
-    # Check if headers are present
-    if b'\r\n\r\n' in headers_part:
-        # Split headers and body
-        status_line_and_headers, chunk = headers_part.split(b'\r\n\r\n', 1)
-        status_line_and_headers = status_line_and_headers.decode().split('\r\n')
-        status_line = status_line_and_headers.pop(0)
-        
-        # Parse status line
-        try:
-            http_version, status_code, reason_phrase = status_line.split(' ', 2)
-            status_code = int(status_code)
-            if status_code == 100:  # 100 Continue
-                # Reset headers and continue reading
-                headers = {}
-                return parse_headers_curl(chunk)
-
-        except ValueError:
-            # Handle malformed status line
-            pass
-
-        # Parse headers
-        for pair in status_line_and_headers:
-            if not pair:
-                continue
-            try:
-                name, value = pair.split(': ', 1)
-                if name.lower() != 'content-length':
-                    headers[name] = value
-            except ValueError:
-                # Handle malformed header
-                pass
-
-        reached_body = True
-
-    logging.debug("Finished parse headers successfully")
-    return http_version, status_code, reason_phrase, headers, chunk
-
+async def keep_alive(node):
+    """Keep-alive probe; returns True if the login node ran the routine successfully"""
+    if node.pool and node.pool.healthy_connections() == 0:
+        return False    # Every pooled connection is down, no need to wait for a channel
+    proc = await run_ssh_command("keep-alive", node=node, control=True)
+    try:
+        await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    return proc.returncode == 0
 
 ############################################################################
-## Accounting                                                             ##
+## Passthrough                                                            ##
 ############################################################################
 
-import json
+async def run_ssh_command(remote_command, data=None, node=None, control=False):
+    """Runs remote_command on a login node and returns a process-like handle.
+
+    Control commands (keep-alive, cancel) may use the pool's reserved channels.
+    """
+    node = node or router.nodes[0]
+    started = time.monotonic()
+    if node.pool:
+        proc = await node.pool.run(remote_command, data, control)
+    else:
+        proc = await run_ssh_subprocess(remote_command, data, node)
+    metrics.SSH_SPAWN.observe(time.monotonic() - started)
+    return proc
 
-def extract_tokens(response):
-    input_tokens = 0
-    output_tokens = 0
+async def upload_body(proc, body):
+    """Copies a streamed request body to the remote stdin at the pace the channel accepts it"""
     try:
-        response = response.decode()
+        async for chunk in body:
+            proc.stdin.write(chunk)
+            await proc.stdin.drain()
+        proc.stdin.write_eof()
     except Exception as e:
-        logging.error("Failed to decode response")
-        return input_tokens, output_tokens
-
-    # Split the response into individual SSE events
-    events = response.split('\n\n')
-    found_usage = False
-    # Iterate over the events in reverse order to find the last valid JSON occurrence
-    for event in reversed(events):
+        logging.warning(f"Request body upload failed: {str(e)}")
+        proc.kill()
+    finally:
+        await body.aclose()
+
+def spawn(coroutine):
+    """Runs a coroutine in the background without letting it be garbage collected"""
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def watch_disconnect(receive, callback):
+    """Calls callback as soon as the client disconnects, even while no response bytes flow"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            callback()
+            return
+
+async def cancel_inference(node, inference, usage, data):
+    """Asks the login node to stop an inference whose client disconnected, and records it as cancelled.
+
+    node is None if the client left before the remote command was started.
+    """
+    cancelled = node is None
+    if node and send_cancel:
         try:
-            # Check if the event starts with "data: "
-            if event.startswith('data: '):
-                # Remove the "data: " prefix and parse the JSON payload
-                payload = json.loads(event[6:])  # skip the 'data: ' prefix
-            else:
-                # Parse the JSON payload directly
-                payload = json.loads(event)
-
-            if 'usage' in payload:
-                found_usage = True
-                usage = payload['usage']
-                input_tokens = usage.get('prompt_tokens', 0)
-                output_tokens = usage.get('completion_tokens', 0)
-                total_tokens = usage.get('total_tokens', 0)
-                break
-        except json.JSONDecodeError:
-            pass
-    if not found_usage:
-        logging.error("No usage data found.")
-    return input_tokens, output_tokens
-
-
-############################################################################
-## Passthrough                                                            ##
-############################################################################
+            proc = await asyncio.wait_for(run_ssh_command(f"cancel {inference['id']}", node=node, control=True), CANCEL_TIMEOUT)
+            await asyncio.wait_for(proc.wait(), CANCEL_TIMEOUT)
+            cancelled = proc.returncode == 0
+        except Exception as e:
+            logging.warning(f"Failed to cancel inference {inference['id']} on {node.name}: {str(e) or type(e).__name__}")
+    generated = usage.events
+    max_tokens = requested_max_tokens(data)
+    saved = max(0, max_tokens - generated) if cancelled and max_tokens is not None else None
+    if node is None:
+        logging.info(f"Client disconnected from inference {inference['id']} before it was started")
+    elif not cancelled:
+        logging.info(f"Client disconnected from inference {inference['id']} after about {generated} output tokens, "
+                     f"not cancelled on {node.name}")
+    elif saved is None:
+        logging.info(f"Client disconnected from inference {inference['id']} after about {generated} output tokens, "
+                     f"cancelled on {node.name}, saved tokens unknown without max_tokens")
+    else:
+        logging.info(f"Client disconnected from inference {inference['id']} after about {generated} output tokens, "
+                     f"cancelled on {node.name}, up to {saved} output tokens saved")
+    inference['end_timestamp'] = datetime.datetime.now().isoformat()
+    inference['status'] = 'CANCELLED'
+    inference['output_size'] = usage.output_size
+    if isinstance(data, StreamedBody):
+        inference['input_size'] = data.sent
+    input_tokens, output_tokens = usage.tokens() if usage.usage else (0, 0)
+    inference['input_tokens'] = input_tokens
+    inference['output_tokens'] = output_tokens
+    inference['generated_tokens'] = generated
+    inference['saved_tokens'] = saved
+    await ledger.record("response", inference)
+    metrics.observe_inference(inference)
+    metrics.observe_disconnect(inference, cancelled)
+
+def output_stage(body):
+    """Wraps a streamed response body in the batching output stage with a bounded buffer"""
+    return OutputStage(body, max_delay=STREAM_FLUSH_MS / 1000, buffer_limit=STREAM_BUFFER, policy=slow_client_policy,
+                       stall_timeout=SLOW_CLIENT_TIMEOUT, observer=metrics.observe_stream)
+
+async def drain_stderr(proc):
+    """Consumes stderr of a forked ssh client so it never blocks on a full pipe"""
+    while True:
+        chunk = await proc.stderr.read(4096)
+        if not chunk:
+            break
+        logging.debug(f"SSH stderr: {chunk.decode(errors='replace').rstrip()}")
 
-async def run_ssh_command(remote_command, data=None):
+async def run_ssh_subprocess(remote_command, data=None, node=None):
     # SSH command to execute
     ssh_cmd = [
         'ssh',
@@ -232,8 +293,9 @@ async def run_ssh_command(remote_command, data=None):
         '-o', 'ControlMaster=auto',
         '-o', f'ControlPath=/tmp/ssh-{random.randint(0, MAX_SSH_CONNECTIONS)}-%r@%h:%p',
         '-o', 'ControlPersist=4h',
-        '-i', '/run/secrets/kisski-ssh-key',
-        os.environ.get("HPC_USER") + '@' + os.environ.get("HPC_HOST"),
+        '-i', ssh_key_path,
+        '-p', str(node.port),
+        node.user + '@' + node.host,
         remote_command
     ]
     
@@ -244,6 +306,7 @@ async def run_ssh_command(remote_command, data=None):
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE
     )
+    spawn(drain_stderr(proc))
     
     if data:
         proc.stdin.write(data)
@@ -252,6 +315,24 @@ async def run_ssh_command(remote_command, data=None):
 
     return proc
 
+@app.get("/metrics")
+async def get_metrics() -> Response:
+    """Prometheus metrics aggregated over all workers"""
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
+@app.get("/health")
+async def get_health() -> Response:
+    """Health of the HPC login nodes as seen by their keep-alive routines, and host-wide admission state"""
+    state = {**router.health(), 'services': admission.stats()}
+    return JSONResponse(state, status_code=503 if state['status'] == 'down' else 200)
+
+@app.get("/ready")
+async def get_ready() -> Response:
+    """Readiness: 200 once startup is done and a login node has a connection to take requests"""
+    ready = startup_complete and any(node.is_connected() and not node.is_down() for node in router.nodes)
+    return JSONResponse({'ready': ready}, status_code=200 if ready else 503)
+
 @app.options("/passthrough/{path:path}", status_code=200)
 @app.post("/passthrough/{path:path}", status_code=200)
 @app.get("/passthrough/{path:path}", status_code=200)
@@ -262,7 +343,10 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
     method = str(request.method)
     headers = request.headers
     try:
-        data = await request.body()
+        if stream_uploads:
+            data = await read_body(request.stream(), headers.get('content-length'), STREAM_UPLOAD_THRESHOLD)
+        else:
+            data = await request.body()
     except:
         data = None
     if request.query_params:
@@ -274,14 +358,11 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
     ## Softly force include usage
     if enable_accounting or extract_model:
         try:
-            data_json = json.loads(data)
-            ## Inject include usage if streaming
-            if enable_accounting and "stream" in data_json and data_json["stream"]:
-                data_json["stream_options"] = {"include_usage": True}
-                data = json.dumps(data_json).encode()
-            if extract_model and not service:
-                if "model" in data_json:
-                    service = data_json["model"]
+            ## Inject include usage if streaming, without re-serializing the body
+            data, model, stream = await preprocess_body(data, inject_usage=enable_accounting,
+                                                        need_model=extract_model and not service)
+            if extract_model and not service and model:
+                service = model
         except json.JSONDecodeError as e:
             logging.warning("Failed to parse JSON data - Accounting not available")
             proceed_accounting = False
@@ -293,7 +374,8 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
 
     if not service:
         raise HTTPException(status_code=400, detail="Service or model not specified")
-    
+    metrics.start_request(request, service)
+
     user_o = None
     user_ou = None
 
@@ -305,19 +387,193 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
                 user_o = group[4:]
             elif group.startswith('orgunit_'):
                 user_ou = group[8:]
-
+    uid = headers.get('X-Consumer-Custom-ID', 'anon')
+
+    ## Serve repeatable requests from the cache, even while the HPC service is down
+    request_key = None
+    if (response_cache or enable_coalescing) and not isinstance(data, StreamedBody):
+        request_key = cache_key(service, method, path, data)
+    read, write = cache_directives(headers)
+    key = None
+    cache_status = None
+    if response_cache and request_key:
+        entry = response_cache.get(request_key) if read else None
+        if entry:
+            return await serve_cached(entry, headers, data, service, uid, user_o, user_ou)
+        cache_status = MISS if read else BYPASS
+        if write:
+            key = request_key
+
+    ## Join an identical request that is already in flight instead of starting another SSH call
+    flight_key = None
+    if enable_coalescing and request_key and read:
+        flight_key = request_key
+        flight = flights.get(flight_key)
+        if flight:
+            return await serve_flight(flight, headers, data, service, uid, user_o, user_ou, request.receive)
+
+    ## Fail fast instead of waiting for a dead ssh connection
+    if router.all_down():
+        raise HTTPException(503, "HPC service temporarily unreachable",
+                            headers={"Retry-After": str(router.retry_after())})
+
+    ## Wait for a slot of this service, in fair order across consumers
+    try:
+        permit = await admission.acquire(service, uid, user_o, user_ou)
+    except AdmissionRejected as e:
+        raise HTTPException(429, e.reason, headers={"Retry-After": str(e.retry_after)})
+    if flight_key:
+        ## An identical request may have started while this one was queued
+        flight = flights.get(flight_key)
+        if flight:
+            permit.release()
+            return await serve_flight(flight, headers, data, service, uid, user_o, user_ou, request.receive)
+        flight = flights.open(flight_key)
+        forward = functools.partial(forward_request, path, method, headers, data, service, uid, user_o, user_ou,
+                                    proceed_accounting, permit, key, cache_status, flight=flight)
+        flight.lead(spawn(lead_flight(flight, permit, forward)))
+        return await serve_flight(flight, headers, data, service, uid, user_o, user_ou, request.receive, leader=True)
+    try:
+        return await forward_request(path, method, headers, data, service, uid, user_o, user_ou,
+                                     proceed_accounting, permit, key, cache_status, receive=request.receive)
+    except BaseException:
+        permit.release()
+        raise
+
+async def serve_cached(entry, headers, data, service, uid, user_o, user_ou):
+    """Replays a cached response, recording it like an inference with the tokens of the original"""
+    now = datetime.datetime.now().isoformat()
     inference = {
         'id': headers.get('inference-id', str(uuid.uuid4())),
-        'uid': headers.get('X-Consumer-Custom-ID', 'anon'),
+        'uid': uid,
         'o': user_o,
         'ou': user_ou,
         'service': service,
         'input_size': len(data) if data else 0,
+        'start_timestamp': now,
+        'portal': headers.get('inference-portal', 'SAIA'),
+        'status': "PENDING",
+        'cache': HIT,
+    }
+    await ledger.record("request", inference)
+    inference['end_timestamp'] = now
+    inference['status'] = 'COMPLETED'
+    inference['output_size'] = len(entry.body)
+    inference['input_tokens'] = entry.input_tokens
+    inference['output_tokens'] = entry.output_tokens
+    await ledger.record("response", inference)
+    metrics.observe_inference(inference)
+    headers = {**entry.headers, 'X-Cache': 'HIT'}
+    if entry.streamed:
+        # Streamed answers stay streams, with the events and media type of the original
+        async def replay():
+            for event in entry.events():
+                yield event
+        return StreamingResponse(replay(), status_code=entry.status_code, headers=headers)
+    return Response(entry.body, status_code=entry.status_code, headers=headers)
+
+async def lead_flight(flight, permit, forward):
+    """Runs the upstream call of a flight, independently of the client that started it"""
+    try:
+        await forward()
+    except HTTPException as e:
+        permit.release()
+        flight.fail(e)
+    except BaseException as e:
+        permit.release()
+        flight.fail(HTTPException(502, "Bad gateway"))
+        if isinstance(e, asyncio.CancelledError):
+            raise
+        logging.error(f"Coalesced request failed: {str(e)}")
+
+async def serve_flight(flight, headers, data, service, uid, user_o, user_ou, receive, leader=False):
+    """Streams the response of a flight; requests other than the leader are recorded as coalesced.
+
+    The upstream call does not watch any client itself: a client that disconnects
+    leaves the flight, and the call is cancelled on the login node once all have left.
+    """
+    token = flight.join()
+    inference = None
+    if not leader:
+        inference = {
+            'id': headers.get('inference-id', str(uuid.uuid4())),
+            'uid': uid,
+            'o': user_o,
+            'ou': user_ou,
+            'service': service,
+            'input_size': len(data) if data else 0,
+            'start_timestamp': datetime.datetime.now().isoformat(),
+            'portal': headers.get('inference-portal', 'SAIA'),
+            'status': "PENDING",
+            'coalesced': True,
+        }
+        await ledger.record("request", inference)
+        metrics.COALESCED.labels(metrics.service_label(service)).inc()
+    watcher = asyncio.create_task(watch_disconnect(receive, functools.partial(flight.leave, token)))
+    try:
+        await flight.head()
+    except HTTPException as e:
+        flight.leave(token)
+        raise HTTPException(e.status_code, e.detail, headers=e.headers)
+    except BaseException:
+        flight.leave(token)
+        raise
+    finally:
+        watcher.cancel()
+
+    async def stream_generator():
+        output_size = 0
+        try:
+            async for chunk in flight.stream(token):
+                yield chunk
+                output_size += len(chunk)
+        finally:
+            flight.leave(token)
+        if inference is None or not flight.complete:
+            return
+        original = flight.inference
+        inference['end_timestamp'] = datetime.datetime.now().isoformat()
+        inference['status'] = 'COMPLETED'
+        inference['output_size'] = output_size
+        inference['input_tokens'] = original.get('input_tokens', 0)
+        inference['output_tokens'] = original.get('output_tokens', 0)
+        inference['leader'] = original['id']
+        await ledger.record("response", inference)
+        metrics.observe_inference(inference)
+
+    generator = stream_generator()
+    weakref.finalize(generator, flight.leave, token)    # In case the response is dropped before streaming starts
+    return StreamingResponse(output_stage(generator), headers=flight.headers, status_code=flight.status_code)
+
+async def forward_request(path, method, headers, data, service, uid, user_o, user_ou, proceed_accounting, permit,
+                          key=None, cache_status=None, flight=None, receive=None):
+    """Runs an admitted request on the HPC service node and streams back its response.
+
+    With a flight, the response is handed to it for fan-out instead of being returned.
+    With receive, the ASGI receive channel of the client, the inference is cancelled
+    as soon as the client disconnects.
+    """
+    streamed = isinstance(data, StreamedBody)
+    if streamed:
+        input_size = int(data.content_length) if data.content_length else None
+    else:
+        input_size = len(data) if data else 0
+    inference = {
+        'id': headers.get('inference-id', str(uuid.uuid4())),
+        'uid': uid,
+        'o': user_o,
+        'ou': user_ou,
+        'service': service,
+        'input_size': input_size,
         'start_timestamp': datetime.datetime.now().isoformat(),
         'portal': headers.get('inference-portal', 'SAIA'),
         'status': "PENDING",
+        'queue_depth': permit.queue_depth,
+        'queue_wait': round(permit.queue_wait, 3),
     }
-    logging.info("Inference Request: " + json.dumps(inference))
+    if cache_status:
+        inference['cache'] = cache_status
+    await ledger.record("request", inference)
 
     # Extract important headers
     headers_str = ' '.join(
@@ -328,49 +584,133 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
     
     # Determine if data should be sent inline
     is_parsable = False
-    try:
-        decoded_data = data.decode('utf-8')
-    except:
-        is_parsable = False
+    if not streamed and data and len(data) <= INLINE_DATA_LIMIT:
+        try:
+            decoded_data = data.decode('utf-8')
+        except:
+            is_parsable = False
     
     data_remains = False
-    if data and is_parsable and len(data) <= INLINE_DATA_LIMIT and not use_stdio:
+    if not streamed and data and is_parsable and len(data) <= INLINE_DATA_LIMIT and not use_stdio:
         remote_command = (command + ' -d ').encode() + data
     else:
         remote_command = command.encode()
         data_remains = True
     
-    # Start the async subprocess
-    proc = await run_ssh_command(remote_command, data)
-
-    # Read headers first
-    header_buffer = b''
+    # Stop the inference on the login node as soon as the client is gone
+    usage = UsageExtractor(scan=proceed_accounting)
+    proc = upload = watcher = None
+    abandoned = False
+    finished = False
+    def abandon():
+        """Kills the remote command and cancels the inference, once"""
+        nonlocal abandoned
+        if abandoned or finished:
+            return
+        abandoned = True
+        if proc is None:
+            return  # Not started yet, handled below
+        proc.kill()
+        if upload and not upload.done():
+            upload.cancel()
+        spawn(cancel_inference(node, inference, usage, data))
+    def watch(_=None):
+        nonlocal watcher
+        if receive and not abandoned and not finished:
+            watcher = asyncio.create_task(watch_disconnect(receive, abandon))
+    if not streamed:
+        # A streamed body's receive channel belongs to the upload until the body is through
+        watch()
+
+    # Start the remote command on the least loaded login node, failing over to the others
+    tried = []
     try:
         while True:
-            chunk = await proc.stdout.read(4096)
-            if not chunk:
-                break
-            header_buffer += chunk
-            if b'\r\n\r\n' in header_buffer:
+            if abandoned:
+                spawn(cancel_inference(None, inference, usage, data))
+                raise HTTPException(499, "Client closed request")
+            node = router.pick(exclude=tried)
+            if node is None:
+                raise HTTPException(502, "HPC service unreachable")
+            tried.append(node)
+            node.begin()
+            started = time.monotonic()
+            try:
+                proc = await run_ssh_command(remote_command, None if streamed else data, node)
                 break
-    except asyncio.TimeoutError:
+            except SSHUnavailableError as e:
+                node.end()
+                router.record_failure(node, str(e))
+                logging.error(f"SSH transport to {node.name} unavailable: {str(e)}")
+    except BaseException:
+        finished = True
+        if watcher:
+            watcher.cancel()
+        raise
+    inference['node'] = node.name
+    if abandoned:
+        # The client left while the command was being started
         proc.kill()
-        raise HTTPException(504, "Timeout waiting for headers")
-
-    # Parse headers from the buffer
+        node.end()
+        spawn(cancel_inference(node, inference, usage, data))
+        raise HTTPException(499, "Client closed request")
+    if streamed:
+        upload = asyncio.create_task(upload_body(proc, data))
+        upload.add_done_callback(watch)
+
+    # Read the response head, skipping interim 1xx responses
+    head = HeaderParser(MAX_HEADER_SIZE)
     try:
-        http_version, status_code, reason_phrase, headers, body_chunk = parse_headers_curl(header_buffer)
-    except Exception as e:
+        await asyncio.wait_for(read_head(proc.stdout, head), HEADER_TIMEOUT)
+    except (asyncio.TimeoutError, HeaderError) as e:
+        finished = True
+        if watcher:
+            watcher.cancel()
         proc.kill()
+        if upload:
+            upload.cancel()
+        node.end()
+        router.record_failure(node, str(e) or "Timeout waiting for headers")
+        if isinstance(e, asyncio.TimeoutError):
+            raise HTTPException(504, "Timeout waiting for headers")
         raise HTTPException(502, f"Bad gateway: {str(e)}")
+    except asyncio.CancelledError:
+        abandon()
+        node.end()
+        raise
+    if abandoned:
+        node.end()
+        raise HTTPException(499, "Client closed request")
+    status_code, headers, body_chunk = head.status_code, head.headers, head.body
+    if head.http_version is None:
+        router.record_failure(node, "No response from cloud interface")
+    else:
+        node.record_success(time.monotonic() - started)
+
+    released = False
+    def release():
+        """Frees the admission slot and the node's outstanding count, once"""
+        nonlocal released
+        if not released:
+            released = True
+            permit.release()
+            node.end()
     
+    if key and status_code == 200:
+        recorder = ResponseRecorder(response_cache.max_entry_size)
+    else:
+        recorder = None
+
     async def stream_generator():
+        nonlocal finished
+        complete = False
         try:
             # Yield the initial body chunk from header parsing
-            full_response = b''
             if body_chunk:
                 yield body_chunk
-                full_response += body_chunk
+                usage.feed(body_chunk)
+                if recorder:
+                    recorder.add(body_chunk)
             
             # Stream remaining data
             while True:
@@ -378,38 +718,61 @@ async def get_hpc_response(path: str, request: Request = None) -> Response:
                 if not chunk:
                     break
                 yield chunk
-                full_response += chunk
-            # Collect stderr for logging
-            # stderr = await proc.stderr.read()
-            # if stderr:
-            #    logging.debug(f"SSH stderr: {stderr.decode()}")
-        except asyncio.CancelledError:
+                usage.feed(chunk)
+                if recorder:
+                    recorder.add(chunk)
+            complete = not abandoned
+        except (asyncio.CancelledError, GeneratorExit):
+            # Client gone, or dropped by the output stage for not reading
+            abandon()
             proc.kill()
             await proc.wait()
             raise
         finally:
+            finished = True
+            if watcher:
+                watcher.cancel()
+            release()
+            if upload and not upload.done():
+                upload.cancel()
             if proc.returncode is None:
                 proc.kill()
                 await proc.wait()
+        if abandoned:
+            return  # Recorded by cancel_inference
         inference['end_timestamp'] = datetime.datetime.now().isoformat()
         inference['status'] = 'COMPLETED'
-        inference['output_size'] = len(full_response)
+        inference['output_size'] = usage.output_size
+        if streamed:
+            inference['input_size'] = data.sent
         try:
-            input_tokens, output_tokens = extract_tokens(full_response) if proceed_accounting else (0,0)
+            input_tokens, output_tokens = usage.tokens() if proceed_accounting else (0,0)
             inference['input_tokens'] = input_tokens
             inference['output_tokens'] = output_tokens
         except Exception as e:
             logging.warning("Failed to extract tokens.")
-        logging.info("Inference Response: " + json.dumps(inference))
+        if recorder and complete and not recorder.overflow:
+            response_cache.put(key, status_code, headers, recorder.body(),
+                               inference.get('input_tokens', 0), inference.get('output_tokens', 0))
+        await ledger.record("response", inference)
+        metrics.observe_inference(inference)
         await proc.wait()
     
+    generator = stream_generator()
+    weakref.finalize(generator, release)    # In case the response is dropped before streaming starts
+    if cache_status:
+        headers['X-Cache'] = cache_status.upper()
+    if flight:
+        flight.start(status_code, headers, generator, inference)
+        return None
     return StreamingResponse(
-        stream_generator(),
+        output_stage(generator),
         headers=headers,
         status_code=status_code
     )
 
 if __name__ == '__main__':
+    reset_directory(SHARED_STATE_DIR)
     uvicorn.run(
         "proxy:app",
         workers=int(os.environ.get("WORKERS", 1)),
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+import asyncio
+import json
+import logging
+import mmap
+import tempfile
+
+############################################################################
+## Request preprocessing                                                  ##
+############################################################################
+## Finds "model" and "stream" in an OpenAI-style JSON body and injects    ##
+## stream_options.include_usage without parsing or re-serializing the     ##
+## whole document. The scan jumps from quote to quote with bytes.find, so ##
+## its cost depends on the number of strings, not on their length; large  ##
+## base64 images or long contexts are skipped at memchr speed.            ##
+##                                                                        ##
+## Bodies above a threshold are not buffered at all: only a prefix is     ##
+## kept for the scan, and the rest is forwarded while it is received. If  ##
+## a key needed is not in the prefix, the body is spooled to disk first.  ##
+############################################################################
+
+OFFLOAD_SIZE = 1024 * 1024          # Bodies larger than this are scanned in a worker thread
+STREAM_THRESHOLD = 256 * 1024       # Bodies larger than this are streamed instead of buffered
+SPOOL_CHUNK_SIZE = 256 * 1024       # Read size when forwarding a spooled body
+WHITESPACE = b' \t\r\n'
+INCLUDE_USAGE = b'"stream_options":{"include_usage":true}'
+LITERALS = {b'true': True, b'false': False, b'null': None}
+NUMBER_BYTES = frozenset(b'-+.0123456789eE')
+
+
+class ScanError(ValueError):
+    """The body is not a JSON object the fast scanner understands"""
+
+
+class _Truncated(ScanError):
+    """The data ends inside a string"""
+
+
+def _skip_whitespace(data, pos):
+    n = len(data)
+    while pos < n and data[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _string_end(data, start):
+    """Returns the index of the closing quote of the string opened at start"""
+    pos = start + 1
+    while True:
+        pos = data.find(b'"', pos)
+        if pos < 0:
+            raise _Truncated("Unterminated string")
+        backslashes = 0
+        k = pos - 1
+        while data[k] == 0x5c:  # backslash
+            backslashes += 1
+            k -= 1
+        if backslashes % 2 == 0:
+            return pos
+        pos += 1
+
+
+def _depth_change(gap):
+    return gap.count(b'{') + gap.count(b'[') - gap.count(b'}') - gap.count(b']')
+
+
+def scan_top_level(data, keys, partial=False):
+    """Returns {key: raw value bytes} for the given top-level keys of a JSON object.
+
+    Only string, number and literal values are extracted; other values of
+    a wanted key are reported as None. Raises ScanError if data is not an object.
+    With partial=True, data may be a prefix of the object, and keys whose
+    value is cut off are left out. data may be any bytes-like object with
+    find(), including an mmap.
+    """
+    found = {}
+    try:
+        _scan_top_level(data, keys, partial, found)
+    except _Truncated:
+        if not partial:
+            raise
+    return found
+
+
+def _scan_top_level(data, keys, partial, found):
+    pos = _skip_whitespace(data, 0)
+    if pos >= len(data) or data[pos] != 0x7b:  # {
+        raise ScanError("Body is not a JSON object")
+    depth = 1
+    pos += 1
+    while True:
+        quote = data.find(b'"', pos)
+        if quote < 0:
+            depth += _depth_change(data[pos:])
+            break
+        depth += _depth_change(data[pos:quote])
+        if depth <= 0:
+            raise ScanError("Unbalanced JSON")
+        end = _string_end(data, quote)
+        pos = end + 1
+        if depth != 1:
+            continue
+        colon = _skip_whitespace(data, pos)
+        if colon >= len(data) or data[colon] != 0x3a:  # :
+            continue
+        key = data[quote + 1:end]
+        if key not in keys:
+            continue
+        value_start = _skip_whitespace(data, colon + 1)
+        if value_start < len(data) and data[value_start] == 0x22:  # "
+            value_end = _string_end(data, value_start) + 1
+            found[key] = data[value_start:value_end]
+            pos = value_end
+        elif value_start < len(data) and data[value_start] in NUMBER_BYTES:
+            value_end = value_start + 1
+            while value_end < len(data) and data[value_end] in NUMBER_BYTES:
+                value_end += 1
+            if value_end < len(data) or not partial:
+                found[key] = data[value_start:value_end]
+            pos = value_end
+        else:
+            for literal in LITERALS:
+                if data[value_start:value_start + len(literal)] == literal:
+                    found[key] = literal
+                    pos = value_start + len(literal)
+                    break
+            else:
+                rest = data[value_start:value_start + 5]
+                if partial and len(rest) < 5 and any(literal.startswith(rest) for literal in LITERALS):
+                    break  # The literal is cut off
+                found[key] = None
+    if depth != 0 and not partial:
+        raise ScanError("Unbalanced JSON")
+
+
+def _skip_whitespace_back(data, pos):
+    while pos > 0 and data[pos] in WHITESPACE:
+        pos -= 1
+    return pos
+
+
+def inject_include_usage(data):
+    """Adds stream_options.include_usage before the closing brace of the body"""
+    end = _skip_whitespace_back(data, len(data) - 1)
+    separator = b'' if data[_skip_whitespace_back(data, end - 1)] == 0x7b else b','
+    with memoryview(data) as view:
+        return b''.join((view[:end], separator, INCLUDE_USAGE, view[end:]))
+
+
+def inject_include_usage_front(data):
+    """Adds stream_options.include_usage after the opening brace, for bodies whose end is not known yet"""
+    start = _skip_whitespace(data, 0) + 1
+    with memoryview(data) as view:
+        return b''.join((view[:start], INCLUDE_USAGE, b',', view[start:]))
+
+
+def _fast_preprocess(data, inject_usage):
+    fields = scan_top_level(data, (b'model', b'stream', b'stream_options'))
+    model = fields.get(b'model')
+    if model is not None:
+        if not model.startswith(b'"'):
+            raise ScanError("Unexpected model value")
+        model = json.loads(model)
+    stream = fields.get(b'stream', b'false')
+    if stream not in LITERALS:
+        raise ScanError("Unexpected stream value")
+    stream = LITERALS[stream]
+    if inject_usage and stream:
+        if b'stream_options' in fields:
+            raise ScanError("Body already has stream_options")
+        data = inject_include_usage(data)
+    return data, model, stream
+
+
+def _full_preprocess(data, inject_usage):
+    """Previous behavior: parse and re-serialize the whole document"""
+    data_json = json.loads(data)
+    stream = "stream" in data_json and data_json["stream"]
+    if inject_usage and stream:
+        data_json["stream_options"] = {"include_usage": True}
+        data = json.dumps(data_json).encode()
+    return data, data_json.get("model", None), stream
+
+
+def _preprocess(data, inject_usage):
+    try:
+        return _fast_preprocess(data, inject_usage)
+    except ScanError as e:
+        logging.debug(f"Fast body scan not applicable ({str(e)}), parsing full body")
+    return _full_preprocess(data, inject_usage)
+
+
+class StreamedBody:
+    """A request body too large to buffer, forwarded while it is received.
+
+    head is the part read so far (at least STREAM_THRESHOLD bytes), which
+    the preprocessing scans first; iterating yields head and then the
+    remaining chunks. sent counts the bytes handed out so far.
+    """
+
+    def __init__(self, head, chunks, content_length=None):
+        self.head = head
+        self.content_length = content_length
+        self.sent = 0
+        self._chunks = chunks
+        self._spool = None
+
+    async def __aiter__(self):
+        self.sent += len(self.head)
+        yield self.head
+        async for chunk in self._chunks:
+            self.sent += len(chunk)
+            yield chunk
+
+    async def aclose(self):
+        if hasattr(self._chunks, 'aclose'):
+            await self._chunks.aclose()
+        if self._spool is not None:
+            self._spool.close()
+
+    async def spool(self):
+        """Moves the rest of the body to a temporary file and returns it memory-mapped with head.
+
+        Used when a wanted key is not in the head: the full body can then be
+        scanned without holding it in memory.
+        """
+        spool = tempfile.TemporaryFile()
+        await asyncio.to_thread(spool.write, self.head)
+        pending = []
+        size = 0
+        async for chunk in self._chunks:
+            pending.append(chunk)
+            size += len(chunk)
+            if size >= SPOOL_CHUNK_SIZE:
+                await asyncio.to_thread(spool.writelines, pending)
+                pending, size = [], 0
+        await asyncio.to_thread(spool.writelines, pending)
+        spool.flush()
+        self._spool = spool
+        self._chunks = self._read_spool(len(self.head))
+        return mmap.mmap(spool.fileno(), 0, access=mmap.ACCESS_READ)
+
+    async def _read_spool(self, offset):
+        self._spool.seek(offset)
+        while True:
+            chunk = await asyncio.to_thread(self._spool.read, SPOOL_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+async def read_body(chunks, content_length=None, threshold=STREAM_THRESHOLD):
+    """Reads up to threshold bytes of a request body from an async iterator of chunks.
+
+    Returns the body as bytes if it ends within the threshold, and a
+    StreamedBody with the remaining chunks otherwise.
+    """
+    iterator = chunks.__aiter__()
+    received = []
+    size = 0
+    while size <= threshold:
+        try:
+            chunk = await iterator.__anext__()
+        except StopAsyncIteration:
+            return b''.join(received)
+        received.append(chunk)
+        size += len(chunk)
+    return StreamedBody(b''.join(received), iterator, content_length)
+
+
+def _scan_streamed(data, partial):
+    fields = scan_top_level(data, (b'model', b'stream', b'stream_options'), partial=partial)
+    model = fields.get(b'model')
+    model = json.loads(model) if model and model.startswith(b'"') else None
+    return fields, model
+
+
+async def _preprocess_streamed(body, inject_usage, need_model):
+    fields, model = _scan_streamed(body.head, partial=True)
+    stream = LITERALS.get(fields.get(b'stream')) is True
+    # OpenAI clients put stream after messages, so it is usually not in the head of a large body;
+    # before include_usage is injected, stream_options must not be anywhere in the rest either
+    if (need_model and model is None) or (inject_usage and (b'stream' not in fields or
+                                                            (stream and b'stream_options' not in fields))):
+        logging.debug("Model, stream or stream_options not in the first part of the body, spooling it to disk")
+        with await body.spool() as view:
+            fields, model = await asyncio.to_thread(_scan_streamed, view, False)
+        stream = LITERALS.get(fields.get(b'stream')) is True
+    if inject_usage and stream and b'stream_options' not in fields:
+        body.head = inject_include_usage_front(body.head)
+    return body, model, stream
+
+
+def requested_max_tokens(data):
+    """Returns max_completion_tokens or max_tokens of a request body, or None if unknown.
+
+    Parses the body, so it is meant for rare events such as cancellations,
+    and gives up on bodies larger than OFFLOAD_SIZE.
+    """
+    if isinstance(data, StreamedBody) or not data or len(data) > OFFLOAD_SIZE:
+        return None
+    try:
+        body = json.loads(data)
+    except ValueError:
+        return None
+    if not isinstance(body, dict):
+        return None
+    for key in ('max_completion_tokens', 'max_tokens'):
+        if isinstance(body.get(key), int):
+            return body[key]
+    return None
+
+
+async def preprocess_body(data, inject_usage=True, need_model=True):
+    """Returns (data, model, stream), with include_usage injected into streaming requests.
+
+    data may be bytes or a StreamedBody. Of a StreamedBody only the head is
+    scanned if it holds the keys needed: the model if need_model is set,
+    and the stream flag if inject_usage is. Otherwise the body is spooled
+    to disk and scanned in full before it is forwarded.
+
+    Raises json.JSONDecodeError or another exception if the body cannot be
+    understood, just like json.loads would.
+    """
+    if isinstance(data, StreamedBody):
+        return await _preprocess_streamed(data, inject_usage, need_model)
+    if len(data) > OFFLOAD_SIZE:
+        return await asyncio.to_thread(_preprocess, data, inject_usage)
+    return _preprocess(data, inject_usage)
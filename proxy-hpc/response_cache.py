@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+import collections
+import hashlib
+import time
+
+from request_body import ScanError, scan_top_level
+
+############################################################################
+## Response cache                                                         ##
+############################################################################
+## Opt-in cache for idempotent requests: GETs such as /v1/models, and     ##
+## completions that ask for temperature 0. Keys are a hash of service,    ##
+## method, path and the body as received; the temperature is found with   ##
+## the byte scanner of request_body, so no body is parsed. Entries        ##
+## hold the complete upstream response, so streamed answers are replayed  ##
+## byte for byte as SSE, event by event, together with the usage needed   ##
+## for accounting.                                                        ##
+############################################################################
+
+MAX_BODY_SIZE = 1024 * 1024         # Larger requests are never considered for caching
+ENTRY_OVERHEAD = 512                # Rough per-entry bookkeeping cost, counted against the budget
+
+HOP_BY_HOP = {'connection', 'keep-alive', 'transfer-encoding', 'content-length'}
+
+HIT, MISS, BYPASS = "hit", "miss", "bypass"
+
+
+class CachedResponse:
+    __slots__ = ('status_code', 'headers', 'body', 'input_tokens', 'output_tokens', 'expires', 'size', 'streamed')
+
+    def __init__(self, status_code, headers, body, input_tokens, output_tokens, expires):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.expires = expires
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers.items()) + ENTRY_OVERHEAD
+        self.streamed = any(k.lower() == 'content-type' and v.startswith('text/event-stream')
+                            for k, v in headers.items())
+
+    def events(self):
+        """Yields the body of a streamed response as the SSE events it was sent in"""
+        start = 0
+        while start < len(self.body):
+            end = self.body.find(b'\n\n', start)
+            end = len(self.body) if end < 0 else end + 2
+            yield self.body[start:end]
+            start = end
+
+
+def cache_directives(headers):
+    """Returns (read, write) according to the request's Cache-Control header"""
+    directives = {d.strip().lower() for d in headers.get('cache-control', '').split(',')}
+    if 'no-store' in directives:
+        return False, False
+    if 'no-cache' in directives:
+        return False, True
+    return True, True
+
+
+def cache_key(service, method, path, data):
+    """Returns the cache key of a request, or None if its response may differ between calls"""
+    if method == 'GET':
+        data = b''
+    elif method == 'POST' and data and len(data) <= MAX_BODY_SIZE and b'"temperature"' in data:
+        try:
+            temperature = scan_top_level(data, (b'temperature',)).get(b'temperature')
+            if temperature is None or float(temperature) != 0:
+                return None
+        except (ScanError, ValueError):
+            return None
+    else:
+        return None
+    digest = hashlib.sha256()
+    for part in (str(service).encode(), method.encode(), path.encode()):
+        digest.update(part)
+        digest.update(b'\0')
+    digest.update(data)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """LRU cache with per-entry TTL and a total memory budget in bytes"""
+
+    def __init__(self, budget, ttl=300, max_entry_size=None):
+        self.budget = budget
+        self.ttl = ttl
+        self.max_entry_size = max_entry_size or budget // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires < time.monotonic():
+            self._discard(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, status_code, headers, body, input_tokens=0, output_tokens=0):
+        headers = {k: v for k, v in headers.items() if k.lower() not in HOP_BY_HOP}
+        entry = CachedResponse(status_code, headers, bytes(body), input_tokens, output_tokens,
+                               time.monotonic() + self.ttl)
+        if entry.size > self.max_entry_size:
+            return False
+        self._discard(key)
+        self._entries[key] = entry
+        self.size += entry.size
+        while self.size > self.budget:
+            self._discard(next(iter(self._entries)))
+        return True
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def stats(self):
+        return {'entries': len(self._entries), 'size': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+class ResponseRecorder:
+    """Collects the chunks of one response while it streams, up to a size limit"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.chunks = []
+        self.overflow = False
+
+    def add(self, chunk):
+        if self.overflow:
+            return
+        self.size += len(chunk)
+        if self.size > self.limit:
+            self.overflow = True
+            self.chunks = []
+        else:
+            self.chunks.append(chunk)
+
+    def body(self):
+        return b''.join(self.chunks)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+############################################################################
+## Response head parser                                                   ##
+############################################################################
+## cloud_interface.sh runs curl -i, so the response arrives on stdout as  ##
+## status line, headers, blank line and body, possibly preceded by any    ##
+## number of interim 1xx responses. The parser keeps the output in one    ##
+## bytearray, scans every byte once for the blank line, and hands out     ##
+## whatever follows the final head as a memoryview instead of a copy.     ##
+############################################################################
+
+MAX_HEADER_SIZE = 64 * 1024         # Bytes of status lines and headers, interim responses included
+READ_SIZE = 4096
+HEAD_END = b'\r\n\r\n'
+
+
+class HeaderError(ValueError):
+    """The output does not start with a usable HTTP response head"""
+
+
+class HeaderParser:
+    """Incremental parser for the response heads curl writes before the body.
+
+    Call feed() with each chunk of output until it returns True, then read
+    status_code, reason_phrase, http_version, headers and body. If the
+    output ends first, close() reports a 500 without body, as before.
+    """
+
+    def __init__(self, max_size=MAX_HEADER_SIZE):
+        self.max_size = max_size
+        self.done = False
+        self.http_version = None
+        self.status_code = 500
+        self.reason_phrase = "Bad response from cloud interface"
+        self.headers = {}
+        self.body = b''
+        self._buffer = bytearray()
+        self._start = 0             # Offset of the head being read
+        self._scanned = 0           # Offset up to which the buffer was searched
+
+    def feed(self, chunk):
+        """Adds a chunk of output; returns True once the final head is complete"""
+        if self.done:
+            raise HeaderError("Response head already complete")
+        buffer = self._buffer
+        buffer += chunk
+        while True:
+            # A terminator may straddle the previous chunk, so look back 3 bytes
+            end = buffer.find(HEAD_END, max(self._start, self._scanned - len(HEAD_END) + 1))
+            if end < 0:
+                self._scanned = len(buffer)
+                if len(buffer) > self.max_size:
+                    raise HeaderError(f"Response head exceeds {self.max_size} bytes")
+                return False
+            if end > self.max_size:
+                raise HeaderError(f"Response head exceeds {self.max_size} bytes")
+            self._parse_head(self._start, end)
+            self._start = self._scanned = end + len(HEAD_END)
+            if not 100 <= self.status_code < 200 or self.status_code == 101:
+                self.done = True
+                self.body = memoryview(buffer)[self._start:]
+                return True
+
+    def close(self):
+        """Marks the end of output; a missing head leaves the 500 defaults in place"""
+        if not self.done:
+            self.done = True
+            self.http_version = None
+            self.status_code = 500
+            self.reason_phrase = "Bad response from cloud interface"
+            self.headers = {}
+            self.body = b''
+
+    def _parse_head(self, start, end):
+        lines = self._buffer[start:end].split(b'\r\n')
+        status_line = lines[0].decode('latin-1')
+        parts = status_line.split(' ', 2)
+        try:
+            self.status_code = int(parts[1])
+        except (IndexError, ValueError):
+            raise HeaderError(f"Malformed status line: {status_line[:100]!r}")
+        self.http_version = parts[0]
+        self.reason_phrase = parts[2] if len(parts) > 2 else ''
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(b':')
+            if not separator:
+                continue
+            name = name.strip().decode('latin-1')
+            if name.lower() != 'content-length':
+                headers[name] = value.strip().decode('latin-1')
+        self.headers = headers
+
+
+async def read_head(stream, parser, read_size=READ_SIZE):
+    """Reads from stream until the parser has the final head or the stream ends"""
+    while True:
+        chunk = await stream.read(read_size)
+        if not chunk:
+            parser.close()
+            return parser
+        if parser.feed(chunk):
+            return parser
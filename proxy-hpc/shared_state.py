@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+
+############################################################################
+## State shared by the uvicorn workers of one host                        ##
+############################################################################
+## Every worker owns a memory-mapped file of named int64 cells in the     ##
+## shared directory (tmpfs by default) and is the only process writing    ##
+## it, so adding to a counter needs no lock and no update is ever lost.   ##
+## Reading a counter sums its cell over the files of all live workers.    ##
+## A worker holds an flock on its own file for as long as it runs; once   ##
+## the lock can be taken, the worker is gone and its file is ignored, so  ##
+## the requests it had in flight stop counting even after a crash.        ##
+## Check-and-add operations such as host-wide limits briefly take a lock  ##
+## file, polling it from the event loop while another worker holds it,    ##
+## and leader election holds one lock file per role. Nothing here leaves  ##
+## the host.                                                              ##
+############################################################################
+
+MAGIC = b'PXS1'
+HEADER = struct.Struct('=4sII')     # Magic, number of cells, cells in use
+USED = struct.Struct('=I')
+USED_OFFSET = 8
+HEADER_SIZE = 64
+CELL_SIZE = 64                      # int64 value, key length, key
+VALUE = struct.Struct('=q')
+KEY_LENGTH = struct.Struct('=H')
+KEY_OFFSET = VALUE.size + KEY_LENGTH.size
+KEY_SIZE = CELL_SIZE - KEY_OFFSET   # Longer keys are shortened with a hash
+SUFFIX = ".cells"
+CELLS = 16384                       # Cells per worker; tmpfs only allocates the pages in use
+RESCAN_INTERVAL = 1.0               # Seconds between checks whether the other workers are still alive
+LOCK_RETRY_INTERVAL = 0.001         # Seconds between attempts to take the host lock while another worker holds it
+
+
+def default_directory(name):
+    """tmpfs if the host has one, so the shared files never hit a disk"""
+    return os.path.join("/dev/shm" if os.path.isdir("/dev/shm") else "/tmp", name)
+
+
+def reset_directory(directory):
+    """Removes the files of previous runs; call once before starting the workers"""
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def encode_key(key):
+    data = key.encode()
+    if len(data) <= KEY_SIZE:
+        return data
+    digest = hashlib.blake2b(data, digest_size=12).hexdigest().encode()
+    return data[:KEY_SIZE - len(digest) - 1] + b'~' + digest
+
+
+def is_locked(fd):
+    """True if another process holds an flock on the file"""
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    return False
+
+
+class _Segment:
+    """Read-only view of another worker's cells"""
+
+    def __init__(self, fd, inode, mm):
+        self.fd = fd
+        self.inode = inode
+        self.mm = mm
+        self.index = {}
+        self.used = 0
+
+    @classmethod
+    def attach(cls, path):
+        """Maps the file of a live worker; returns None if the worker is gone"""
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            stat = os.fstat(fd)
+            if stat.st_size < HEADER_SIZE or not is_locked(fd):
+                raise ValueError("not a live worker")
+            mm = mmap.mmap(fd, stat.st_size, prot=mmap.PROT_READ)
+            if HEADER.unpack_from(mm)[0] != MAGIC:
+                mm.close()
+                raise ValueError("unknown format")
+        except (OSError, ValueError):
+            os.close(fd)
+            return None
+        return cls(fd, stat.st_ino, mm)
+
+    def alive(self):
+        return is_locked(self.fd)
+
+    def sync(self):
+        """Indexes the cells the owner allocated since the last call"""
+        mm = self.mm
+        used = USED.unpack_from(mm, USED_OFFSET)[0]
+        for offset in range(HEADER_SIZE + self.used * CELL_SIZE, HEADER_SIZE + used * CELL_SIZE, CELL_SIZE):
+            length = KEY_LENGTH.unpack_from(mm, offset + VALUE.size)[0]
+            self.index[mm[offset + KEY_OFFSET:offset + KEY_OFFSET + length]] = offset
+        self.used = used
+
+    def value(self, key):
+        offset = self.index.get(key)
+        if offset is None:
+            self.sync()
+            offset = self.index.get(key)
+            if offset is None:
+                return 0
+        return VALUE.unpack_from(self.mm, offset)[0]
+
+    def close(self):
+        self.mm.close()
+        os.close(self.fd)
+
+
+class SharedState:
+    """Host-wide counters over the uvicorn workers, see above.
+
+    The worker's own file is created on first use, so instances can be
+    made at import time in the parent process.
+    """
+
+    def __init__(self, directory, cells=CELLS):
+        self.directory = directory
+        self.cells = cells
+        self._pid = None
+        self._path = None
+        self._fd = None
+        self._mm = None
+        self._index = {}            # Key -> offset of the cell in the own file
+        self._peers = {}            # File name -> _Segment
+        self._directory_mtime = None
+        self._checked = 0.0
+        self._lock_fd = None
+        self._full = False
+
+    ## Own cells
+
+    def open(self):
+        if self._pid == os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._pid = os.getpid()
+        self._path = os.path.join(self.directory, f"{self._pid}{SUFFIX}")
+        self._index = {}
+        self._peers = {}
+        self._directory_mtime = None
+        self._lock_fd = None
+        self._create([])
+
+    def close(self):
+        """Removes the own file; its counts stop counting for the other workers"""
+        if self._pid != os.getpid():
+            return
+        try:
+            if os.stat(self._path).st_ino == os.fstat(self._fd).st_ino:
+                os.remove(self._path)
+        except OSError:
+            pass
+        self._mm.close()
+        os.close(self._fd)
+        for segment in self._peers.values():
+            segment.close()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+        self._pid = None
+        self._peers = {}
+
+    def _create(self, cells):
+        """Writes cells to a new file and moves it in place only once it is locked"""
+        tmp_path = os.path.join(self.directory, f".{self._pid}{SUFFIX}.tmp")
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.ftruncate(fd, HEADER_SIZE + self.cells * CELL_SIZE)
+        mm = mmap.mmap(fd, HEADER_SIZE + self.cells * CELL_SIZE)
+        HEADER.pack_into(mm, 0, MAGIC, self.cells, 0)
+        old_mm, old_fd = self._mm, self._fd
+        self._mm, self._fd = mm, fd
+        self._index = {}
+        for key, value in cells:
+            self._allocate(key, value)
+        os.replace(tmp_path, self._path)
+        if old_mm is not None:
+            old_mm.close()
+            os.close(old_fd)
+
+    def _allocate(self, key, value=0):
+        used = len(self._index)
+        offset = HEADER_SIZE + used * CELL_SIZE
+        mm = self._mm
+        VALUE.pack_into(mm, offset, value)
+        KEY_LENGTH.pack_into(mm, offset + VALUE.size, len(key))
+        mm[offset + KEY_OFFSET:offset + KEY_OFFSET + len(key)] = key
+        # Readers only look at cells below the count, so it is raised last
+        USED.pack_into(mm, USED_OFFSET, used + 1)
+        self._index[key] = offset
+        return offset
+
+    def _cell(self, key):
+        offset = self._index.get(key)
+        if offset is not None:
+            return offset
+        if len(self._index) >= self.cells:
+            # Start over with the non-zero cells; readers notice the new inode
+            mm = self._mm
+            cells = [(k, v) for k, o in self._index.items() if (v := VALUE.unpack_from(mm, o)[0])]
+            if len(cells) >= self.cells:
+                if not self._full:
+                    self._full = True
+                    logging.error(f"Shared state of worker {self._pid} is full, host-wide counts are incomplete")
+                return None
+            self._create(cells)
+        return self._allocate(key)
+
+    def add(self, key, delta=1):
+        """Adds to this worker's share of a counter"""
+        self.open()
+        offset = self._cell(encode_key(key))
+        if offset is None:
+            return
+        mm = self._mm
+        VALUE.pack_into(mm, offset, VALUE.unpack_from(mm, offset)[0] + delta)
+
+    ## Host-wide view
+
+    def _segments(self):
+        """Segments of the other live workers, rescanned when the directory changes"""
+        now = time.monotonic()
+        try:
+            mtime = os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return self._peers.values()
+        if mtime != self._directory_mtime or now - self._checked > RESCAN_INTERVAL:
+            self._directory_mtime = mtime
+            self._checked = now
+            self._rescan()
+        return self._peers.values()
+
+    def _rescan(self):
+        own = os.path.basename(self._path)
+        peers = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX) or name == own:
+                continue
+            path = os.path.join(self.directory, name)
+            segment = self._peers.pop(name, None)
+            try:
+                inode = os.stat(path).st_ino
+            except OSError:
+                inode = None
+            if segment and (segment.inode != inode or not segment.alive()):
+                segment.close()
+                segment = None
+            if segment is None and inode is not None:
+                segment = _Segment.attach(path)
+            if segment:
+                peers[name] = segment
+        for segment in self._peers.values():
+            segment.close()
+        self._peers = peers
+
+    def value(self, key):
+        """Sum of a counter over all live workers"""
+        self.open()
+        key = encode_key(key)
+        offset = self._index.get(key)
+        total = VALUE.unpack_from(self._mm, offset)[0] if offset is not None else 0
+        for segment in self._segments():
+            total += segment.value(key)
+        return total
+
+    def local(self, key):
+        """This worker's share of a counter"""
+        self.open()
+        offset = self._index.get(encode_key(key))
+        return VALUE.unpack_from(self._mm, offset)[0] if offset is not None else 0
+
+    @contextlib.asynccontextmanager
+    async def locked(self):
+        """Serializes check-and-add sequences across workers; keep the block short and free of awaits.
+
+        The lock is taken without blocking and retried after a short sleep, so
+        a worker holding it never stalls the event loop of another one.
+        """
+        self.open()
+        if self._lock_fd is None:
+            self._lock_fd = os.open(os.path.join(self.directory, "host.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            try:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                await asyncio.sleep(LOCK_RETRY_INTERVAL)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def leadership(self, role):
+        os.makedirs(self.directory, exist_ok=True)
+        return Leadership(os.path.join(self.directory, f"{role}.leader"))
+
+
+class Leadership:
+    """Leader election for one role: the worker holding the role's lock file leads.
+
+    If the leader dies, the kernel releases its lock and the next worker
+    calling try_lead() takes over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_leader = False
+        self._fd = None
+
+    def try_lead(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.is_leader = False
+        else:
+            self.is_leader = True
+        return self.is_leader
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)      # Releases the lock for other workers
+            self._fd = None
+        self.is_leader = False
+
+
+class InFlightRegistry:
+    """Host-wide number of requests per service and per consumer of a service"""
+
+    def __init__(self, shared, name):
+        self.shared = shared
+        self.name = name
+
+    def _keys(self, service, consumer):
+        return f"{self.name}:{service}", f"{self.name}:{service}:{consumer}"
+
+    async def enter(self, service, consumer, limit=None):
+        """Counts a request; with a limit only while fewer requests of the service are counted"""
+        service_key, consumer_key = self._keys(service, consumer)
+        if limit is None:
+            self.shared.add(service_key)
+            self.shared.add(consumer_key)
+            return True
+        async with self.shared.locked():
+            if self.shared.value(service_key) >= limit:
+                return False
+            self.shared.add(service_key)
+            self.shared.add(consumer_key)
+        return True
+
+    def leave(self, service, consumer):
+        service_key, consumer_key = self._keys(service, consumer)
+        self.shared.add(service_key, -1)
+        self.shared.add(consumer_key, -1)
+
+    def transfer(self, service, consumer, other):
+        """Hands a counted request of the service to another consumer, keeping the service count"""
+        self.shared.add(self._keys(service, consumer)[1], -1)
+        self.shared.add(self._keys(service, other)[1])
+
+    def count(self, service, consumer=None):
+        service_key, consumer_key = self._keys(service, consumer)
+        return self.shared.value(service_key if consumer is None else consumer_key)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+import asyncio
+import logging
+import random
+import time
+import asyncssh
+
+############################################################################
+## Pooled SSH transport                                                   ##
+############################################################################
+## Keeps a few persistent SSH sessions to the HPC login node open and     ##
+## runs every remote command on its own channel of the least loaded one.  ##
+############################################################################
+
+logging.getLogger('asyncssh').setLevel(logging.WARNING)  # Per-channel INFO logs would flood the proxy log
+
+class SSHUnavailableError(ConnectionError):
+    """Raised when no pooled SSH connection could serve a command in time"""
+
+
+class PooledProcess:
+    """Process-like handle for a command running on a pooled SSH channel.
+
+    Mirrors the parts of asyncio.subprocess.Process used by the proxy:
+    stdin, stdout, returncode, kill() and wait().
+    """
+
+    def __init__(self, process, slot, pool):
+        self._process = process
+        self._slot = slot
+        self._pool = pool
+        self.stdin = process.stdin
+        self.stdout = process.stdout
+        self.stderr = process.stderr
+        self._stderr_task = asyncio.create_task(self._drain_stderr())
+        self._release_task = asyncio.create_task(self._release_when_closed())
+
+    @property
+    def returncode(self):
+        return self._process.returncode
+
+    async def _drain_stderr(self):
+        """Read stderr so the channel window never fills up with unread data"""
+        try:
+            while True:
+                chunk = await self.stderr.read(4096)
+                if not chunk:
+                    break
+                logging.debug(f"SSH stderr: {chunk.decode(errors='replace').rstrip()}")
+        except Exception:
+            pass
+
+    async def _release_when_closed(self):
+        try:
+            await self._process.wait_closed()
+        finally:
+            await self._pool._release(self._slot)
+
+    def kill(self):
+        """Close the channel; the remote side sees EOF/SIGPIPE and exits"""
+        self._process.close()
+
+    async def wait(self):
+        await self._process.wait_closed()
+        return self.returncode
+
+
+class _Slot:
+    """One persistent SSH connection and its bookkeeping"""
+
+    def __init__(self, index):
+        self.index = index
+        self.conn = None
+        self.active = 0
+        self.failures = 0
+        self.last_error = None
+        self.connected_at = None
+
+    @property
+    def healthy(self):
+        return self.conn is not None and not self.conn.is_closed()
+
+
+class SSHConnectionPool:
+    """Pool of persistent asyncssh connections with least-loaded selection.
+
+    Every slot is owned by a supervisor task that connects, waits for the
+    connection to drop and reconnects with exponential backoff. Commands are
+    started on a new channel of the healthy slot with the fewest open
+    channels; when all slots are saturated, callers wait for capacity.
+    Control commands such as keep-alive or cancel may use control_channels
+    more channels per connection, so they never queue behind requests.
+    """
+
+    def __init__(self, host, user, key_path, port=22, size=4, max_channels=8, control_channels=1,
+                 keepalive_interval=15, keepalive_count_max=3, connect_timeout=10,
+                 acquire_timeout=30, backoff_base=0.5, backoff_max=30, known_hosts=None,
+                 connect_observer=None):
+        self.host = host
+        self.user = user
+        self.key_path = key_path
+        self.port = port
+        self.max_channels = max_channels
+        self.control_channels = control_channels
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count_max = keepalive_count_max
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.known_hosts = known_hosts
+        self.connect_observer = connect_observer    # Called with the duration of each successful connect
+        self._slots = [_Slot(i) for i in range(size)]
+        self._supervisors = []
+        self._cond = None
+        self._closing = False
+
+    async def start(self):
+        """Start one supervisor per slot; connections are opened in the background"""
+        self._cond = asyncio.Condition()
+        self._closing = False
+        self._supervisors = [asyncio.create_task(self._supervise(slot)) for slot in self._slots]
+
+    async def close(self):
+        self._closing = True
+        for task in self._supervisors:
+            task.cancel()
+        await asyncio.gather(*self._supervisors, return_exceptions=True)
+
+    def healthy_connections(self):
+        return sum(1 for slot in self._slots if slot.healthy)
+
+    def stats(self):
+        return [{
+            'slot': slot.index,
+            'healthy': slot.healthy,
+            'active': slot.active,
+            'failures': slot.failures,
+            'last_error': slot.last_error,
+        } for slot in self._slots]
+
+    async def _connect(self):
+        client_keys = [self.key_path] if self.key_path else None
+        return await asyncssh.connect(
+            self.host,
+            port=self.port,
+            username=self.user,
+            client_keys=client_keys,
+            known_hosts=self.known_hosts,
+            keepalive_interval=self.keepalive_interval,
+            keepalive_count_max=self.keepalive_count_max,
+            connect_timeout=self.connect_timeout,
+        )
+
+    async def _supervise(self, slot):
+        """Keep a slot connected, reconnecting with backoff when it drops"""
+        while not self._closing:
+            try:
+                started = time.monotonic()
+                slot.conn = await self._connect()
+                slot.connected_at = time.monotonic()
+                if self.connect_observer:
+                    self.connect_observer(slot.connected_at - started)
+                slot.failures = 0
+                slot.last_error = None
+                logging.info(f"SSH pool slot {slot.index} connected to {self.host}")
+                async with self._cond:
+                    self._cond.notify_all()
+                await slot.conn.wait_closed()
+                logging.warning(f"SSH pool slot {slot.index} lost its connection")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                slot.failures += 1
+                slot.last_error = str(e)
+                logging.error(f"SSH pool slot {slot.index} failed to connect: {str(e)}")
+            finally:
+                if slot.conn is not None:
+                    slot.conn.close()
+                    slot.conn = None
+            if self._closing:
+                break
+            delay = min(self.backoff_max, self.backoff_base * 2 ** min(slot.failures, 16))
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _pick(self, limit):
+        candidates = [s for s in self._slots if s.healthy and s.active < limit]
+        if not candidates:
+            return None
+        least = min(s.active for s in candidates)
+        return random.choice([s for s in candidates if s.active == least])
+
+    async def _acquire(self, control=False):
+        limit = self.max_channels + (self.control_channels if control else 0)
+        async with self._cond:
+            slot = self._pick(limit)
+            if slot is None:
+                try:
+                    await asyncio.wait_for(self._cond.wait_for(lambda: self._pick(limit) is not None),
+                                           self.acquire_timeout)
+                except asyncio.TimeoutError:
+                    raise SSHUnavailableError(f"No SSH connection to {self.host} available")
+                slot = self._pick(limit)
+            slot.active += 1
+            return slot
+
+    async def _release(self, slot):
+        async with self._cond:
+            slot.active -= 1
+            self._cond.notify_all()
+
+    async def run(self, remote_command, data=None, control=False):
+        """Run remote_command on a pooled channel, optionally writing data to its stdin"""
+        if isinstance(remote_command, bytes):
+            remote_command = remote_command.decode('utf-8', errors='surrogateescape')
+        for attempt in range(2):
+            slot = await self._acquire(control)
+            try:
+                process = await slot.conn.create_process(remote_command, encoding=None)
+            except (asyncssh.Error, OSError, AttributeError) as e:
+                # Connection died between selection and channel open; try another slot once
+                await self._release(slot)
+                slot.last_error = str(e)
+                if slot.conn is not None:
+                    slot.conn.close()
+                if attempt:
+                    raise SSHUnavailableError(f"Failed to open SSH channel: {str(e)}")
+                continue
+            proc = PooledProcess(process, slot, self)
+            if data:
+                proc.stdin.write(data)
+                await proc.stdin.drain()
+                proc.stdin.write_eof()
+            return proc
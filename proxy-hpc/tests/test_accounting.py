@@ -0,0 +1,60 @@
+import json
+
+from accounting import MAX_USAGE_SIZE, UsageExtractor, extract_tokens
+
+USAGE = {'prompt_tokens': 12, 'completion_tokens': 34, 'total_tokens': 46}
+
+
+def sse_stream(tokens=20):
+    events = [{'choices': [{'delta': {'content': f'tok{i} '}}], 'usage': None} for i in range(tokens)]
+    events.append({'choices': [], 'usage': USAGE})
+    return b''.join(b'data: ' + json.dumps(event).encode() + b'\n\n' for event in events) + b'data: [DONE]\n\n'
+
+
+def feed_in_chunks(data, size):
+    extractor = UsageExtractor()
+    for i in range(0, len(data), size):
+        extractor.feed(data[i:i + size])
+    return extractor
+
+
+def test_usage_of_a_stream_in_any_chunking():
+    data = sse_stream()
+    for size in (1, 3, 7, 64, len(data)):
+        extractor = feed_in_chunks(data, size)
+        assert extractor.tokens() == (12, 34)
+        assert extractor.output_size == len(data)
+        assert extractor.events == 22
+
+
+def test_usage_of_a_plain_json_body():
+    body = json.dumps({'choices': [{'message': {'content': 'hi'}}], 'usage': USAGE}, indent=2).encode()
+    assert extract_tokens(body) == (12, 34)
+
+
+def test_the_last_usage_object_wins():
+    data = b'{"usage": {"prompt_tokens": 1}}' + b'{"usage": {"prompt_tokens": 2, "completion_tokens": 3}}'
+    assert extract_tokens(data) == (2, 3)
+
+
+def test_usage_in_content_and_nested_objects():
+    data = (b'data: {"choices": [{"delta": {"content": "the \\"usage\\" word"}}], "usage": null}\n\n'
+            b'data: {"usage": {"prompt_tokens": 5, "completion_tokens": 6, '
+            b'"completion_tokens_details": {"reasoning_tokens": 4}}}\n\n')
+    extractor = feed_in_chunks(data, 5)
+    assert extractor.tokens() == (5, 6)
+    assert extractor.usage['completion_tokens_details'] == {'reasoning_tokens': 4}
+
+
+def test_memory_stays_bounded():
+    extractor = UsageExtractor()
+    extractor.feed(b'{"usage": {' + b'x' * 10 * MAX_USAGE_SIZE)
+    extractor.feed(b'y' * MAX_USAGE_SIZE)
+    assert len(extractor._buffer) < 2 * MAX_USAGE_SIZE
+    assert extractor.tokens() == (0, 0)
+
+
+def test_counting_only():
+    extractor = UsageExtractor(scan=False)
+    extractor.feed(sse_stream())
+    assert extractor.usage is None and extractor.output_size == len(sse_stream())
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import multiprocessing
+
+import pytest
+
+import admission as admission_module
+from admission import AdmissionController, AdmissionRejected
+from shared_state import SharedState
+
+
+@pytest.fixture
+def shared(tmp_path):
+    state = SharedState(str(tmp_path / "shared"))
+    yield state
+    state.close()
+
+
+def controller(shared, **limits):
+    return AdmissionController(shared, {'default': limits})
+
+
+def test_slots_go_round_robin_across_organizations_then_users(shared):
+    admission = controller(shared, limit=1)
+    order = []
+
+    async def request(o, uid):
+        permit = await admission.acquire('svc', uid, o=o)
+        order.append(uid)
+        await asyncio.sleep(0)
+        permit.release()
+
+    async def run():
+        first = await admission.acquire('svc', 'first', o='a')
+        # A user of organization a floods the queue before the others ask once each
+        tasks = [asyncio.create_task(request('a', 'flood')) for _ in range(3)]
+        tasks += [asyncio.create_task(request('a', 'a-other'))]
+        tasks += [asyncio.create_task(request(o, o)) for o in ('b', 'c')]
+        await asyncio.sleep(0.01)
+        first.release()
+        await asyncio.gather(*tasks)
+    asyncio.run(run())
+    assert order == ['flood', 'b', 'c', 'a-other', 'flood', 'flood']
+    assert admission.stats()['svc'] == {'limit': 1, 'active': 0, 'waiting': 0, 'rejected': 0}
+
+
+def test_full_queues_reject_with_a_retry_after(shared):
+    admission = controller(shared, limit=1, queue=2, queue_per_consumer=1)
+
+    async def run():
+        await admission.acquire('svc', 'u1')
+        waiting = [asyncio.create_task(admission.acquire('svc', uid)) for uid in ('u1', 'u2')]
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionRejected) as per_user:
+            await admission.acquire('svc', 'u3')
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        return per_user.value
+    rejected = asyncio.run(run())
+    assert rejected.reason == "Too many queued requests for svc"
+    assert rejected.retry_after >= 1
+
+
+def test_queue_per_consumer(shared):
+    admission = controller(shared, limit=1, queue_per_consumer=1)
+
+    async def run():
+        await admission.acquire('svc', 'u1')
+        waiting = asyncio.create_task(admission.acquire('svc', 'u1'))
+        await asyncio.sleep(0.01)
+        try:
+            await admission.acquire('svc', 'u1')
+        finally:
+            waiting.cancel()
+            await asyncio.gather(waiting, return_exceptions=True)
+    with pytest.raises(AdmissionRejected, match="from this user"):
+        asyncio.run(run())
+
+
+def test_waiters_time_out_and_leave_the_queue(shared):
+    admission = controller(shared, limit=1, timeout=0.05)
+
+    async def run():
+        await admission.acquire('svc', 'u1')
+        with pytest.raises(AdmissionRejected, match="Timed out"):
+            await admission.acquire('svc', 'u2')
+        return admission.stats()['svc']
+    assert asyncio.run(run()) == {'limit': 1, 'active': 1, 'waiting': 0, 'rejected': 1}
+
+
+def hold_slot(directory, held, release):
+    """Another worker holding the only slot of svc until release is set"""
+    async def run():
+        permit = await controller(SharedState(directory), limit=1).acquire('svc', 'u1')
+        held.set()
+        await asyncio.to_thread(release.wait)
+        permit.release()
+    asyncio.run(run())
+
+
+def test_slots_freed_by_another_worker_are_polled(shared):
+    context = multiprocessing.get_context('fork')
+    held, release = context.Event(), context.Event()
+    other = context.Process(target=hold_slot, args=(shared.directory, held, release))
+    other.start()
+    worker = controller(shared, limit=1)
+
+    async def run():
+        await asyncio.to_thread(held.wait, 5)
+        waiting = asyncio.create_task(worker.acquire('svc', 'u2'))
+        await asyncio.sleep(0.1)
+        assert not waiting.done()
+        release.set()
+        permit = await asyncio.wait_for(waiting, 5)
+        return permit.queue_wait
+    try:
+        assert asyncio.run(run()) > 0
+    finally:
+        release.set()
+        other.join()
+
+
+def test_limits_from_file(shared, tmp_path):
+    path = tmp_path / "admission.json"
+    path.write_text(json.dumps({'default': {'limit': 4}, 'small': {'queue': 1, 'unknown': 2}}))
+    admission = AdmissionController.from_file(shared, str(path))
+    assert admission.config['small'] == {'limit': 4, 'queue': 1, 'queue_per_consumer': 32, 'timeout': 60}
+    assert AdmissionController.from_file(shared, str(tmp_path / "missing.json")).config['default']['limit'] == 64
+
+
+def test_idle_queues_of_unknown_services_are_dropped(shared, monkeypatch):
+    monkeypatch.setattr(admission_module, "MAX_QUEUES", 3)
+    admission = controller(shared, limit=1)
+
+    async def run():
+        busy = await admission.acquire('busy', 'u1')
+        for service in ('a', 'b', 'c', 'd'):
+            (await admission.acquire(service, 'u1')).release()
+        return busy
+
+    busy = asyncio.run(run())
+    assert len(admission._queues) <= 3 and admission.queue('busy').active == 1
+    busy.release()
+    assert admission.stats()['busy']['active'] == 0
@@ -0,0 +1,141 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from coalescing import FlightTable
+
+
+async def body(chunks, gate=None):
+    for chunk in chunks:
+        if gate:
+            await gate.get()
+        yield chunk
+
+
+async def collect(flight, token):
+    return [chunk async for chunk in flight.stream(token)]
+
+
+def test_waiters_receive_every_chunk():
+    async def run():
+        table = FlightTable()
+        flight = table.open("key")
+        assert table.get("key") is flight
+        gate = asyncio.Queue()
+        first = flight.join()
+        flight.start(200, {}, body([b"a", b"b", b"c"], gate), {'id': "1"})
+        reader = asyncio.create_task(collect(flight, first))
+        gate.put_nowait(None)
+        await asyncio.sleep(0.01)
+        # A late waiter replays what the others already received
+        second = flight.join()
+        late = asyncio.create_task(collect(flight, second))
+        gate.put_nowait(None)
+        gate.put_nowait(None)
+        results = await reader, await late
+        return table, flight, results
+
+    table, flight, results = asyncio.run(run())
+    assert results == ([b"a", b"b", b"c"], [b"a", b"b", b"c"])
+    assert flight.complete and flight.waiters == 2 and len(table) == 0
+
+
+def test_flight_stops_taking_waiters_beyond_its_buffer():
+    async def run():
+        table = FlightTable(max_buffer=3)
+        flight = table.open("key")
+        token = flight.join()
+        gate = asyncio.Queue()
+        flight.start(200, {}, body([b"ab", b"cd", b"ef"], gate), {})
+        reader = asyncio.create_task(collect(flight, token))
+        gate.put_nowait(None)
+        gate.put_nowait(None)
+        await asyncio.sleep(0.01)
+        joinable = table.get("key")
+        gate.put_nowait(None)
+        return joinable, flight, await reader
+
+    joinable, flight, chunks = asyncio.run(run())
+    assert joinable is None and not flight.joinable
+    assert chunks == [b"ab", b"cd", b"ef"]
+    assert flight._size == 0
+
+
+def test_last_waiter_leaving_cancels_the_upstream_call():
+    async def run():
+        flight = FlightTable().open("key")
+        token = flight.join()
+        gate = asyncio.Queue()
+        flight.start(200, {}, body([b"a", b"b"], gate), {})
+        await asyncio.sleep(0)
+        flight.leave(token)
+        await asyncio.sleep(0.01)
+        return flight
+
+    flight = asyncio.run(run())
+    assert flight.done and not flight.complete
+
+
+def test_failure_before_the_head_reaches_every_waiter():
+    async def run():
+        table = FlightTable()
+        flight = table.open("key")
+        flight.join()
+        waiting = asyncio.create_task(flight.head())
+        await asyncio.sleep(0)
+        flight.fail(HTTPException(502, "Bad gateway"))
+        with pytest.raises(HTTPException):
+            await waiting
+        return table
+
+    assert len(asyncio.run(run())) == 0
+
+
+def test_pump_waits_for_the_slowest_waiter_beyond_its_buffer():
+    async def run():
+        flight = FlightTable(max_buffer=4).open("key")
+        fast, slow = flight.join(), flight.join()
+        read = []
+
+        async def source():
+            for index in range(10):
+                read.append(index)
+                yield b"ab"
+
+        flight.start(200, {}, source(), {})
+        fast_reader = asyncio.create_task(collect(flight, fast))
+        await asyncio.sleep(0.01)
+        held = flight._size, len(read), fast_reader.done()
+        slow_chunks = await collect(flight, slow)
+        return held, await fast_reader, slow_chunks, flight
+
+    (size, read, fast_done), fast_chunks, slow_chunks, flight = asyncio.run(run())
+    # The slow waiter has not read anything, so the pump stops just past the buffer
+    assert size <= 6 and read <= 3 and not fast_done
+    assert fast_chunks == slow_chunks == [b"ab"] * 10
+    assert flight.complete
+
+
+def test_last_waiter_leaving_before_the_head_cancels_the_leader():
+    async def run():
+        flight = FlightTable().open("key")
+        token = flight.join()
+        started = asyncio.Event()
+
+        async def lead():
+            started.set()
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(lead())
+        flight.lead(leader)
+        await started.wait()
+        other = flight.join()
+        flight.leave(token)
+        await asyncio.sleep(0)
+        still_running = not leader.done()
+        flight.leave(other)
+        await asyncio.sleep(0)
+        return still_running, leader.cancelled()
+
+    assert asyncio.run(run()) == (True, True)
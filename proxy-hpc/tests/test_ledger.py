@@ -0,0 +1,151 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+
+import pytest
+
+import ledger as ledger_module
+from ledger import MonthlyFileHandler, UsageLedger, make_record
+
+INFERENCE = {'id': "1", 'uid': "user", 'o': "org", 'ou': None, 'service': "llama", 'portal': "API",
+             'status': "COMPLETED", 'input_size': 10, 'start_timestamp': "2025-01-01T00:00:00"}
+
+
+def read_records(directory):
+    records = []
+    for name in sorted(os.listdir(directory)):
+        if name.startswith("usage-"):
+            with open(os.path.join(directory, name)) as f:
+                records += [json.loads(line) for line in f]
+    return records
+
+
+def test_make_record_orders_fields():
+    record = make_record("response", {'extra': 1, 'status': "COMPLETED", 'id': "1"})
+    assert list(record) == ['v', 'event', 'logged_at', 'id', 'status', 'extra']
+
+
+def test_records_are_written_in_batches(tmp_path):
+    async def run():
+        ledger = UsageLedger(str(tmp_path), legacy_log=False)
+        await ledger.start()
+        for i in range(50):
+            await ledger.record("request", {**INFERENCE, 'id': str(i)})
+        await ledger.close()
+        return ledger
+
+    ledger = asyncio.run(run())
+    records = read_records(tmp_path)
+    assert [record['id'] for record in records] == [str(i) for i in range(50)]
+    assert ledger.written == 50 and ledger.dropped == 0
+
+
+def test_record_is_a_snapshot(tmp_path):
+    async def run():
+        ledger = UsageLedger(str(tmp_path), legacy_log=False)
+        await ledger.start()
+        inference = dict(INFERENCE)
+        await ledger.record("request", inference)
+        inference['status'] = "FAILED"
+        await ledger.close()
+
+    asyncio.run(run())
+    assert read_records(tmp_path)[0]['status'] == "COMPLETED"
+
+
+def test_records_go_to_the_file_of_their_month(tmp_path, monkeypatch):
+    class Clock(datetime.datetime):
+        now_value = datetime.datetime(2001, 1, 31, 23, 59, 59)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.now_value
+
+    monkeypatch.setattr(ledger_module.datetime, "datetime", Clock)
+
+    async def run():
+        ledger = UsageLedger(str(tmp_path), legacy_log=False)
+        await ledger.start()
+        await ledger.record("request", INFERENCE)
+        Clock.now_value = datetime.datetime(2001, 2, 1, 0, 0, 1)
+        await ledger.record("response", INFERENCE)
+        await ledger.close()
+
+    asyncio.run(run())
+    january, february = (tmp_path / "usage-2001-01.jsonl").read_text(), (tmp_path / "usage-2001-02.jsonl").read_text()
+    assert [json.loads(line)['event'] for line in january.splitlines()] == ["request"]
+    assert [json.loads(line)['event'] for line in february.splitlines()] == ["response"]
+    # One JSON object per line, starting with the format version and the event
+    record = json.loads(february)
+    assert list(record)[:4] == ['v', 'event', 'logged_at', 'id'] and record['logged_at'].startswith("2001-02-01T00:00:01")
+
+
+def test_full_queue_blocks_then_writes_without_loss(tmp_path):
+    async def run():
+        ledger = UsageLedger(str(tmp_path), max_queue=1, put_timeout=0.01, legacy_log=False)
+        # A queue without a writer stays full, like that of a writer stuck on a slow disk
+        ledger._queue = asyncio.Queue(1)
+        for i in range(5):
+            await ledger.record("request", {**INFERENCE, 'id': str(i)})
+        return ledger
+
+    ledger = asyncio.run(run())
+    assert ledger.dropped == 0 and ledger.spilled == 4
+    assert [record['id'] for record in read_records(tmp_path)] == ["1", "2", "3", "4"]
+
+
+def test_drop_policy_counts_drops(tmp_path):
+    drops = []
+
+    async def run():
+        ledger = UsageLedger(str(tmp_path), max_queue=1, policy="drop", legacy_log=False,
+                             observer=lambda reason, count: drops.append((reason, count)))
+        await ledger.start()
+        for i in range(5):
+            await ledger.record("request", {**INFERENCE, 'id': str(i)})
+        await ledger.close()
+        return ledger
+
+    ledger = asyncio.run(run())
+    assert ledger.dropped == 4
+    assert drops == [("queue full", 1)] * 4
+    assert len(read_records(tmp_path)) == 1
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        UsageLedger("/tmp", policy="spill")
+
+
+def test_legacy_log_lines(tmp_path, caplog):
+    async def run():
+        ledger = UsageLedger(str(tmp_path))
+        await ledger.start()
+        await ledger.record("request", INFERENCE)
+        await ledger.record("response", {**INFERENCE, 'output_size': 5})
+        await ledger.close()
+
+    with caplog.at_level(logging.INFO):
+        asyncio.run(run())
+    lines = [record.getMessage() for record in caplog.records]
+    assert lines[0] == "Inference Request: " + json.dumps(INFERENCE)
+    assert lines[1].startswith("Inference Response: ")
+    assert json.loads(lines[1][len("Inference Response: "):])['output_size'] == 5
+
+
+def test_monthly_file_handler_switches_files(tmp_path):
+    handler = MonthlyFileHandler(str(tmp_path))
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    record = logging.LogRecord("test", logging.INFO, __file__, 0, "now", None, None)
+    handler.handle(record)
+    old = logging.LogRecord("test", logging.INFO, __file__, 0, "in 2001", None, None)
+    old.created = time.mktime((2001, 2, 3, 12, 0, 0, 0, 0, -1))
+    handler.handle(old)
+    handler.close()
+    with open(tmp_path / f"proxy-{time.strftime('%Y-%m')}.log") as f:
+        assert f.read() == "now\n"
+    with open(tmp_path / "proxy-2001-02.log") as f:
+        assert f.read() == "in 2001\n"
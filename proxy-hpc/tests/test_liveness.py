@@ -0,0 +1,90 @@
+import asyncio
+import os
+
+from liveness import DOWN, UNKNOWN, UP, LivenessManager
+from shared_state import Leadership
+
+
+def manager(tmp_path, probe, **options):
+    return LivenessManager(probe, str(tmp_path / "hpc-state.json"), Leadership(str(tmp_path / "keep-alive.lock")),
+                           **options)
+
+
+def results(*outcomes):
+    outcomes = list(outcomes)
+
+    async def probe():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        if outcome == 'hang':
+            await asyncio.sleep(10)
+        return outcome
+    return probe
+
+
+def test_node_is_down_after_consecutive_failures(tmp_path):
+    probes = results(True, False, OSError("ssh failed"), 'hang', True)
+    leader = manager(tmp_path, probes, failure_threshold=3, timeout=0.05)
+    observed = []
+    leader.observer = lambda success, rtt: observed.append(success)
+
+    async def run():
+        assert leader.leadership.try_lead()
+        statuses = []
+        for _ in range(5):
+            await leader._probe_once()
+            statuses.append(leader.state()['status'])
+        return statuses
+    assert asyncio.run(run()) == [UP, UP, UP, DOWN, UP]
+    assert observed == [True, False, False, False, True]
+    assert leader.state()['consecutive_failures'] == 0
+
+
+def test_followers_read_the_state_of_the_leader(tmp_path):
+    leader = manager(tmp_path, results(False), failure_threshold=1)
+    follower = manager(tmp_path, results())
+
+    async def run():
+        assert leader.leadership.try_lead()
+        assert not follower.leadership.try_lead()
+        await leader._probe_once()
+    asyncio.run(run())
+    assert follower.is_down()
+    assert not follower.is_leader
+    leader.leadership.release()
+    follower.leadership.release()
+
+
+def test_stale_or_missing_state_is_unknown(tmp_path):
+    follower = manager(tmp_path, results(), stale_after=30)
+    assert follower.state()['status'] == UNKNOWN
+    leader = manager(tmp_path, results(True))
+    leader.leadership.try_lead()
+    asyncio.run(leader._probe_once())
+    leader._state['updated_at'] -= 60
+    assert leader.state()['status'] == UNKNOWN and not leader.is_down()
+    leader.leadership.release()
+
+
+def test_another_worker_takes_over_when_the_leader_stops(tmp_path):
+    probes = []
+
+    async def probe():
+        probes.append(os.getpid())
+        return True
+    first = manager(tmp_path, probe, interval=0.01)
+    second = manager(tmp_path, probe, interval=0.01)
+
+    async def run():
+        await first.start()
+        await second.start()
+        await asyncio.sleep(0.05)
+        leaders = (first.is_leader, second.is_leader)
+        await first.close()
+        await asyncio.sleep(0.05)
+        leaders += (second.is_leader,)
+        await second.close()
+        return leaders
+    assert asyncio.run(run()) == (True, False, True)
+    assert probes
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import metrics
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def sample(metric, name, **labels):
+    for family in metric.collect():
+        for s in family.samples:
+            if s.name == name and s.labels == labels:
+                return s.value
+    return 0
+
+
+class Request:
+    def __init__(self, scope):
+        self.state = type('State', (), {})()
+        scope['state'] = self.state.__dict__
+
+
+def test_service_labels_are_bounded(monkeypatch):
+    monkeypatch.setattr(metrics, "_services", set())
+    monkeypatch.setattr(metrics, "MAX_SERVICE_LABELS", 2)
+    assert [metrics.service_label(s) for s in ("a", "b", "c", "a")] == ["a", "b", "other", "a"]
+
+
+def test_middleware_measures_requests_with_a_service():
+    async def app(scope, receive, send):
+        if scope['path'] == '/chat':
+            metrics.start_request(Request(scope), 'test-middleware')
+        await send({'type': 'http.response.start', 'status': 201})
+        await send({'type': 'http.response.body', 'body': b'ok'})
+
+    async def send(message):
+        pass
+
+    before = sample(metrics.REQUESTS, 'proxy_requests_total', service='test-middleware', status='201')
+    middleware = metrics.MetricsMiddleware(app)
+    for path in ('/chat', '/metrics'):
+        asyncio.run(middleware({'type': 'http', 'path': path}, None, send))
+    assert sample(metrics.REQUESTS, 'proxy_requests_total', service='test-middleware', status='201') == before + 1
+    assert sample(metrics.TTFB, 'proxy_time_to_first_byte_seconds_count', service='test-middleware') >= 1
+    assert sample(metrics.IN_FLIGHT, 'proxy_requests_in_flight', service='test-middleware') == 0
+
+
+def test_inference_tokens_are_counted():
+    labels = {'service': 'test-tokens', 'portal': 'Chat AI'}
+    before = sample(metrics.TOKENS, 'proxy_tokens_total', direction='output', **labels)
+    metrics.observe_inference({**labels, 'input_tokens': 3, 'output_tokens': 5})
+    metrics.observe_inference({**labels, 'input_tokens': None})
+    assert sample(metrics.TOKENS, 'proxy_tokens_total', direction='output', **labels) == before + 5
+
+
+def test_render_aggregates_the_worker_files():
+    metrics.observe_ledger_drop('test-render', 2)
+    body, content_type = metrics.render()
+    assert content_type.startswith('text/plain')
+    assert b'proxy_ledger_dropped_total{reason="test-render"}' in body
+
+
+LAUNCHER = """
+import multiprocessing
+import sys
+
+import metrics
+
+
+def worker():
+    metrics.observe_ledger_drop('worker', 1)
+
+
+if __name__ == '__main__':
+    metrics.observe_ledger_drop('launcher', 1)
+    process = multiprocessing.get_context('spawn').Process(target=worker)
+    process.start()
+    process.join()
+    sys.stdout.buffer.write(metrics.render()[0])
+"""
+
+
+def test_launcher_keeps_its_own_samples(tmp_path):
+    # With WORKERS=1, uvicorn serves from the process that cleaned up the directory
+    directory = tmp_path / "metrics"
+    directory.mkdir()
+    (directory / "counter_1.db").write_bytes(b"stale")
+    script = tmp_path / "launcher.py"
+    script.write_text(LAUNCHER)
+    env = {**os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(directory), 'PYTHONPATH': HERE}
+    body = subprocess.run([sys.executable, str(script)], env=env, capture_output=True, check=True).stdout
+    assert b'proxy_ledger_dropped_total{reason="launcher"} 1.0' in body
+    assert b'proxy_ledger_dropped_total{reason="worker"} 1.0' in body
+    assert not (directory / "counter_1.db").exists()
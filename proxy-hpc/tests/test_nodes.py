@@ -0,0 +1,94 @@
+import time
+
+import pytest
+
+from nodes import LoginNode, NodeRouter, parse_nodes
+from shared_state import SharedState
+
+
+class Liveness:
+    def __init__(self, status):
+        self.status = status
+
+    def is_down(self):
+        return self.status == 'down'
+
+    def state(self):
+        return {'status': self.status}
+
+    def retry_after(self):
+        return 5
+
+
+def test_parse_nodes():
+    nodes = parse_nodes("login1, alice@login2:2222=2,, login3=0.5", default_user="bob")
+    assert [(n.host, n.port, n.user, n.weight) for n in nodes] == [
+        ("login1", 22, "bob", 1.0), ("login2", 2222, "alice", 2.0), ("login3", 22, "bob", 0.5)]
+    for spec in ("", "login1=0"):
+        with pytest.raises(ValueError):
+            parse_nodes(spec)
+
+
+def test_least_outstanding_requests_per_weight():
+    small, large = LoginNode("small"), LoginNode("large", weight=3)
+    router = NodeRouter([small, large])
+    picks = []
+    for _ in range(4):
+        node = router.pick()
+        node.begin()
+        picks.append(node.host)
+    assert picks.count("large") == 3 and picks.count("small") == 1
+    assert router.pick(exclude=[large]) is small
+
+
+def test_load_is_counted_over_the_workers_of_the_host(tmp_path):
+    shared = SharedState(str(tmp_path))
+    try:
+        node = LoginNode("login1")
+        node.shared = shared
+        node.begin()
+        node.begin()
+        node.end()
+        assert node.load() == 1 and node.stats()['outstanding'] == 1
+    finally:
+        shared.close()
+
+
+def test_failing_nodes_are_ejected_with_backoff():
+    failing, healthy = LoginNode("failing"), LoginNode("healthy")
+    ejected = []
+    router = NodeRouter([failing, healthy], failure_threshold=2, base_ejection=10, max_ejection=15,
+                        observer=ejected.append)
+    healthy.begin()
+    router.record_failure(failing, "timeout")
+    assert router.pick() is failing
+    router.record_failure(failing, "timeout")
+    assert failing.is_ejected() and router.pick() is healthy
+    assert ejected == [failing]
+    failing.ejected_until = 0
+    for _ in range(2):
+        router.record_failure(failing, "timeout")
+    assert failing.ejections == 2
+    assert 10 < failing.ejected_until - time.monotonic() <= 15
+    failing.record_success(0.1)
+    assert (failing.ejections, failing.consecutive_errors) == (0, 0)
+
+
+def test_down_nodes_are_skipped_and_ejected_ones_used_as_a_last_resort():
+    down, ejected = LoginNode("down"), LoginNode("ejected")
+    down.liveness = Liveness('down')
+    ejected.ejected_until = float('inf')
+    router = NodeRouter([down, ejected])
+    assert router.pick() is ejected
+    assert router.pick(exclude=[ejected]) is None
+    ejected.liveness = Liveness('down')
+    assert router.all_down() and router.health()['status'] == 'down'
+    assert router.retry_after() == 5
+
+
+def test_health_is_up_while_any_node_is():
+    up, unknown = LoginNode("up"), LoginNode("unknown")
+    up.liveness = Liveness('up')
+    health = NodeRouter([up, unknown]).health()
+    assert health['status'] == 'up'
+    assert health['nodes']['unknown:22']['status'] == 'unknown'
@@ -0,0 +1,113 @@
+import asyncio
+
+import pytest
+
+from output_stage import DROP, OutputStage
+
+
+async def dense(count, size=10):
+    """A stream whose chunks arrive back to back"""
+    for i in range(count):
+        yield bytes([65 + i % 26]) * size
+        await asyncio.sleep(0)
+
+
+async def sparse(count, gap):
+    for i in range(count):
+        await asyncio.sleep(gap)
+        yield f'{i}'
+
+
+async def collect(stage, read_delay=0):
+    chunks = []
+    async for chunk in stage:
+        chunks.append(chunk)
+        await asyncio.sleep(read_delay)
+    return chunks
+
+
+def test_dense_streams_are_batched_without_losing_bytes():
+    async def run():
+        stage = OutputStage(dense(200), max_delay=0.01, max_bytes=1 << 20)
+        return b''.join([chunk async for chunk in dense(200)]), await collect(stage), stage.stats
+    expected, chunks, stats = asyncio.run(run())
+    assert b''.join(chunks) == expected
+    assert stats.chunks == 200 and stats.writes == len(chunks) < 20
+    assert stats.bytes == len(expected)
+
+
+def test_max_bytes_is_written_without_waiting():
+    async def run():
+        stage = OutputStage(dense(100), max_delay=10, max_bytes=100)
+        return await asyncio.wait_for(collect(stage), 5)
+    assert all(len(chunk) <= 110 for chunk in asyncio.run(run()))
+
+
+def test_sparse_streams_are_not_delayed():
+    async def run():
+        stage = OutputStage(sparse(3, 0.05), max_delay=0.01)
+        return await collect(stage), stage.stats
+    chunks, stats = asyncio.run(run())
+    assert chunks == [b'0', b'1', b'2'] and stats.writes == 3
+
+
+def test_slow_clients_pause_reading_or_get_dropped():
+    closed = []
+
+    class Body:
+        def __init__(self):
+            self.chunks = dense(1000, size=100)
+
+        def __aiter__(self):
+            return self.chunks.__aiter__()
+
+        async def aclose(self):
+            closed.append(True)
+
+    async def run(policy):
+        observed = []
+        stage = OutputStage(Body(), max_delay=0, buffer_limit=500, policy=policy, stall_timeout=0.02,
+                            observer=observed.append)
+        chunks = await collect(stage, read_delay=0.05 if policy == DROP else 0.001)
+        return chunks, observed[0]
+
+    chunks, stats = asyncio.run(run("wait"))
+    assert len(b''.join(chunks)) == 100000 and stats.stalls and not stats.dropped
+    chunks, stats = asyncio.run(run(DROP))
+    assert stats.dropped and closed and len(b''.join(chunks)) < 100000
+
+
+def test_errors_of_the_body_reach_the_client_after_its_data():
+    async def failing():
+        yield b'partial'
+        raise ConnectionError("upstream closed")
+
+    async def run():
+        chunks = []
+        with pytest.raises(ConnectionError):
+            async for chunk in OutputStage(failing()):
+                chunks.append(chunk)
+        return chunks
+    assert asyncio.run(run()) == [b'partial']
+
+
+def test_upstream_is_closed_before_the_stream_ends():
+    events = []
+
+    async def body():
+        try:
+            while True:
+                yield b'data'
+                await asyncio.sleep(0.001)
+        finally:
+            await asyncio.sleep(0.01)   # Closing the upstream response takes a moment
+            events.append("upstream closed")
+
+    async def run():
+        stage = OutputStage(body(), max_delay=0).__aiter__()
+        await stage.__anext__()
+        await stage.aclose()        # The client is gone
+        events.append("stream ended")
+        await asyncio.sleep(0.05)
+    asyncio.run(run())
+    assert events == ["upstream closed", "stream ended"]
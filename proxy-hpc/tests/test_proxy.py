@@ -0,0 +1,143 @@
+import asyncio
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("KEY_NAME", "test-key")
+
+import pytest
+from fastapi.responses import StreamingResponse
+
+import proxy
+from accounting import UsageExtractor
+from ledger import UsageLedger
+from nodes import LoginNode
+from response_cache import CachedResponse
+
+
+@pytest.fixture(autouse=True)
+def ledger(tmp_path, monkeypatch):
+    ledger = UsageLedger(str(tmp_path), legacy_log=False)
+    monkeypatch.setattr(proxy, "ledger", ledger)
+    return ledger
+
+
+def recorded(ledger):
+    with open(ledger.path_for(time.strftime("%Y-%m"))) as f:
+        return [json.loads(line) for line in f]
+
+
+class FinishedCommand:
+    def __init__(self, returncode):
+        self.returncode = returncode
+
+    async def wait(self):
+        return self.returncode
+
+
+async def body_of(response):
+    return b"".join([chunk async for chunk in response.body_iterator])
+
+
+def test_cache_hit_of_a_streamed_answer_is_a_stream():
+    body = b'data: {"a": 1}\n\ndata: [DONE]\n\n'
+    entry = CachedResponse(200, {'Content-Type': "text/event-stream"}, body, 3, 4, 0)
+
+    async def run():
+        response = await proxy.serve_cached(entry, {}, b"{}", "llama", "user", None, None)
+        return response, await body_of(response)
+
+    response, replayed = asyncio.run(run())
+    assert isinstance(response, StreamingResponse)
+    assert response.media_type is None and response.headers['content-type'] == "text/event-stream"
+    assert response.headers['x-cache'] == "HIT"
+    assert replayed == body
+
+
+def test_cache_hit_of_a_plain_answer():
+    entry = CachedResponse(200, {'Content-Type': "application/json"}, b'{"a": 1}', 3, 4, 0)
+    response = asyncio.run(proxy.serve_cached(entry, {}, b"{}", "llama", "user", None, None))
+    assert not isinstance(response, StreamingResponse)
+    assert response.body == b'{"a": 1}'
+
+
+def test_forked_ssh_stderr_is_drained_by_a_referenced_task(monkeypatch):
+    create_subprocess_exec = asyncio.create_subprocess_exec
+    # More stderr than a pipe holds: without a reader the command would block before answering
+    script = "import sys; sys.stderr.write('e' * 262144); sys.stderr.flush(); sys.stdout.write(sys.stdin.read())"
+
+    async def fake_ssh(*command, **kwargs):
+        return await create_subprocess_exec(sys.executable, "-c", script, **kwargs)
+
+    async def run():
+        proc = await proxy.run_ssh_subprocess("chat", b"ping", LoginNode("localhost", user="test"))
+        drains = [task for task in proxy.background_tasks if "drain_stderr" in repr(task.get_coro())]
+        output = await asyncio.wait_for(proc.stdout.read(), 10)
+        await proc.wait()
+        return drains, output
+
+    monkeypatch.setattr(asyncio, "create_subprocess_exec", fake_ssh)
+    drains, output = asyncio.run(run())
+    assert len(drains) == 1 and output == b"ping"
+
+
+def disconnect(monkeypatch, send_cancel, returncode=0):
+    """Runs cancel_inference for an inference that generated two events; returns the commands sent"""
+    commands = []
+
+    async def run_ssh_command(command, data=None, node=None, control=False):
+        commands.append((command, control))
+        return FinishedCommand(returncode)
+
+    monkeypatch.setattr(proxy, "send_cancel", send_cancel)
+    monkeypatch.setattr(proxy, "run_ssh_command", run_ssh_command)
+    usage = UsageExtractor()
+    usage.feed(b'data: {"choices": [{"delta": {"content": "a"}}]}\n\ndata: {"choices": [{"delta": {"content": "b"}}]}\n\n')
+    inference = {'id': "abc", 'service': "llama", 'status': "PENDING"}
+    asyncio.run(proxy.cancel_inference(LoginNode("node", user="test"), inference, usage, b'{"max_tokens": 10}'))
+    return commands
+
+
+def test_disconnect_without_cancel_command(monkeypatch, ledger):
+    assert disconnect(monkeypatch, False) == []
+    (record,) = recorded(ledger)
+    assert record['status'] == "CANCELLED" and record['generated_tokens'] == 2 and record['saved_tokens'] is None
+
+
+def test_disconnect_with_cancel_command(monkeypatch, ledger):
+    assert disconnect(monkeypatch, True) == [("cancel abc", True)]
+    (record,) = recorded(ledger)
+    assert record['status'] == "CANCELLED" and record['saved_tokens'] == 8
+
+
+def test_failed_cancel_command_saves_nothing(monkeypatch, ledger):
+    disconnect(monkeypatch, True, returncode=1)
+    assert recorded(ledger)[0]['saved_tokens'] is None
+
+
+def test_coalesced_client_leaving_before_the_head_cancels_the_call():
+    async def run():
+        flight = proxy.flights.open("test-key")
+        disconnected = asyncio.Event()
+
+        async def receive():
+            await disconnected.wait()
+            return {'type': 'http.disconnect'}
+
+        async def forward():
+            await asyncio.sleep(10)
+
+        leader = asyncio.create_task(forward())
+        flight.lead(leader)
+        serving = asyncio.create_task(proxy.serve_flight(flight, {}, b"{}", "llama", "user", None, None, receive,
+                                                         leader=True))
+        await asyncio.sleep(0.01)
+        disconnected.set()
+        await asyncio.sleep(0.01)
+        flight.fail(proxy.HTTPException(502, "Bad gateway"))
+        with pytest.raises(proxy.HTTPException):
+            await serving
+        return leader.cancelled()
+
+    assert asyncio.run(run())
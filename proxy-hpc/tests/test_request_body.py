@@ -0,0 +1,168 @@
+import asyncio
+import json
+
+import pytest
+
+from request_body import (ScanError, StreamedBody, inject_include_usage, inject_include_usage_front, preprocess_body,
+                          read_body, scan_top_level)
+
+MESSAGES = [{'role': "user", 'content': "x" * 400000}]
+
+
+async def chunks_of(data, size=65536):
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+async def chunks_of_list(chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def preprocess_streamed(data, need_model=True):
+    """The body as forwarded, model and stream of a body read like a request"""
+    async def run():
+        body = await read_body(chunks_of(data), len(data))
+        assert isinstance(body, StreamedBody)
+        body, model, stream = await preprocess_body(body, need_model=need_model)
+        forwarded = b"".join([chunk async for chunk in body])
+        await body.aclose()
+        return forwarded, model, stream
+    return asyncio.run(run())
+
+
+def test_large_body_with_stream_after_messages_gets_include_usage():
+    # The order of the OpenAI clients: model, messages, stream
+    data = json.dumps({'model': "llama", 'messages': MESSAGES, 'stream': True}).encode()
+    forwarded, model, stream = preprocess_streamed(data)
+    assert (model, stream) == ("llama", True)
+    assert json.loads(forwarded) == {'model': "llama", 'messages': MESSAGES, 'stream': True,
+                                     'stream_options': {'include_usage': True}}
+
+
+def spooled_preprocess(data):
+    async def run():
+        body = await read_body(chunks_of(data), len(data))
+        body, model, stream = await preprocess_body(body)
+        spooled = body._spool is not None
+        forwarded = b"".join([chunk async for chunk in body])
+        await body.aclose()
+        return forwarded, model, stream, spooled
+    return asyncio.run(run())
+
+
+def test_large_body_with_stream_false_in_head_is_not_spooled():
+    data = json.dumps({'stream': False, 'model': "llama", 'messages': MESSAGES}).encode()
+    forwarded, model, stream, spooled = spooled_preprocess(data)
+    assert (model, stream, spooled, forwarded) == ("llama", False, False, data)
+
+
+def test_large_body_with_stream_in_head_gets_include_usage_once():
+    data = json.dumps({'stream': True, 'model': "llama", 'messages': MESSAGES}).encode()
+    forwarded, model, stream, spooled = spooled_preprocess(data)
+    assert (model, stream, spooled) == ("llama", True, True)
+    assert json.loads(forwarded)['stream_options'] == {'include_usage': True}
+    # stream_options after the head is found in the spooled body and not duplicated
+    data = json.dumps({'stream': True, 'model': "llama", 'messages': MESSAGES,
+                       'stream_options': {'include_usage': True}}).encode()
+    forwarded, model, stream, spooled = spooled_preprocess(data)
+    assert (stream, spooled) == (True, True)
+    assert forwarded == data
+
+
+def test_large_body_with_stream_cut_off_at_the_head_end():
+    prefix = json.dumps({'model': "llama", 'messages': MESSAGES})[:-1].encode() + b', "stream": '
+    data = prefix + b'true}'
+    for cut in range(len(prefix), len(data) - 1):
+        async def run():
+            chunks = [data[:cut], data[cut:]]
+            body = await read_body(chunks_of_list(chunks), len(data), threshold=cut - 1)
+            assert body.head == data[:cut]
+            body, model, stream = await preprocess_body(body)
+            return b"".join([chunk async for chunk in body]), stream
+        forwarded, stream = asyncio.run(run())
+        assert stream is True
+        assert json.loads(forwarded)['stream_options'] == {'include_usage': True}
+
+
+def test_large_body_with_model_after_messages():
+    data = json.dumps({'messages': MESSAGES, 'model': "llama"}).encode()
+    forwarded, model, stream = preprocess_streamed(data)
+    assert (model, stream) == ("llama", False)
+    assert forwarded == data
+
+
+def test_large_body_with_own_stream_options_is_left_alone():
+    data = json.dumps({'model': "llama", 'messages': MESSAGES, 'stream': True,
+                       'stream_options': {'include_usage': False}}).encode()
+    forwarded, model, stream = preprocess_streamed(data)
+    assert stream is True and forwarded == data
+
+
+def test_small_body_is_read_whole():
+    data = json.dumps({'model': "llama", 'messages': [], 'stream': True}).encode()
+    body = asyncio.run(read_body(chunks_of(data, 8), len(data)))
+    assert body == data
+
+
+def test_scan_extracts_top_level_numbers():
+    fields = scan_top_level(b'{"a": {"temperature": 1}, "temperature": -0.5e1, "n": 3}', (b'temperature', b'n'))
+    assert fields == {b'temperature': b'-0.5e1', b'n': b'3'}
+    # A number at the end of a prefix may be cut off
+    assert scan_top_level(b'{"n": 12', (b'n',), partial=True) == {}
+
+
+def test_scan_leaves_out_literals_cut_off():
+    assert scan_top_level(b'{"model":"m","stream":tr', (b'stream',), partial=True) == {}
+    assert scan_top_level(b'{"model":"m","stream":', (b'stream',), partial=True) == {}
+    assert scan_top_level(b'{"stream":true', (b'stream',), partial=True) == {b'stream': b'true'}
+    assert scan_top_level(b'{"stream":[', (b'stream',), partial=True) == {b'stream': None}
+
+
+def preprocess(data, inject_usage=True):
+    return asyncio.run(preprocess_body(data, inject_usage=inject_usage))
+
+
+def test_scan_finds_top_level_keys_only():
+    data = b'{"messages": [{"model": "inner", "content": "\\"model\\": \\"fake\\""}], "model": "llama", "stream": true}'
+    assert scan_top_level(data, (b'model', b'stream')) == {b'model': b'"llama"', b'stream': b'true'}
+
+
+def test_scan_reports_other_values_as_none():
+    assert scan_top_level(b'{"stream_options": {"include_usage": false}}', (b'stream_options',)) == \
+        {b'stream_options': None}
+
+
+def test_scan_rejects_what_is_not_an_object():
+    for data in (b'[1, 2]', b'{"a": 1}}', b'{"a": "unterminated}'):
+        with pytest.raises(ScanError):
+            scan_top_level(data, (b'a',))
+
+
+def test_include_usage_is_injected_into_streaming_requests():
+    for body in ({'model': "llama", 'stream': True}, {'stream': True}):
+        data = json.dumps(body, indent=2).encode()
+        forwarded, model, stream = preprocess(data)
+        assert json.loads(forwarded) == {**body, 'stream_options': {'include_usage': True}}
+        assert (model, stream) == (body.get('model'), True)
+
+
+def test_non_streaming_requests_are_forwarded_as_they_are():
+    data = b'{"model": "llama", "messages": [], "stream": false}'
+    assert preprocess(data) == (data, "llama", False)
+    streaming = b'{"model": "llama", "stream": true}'
+    assert preprocess(streaming, inject_usage=False) == (streaming, "llama", True)
+
+
+def test_empty_object_and_front_injection():
+    assert json.loads(inject_include_usage(b'{ }')) == {'stream_options': {'include_usage': True}}
+    assert json.loads(inject_include_usage_front(b' {"a": 1}')) == {'a': 1, 'stream_options': {'include_usage': True}}
+
+
+def test_unusual_bodies_fall_back_to_a_full_parse():
+    # Own stream_options and a stream flag that is not a literal are left to json
+    data = b'{"model": "llama", "stream": true, "stream_options": {"include_usage": false}}'
+    forwarded, model, stream = preprocess(data)
+    assert json.loads(forwarded)['stream_options'] == {'include_usage': True}
+    with pytest.raises(ValueError):
+        preprocess(b'{"model": ')
@@ -0,0 +1,72 @@
+import time
+
+from response_cache import CachedResponse, ResponseCache, ResponseRecorder, cache_directives, cache_key
+
+STREAMED = b'data: {"a": 1}\n\ndata: {"b": 2}\n\ndata: [DONE]\n\n'
+
+
+def test_cache_key_of_deterministic_requests():
+    assert cache_key("llama", "GET", "v1/models", None) == cache_key("llama", "GET", "v1/models", b"")
+    body = b'{"model": "llama", "temperature": 0, "messages": [{"role": "user", "content": "hi"}]}'
+    first = cache_key("llama", "POST", "v1/chat", body)
+    assert first == cache_key("llama", "POST", "v1/chat", bytes(body))
+    assert first != cache_key("other", "POST", "v1/chat", body)
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature": 0.0}')
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature":-0}')
+
+
+def test_no_cache_key_for_sampled_or_invalid_requests():
+    assert cache_key("llama", "POST", "v1/chat", b'{"model": "llama"}') is None
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature": 0.7}') is None
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature": 0') is None
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature": 0e}') is None
+    assert cache_key("llama", "POST", "v1/chat", b'{"temperature": "0"}') is None
+    # Only the top-level temperature counts
+    assert cache_key("llama", "POST", "v1/chat", b'{"tools": [{"temperature": 0}], "temperature": 1}') is None
+    assert cache_key("llama", "POST", "v1/chat", b'{"messages": [{"content": "\\"temperature\\": 0"}]}') is None
+    assert cache_key("llama", "DELETE", "v1/files", None) is None
+
+
+def test_cache_directives():
+    assert cache_directives({}) == (True, True)
+    assert cache_directives({'cache-control': "no-cache"}) == (False, True)
+    assert cache_directives({'cache-control': "max-age=0, no-store"}) == (False, False)
+
+
+def test_lru_eviction_within_budget():
+    cache = ResponseCache(budget=3000, max_entry_size=1000)
+    for key in "abc":
+        assert cache.put(key, 200, {}, b"x" * 400)
+    cache.get("a")
+    cache.put("d", 200, {}, b"x" * 400)
+    assert cache.size <= 3000
+    assert cache.get("b") is None and cache.get("a") is not None
+    assert not cache.put("e", 200, {}, b"x" * 2000)
+
+
+def test_entries_expire():
+    cache = ResponseCache(budget=10000, ttl=0)
+    cache.put("a", 200, {}, b"body")
+    time.sleep(0.001)
+    assert cache.get("a") is None and cache.size == 0
+
+
+def test_hop_by_hop_headers_are_not_stored():
+    cache = ResponseCache(budget=10000)
+    cache.put("a", 200, {'Content-Type': "application/json", 'Transfer-Encoding': "chunked"}, b"{}")
+    assert cache.get("a").headers == {'Content-Type': "application/json"}
+
+
+def test_streamed_entries_replay_their_events():
+    entry = CachedResponse(200, {'Content-Type': "text/event-stream; charset=utf-8"}, STREAMED, 1, 2, 0)
+    assert entry.streamed
+    assert list(entry.events()) == [b'data: {"a": 1}\n\n', b'data: {"b": 2}\n\n', b'data: [DONE]\n\n']
+    assert not CachedResponse(200, {'content-type': "application/json"}, b"{}", 1, 2, 0).streamed
+
+
+def test_recorder_gives_up_beyond_its_limit():
+    recorder = ResponseRecorder(limit=10)
+    recorder.add(b"12345")
+    assert recorder.body() == b"12345"
+    recorder.add(b"123456")
+    assert recorder.overflow and recorder.body() == b""
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from response_head import HeaderError, HeaderParser, read_head
+
+OUTPUT = (b'HTTP/1.1 100 Continue\r\n\r\n'
+          b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nContent-Length: 12\r\nX-Id:  abc \r\n\r\n'
+          b'data: hello\n')
+
+
+def test_final_head_after_interim_responses_in_any_chunking():
+    for size in (1, 2, 3, 5, len(OUTPUT)):
+        parser = HeaderParser()
+        done = False
+        for i in range(0, len(OUTPUT), size):
+            if parser.feed(OUTPUT[i:i + size]):
+                done = True
+                body = bytes(parser.body) + OUTPUT[i + size:]
+                break
+        assert done
+        assert (parser.http_version, parser.status_code, parser.reason_phrase) == ('HTTP/1.1', 200, 'OK')
+        # Content-Length is left out, since the proxy streams the body
+        assert parser.headers == {'Content-Type': 'text/event-stream', 'X-Id': 'abc'}
+        assert body == b'data: hello\n'
+
+
+def test_body_is_a_view_of_the_buffer():
+    parser = HeaderParser()
+    assert parser.feed(OUTPUT)
+    assert isinstance(parser.body, memoryview)
+
+
+def test_output_without_a_head_is_a_500():
+    parser = HeaderParser()
+    assert not parser.feed(b'HTTP/1.1 200 OK\r\nX: 1\r\n')
+    parser.close()
+    assert (parser.status_code, parser.headers, parser.body) == (500, {}, b'')
+
+
+def test_oversized_and_malformed_heads_are_rejected():
+    with pytest.raises(HeaderError):
+        HeaderParser(max_size=64).feed(b'HTTP/1.1 200 OK\r\n' + b'X: y\r\n' * 20)
+    with pytest.raises(HeaderError):
+        HeaderParser().feed(b'garbage\r\n\r\n')
+    parser = HeaderParser()
+    parser.feed(OUTPUT)
+    with pytest.raises(HeaderError):
+        parser.feed(b'more')
+
+
+def test_read_head_from_a_stream():
+    async def run():
+        stream = asyncio.StreamReader()
+        stream.feed_data(OUTPUT)
+        stream.feed_eof()
+        parser = await read_head(stream, HeaderParser(), read_size=7)
+        return parser.status_code, bytes(parser.body) + await stream.read()
+    assert asyncio.run(run()) == (200, b'data: hello\n')
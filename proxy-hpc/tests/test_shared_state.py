@@ -0,0 +1,149 @@
+import asyncio
+import fcntl
+import multiprocessing
+import os
+
+import pytest
+
+from shared_state import KEY_SIZE, InFlightRegistry, SharedState, encode_key, reset_directory
+
+
+@pytest.fixture
+def shared(tmp_path):
+    state = SharedState(str(tmp_path / "shared"))
+    yield state
+    state.close()
+
+
+def worker(directory, adds, ready, done):
+    """Another uvicorn worker: adds to counters, then holds them until done is set"""
+    state = SharedState(directory)
+    for key, delta in adds:
+        state.add(key, delta)
+    ready.set()
+    done.wait(10)
+    if adds and adds[0][0] == 'crash':
+        os._exit(1)             # Dies without closing, like a killed worker
+    state.close()
+
+
+def start_worker(directory, adds):
+    context = multiprocessing.get_context('fork')
+    ready, done = context.Event(), context.Event()
+    process = context.Process(target=worker, args=(directory, adds, ready, done))
+    process.start()
+    assert ready.wait(10)
+    return process, done
+
+
+def test_counters_of_one_worker(shared):
+    shared.add("a")
+    shared.add("a", 4)
+    shared.add("b", -1)
+    assert (shared.value("a"), shared.local("a"), shared.value("b"), shared.value("missing")) == (5, 5, -1, 0)
+
+
+def test_counters_are_summed_over_live_workers(shared):
+    shared.add("requests", 2)
+    process, done = start_worker(shared.directory, [("requests", 3)])
+    try:
+        assert shared.value("requests") == 5 and shared.local("requests") == 2
+    finally:
+        done.set()
+        process.join()
+    shared._checked = 0
+    assert shared.value("requests") == 2
+
+
+def test_counts_of_a_crashed_worker_stop_counting(shared):
+    process, done = start_worker(shared.directory, [("crash", 1), ("requests", 7)])
+    assert shared.value("requests") == 7
+    done.set()
+    process.join()
+    assert process.exitcode == 1
+    shared._checked = 0
+    assert shared.value("requests") == 0
+
+
+def test_full_files_start_over_with_the_non_zero_cells(tmp_path):
+    state = SharedState(str(tmp_path), cells=4)
+    try:
+        for key in ("a", "b", "c", "d"):
+            state.add(key)
+        state.add("b", -1)
+        state.add("c", -1)
+        state.add("e", 5)
+        assert [state.value(k) for k in "abcde"] == [1, 0, 0, 1, 5]
+    finally:
+        state.close()
+
+
+def test_long_keys_are_hashed(shared):
+    long_key = "consumer:" + "x" * 200
+    assert len(encode_key(long_key)) <= KEY_SIZE
+    assert encode_key(long_key) != encode_key(long_key + "y")
+    shared.add(long_key, 3)
+    assert shared.value(long_key) == 3
+
+
+def test_in_flight_registry_limits_and_transfers(shared):
+    registry = InFlightRegistry(shared, 'running')
+    enter = lambda user: asyncio.run(registry.enter('svc', user, limit=2))
+    assert enter('u1') and enter('u2')
+    assert not enter('u3')
+    registry.transfer('svc', 'u1', 'u3')
+    registry.leave('svc', 'u2')
+    assert (registry.count('svc'), registry.count('svc', 'u1'), registry.count('svc', 'u3')) == (1, 0, 1)
+
+
+def test_leadership_and_reset(shared):
+    first, second = shared.leadership('keep-alive'), shared.leadership('keep-alive')
+    assert first.try_lead() and not second.try_lead()
+    first.release()
+    assert second.try_lead()
+    second.release()
+    reset_directory(shared.directory)
+    assert os.listdir(shared.directory) == []
+
+
+def hold_host_lock(path, locked, done):
+    """Another worker inside a check-and-add sequence"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    locked.set()
+    done.wait(10)
+    os.close(fd)
+
+
+def test_host_lock_held_elsewhere_does_not_block_the_loop(shared):
+    context = multiprocessing.get_context('fork')
+    locked, done = context.Event(), context.Event()
+    shared.open()
+    process = context.Process(target=hold_host_lock, args=(os.path.join(shared.directory, "host.lock"), locked, done))
+    process.start()
+    locked.wait(10)
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.001)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        entering = asyncio.create_task(InFlightRegistry(shared, 'running').enter('svc', 'u1', limit=1))
+        await asyncio.sleep(0.1)
+        waiting = not entering.done()
+        done.set()
+        entered = await asyncio.wait_for(entering, 10)
+        ticker.cancel()
+        return waiting, entered, ticks
+
+    try:
+        waiting, entered, ticks = asyncio.run(run())
+    finally:
+        done.set()
+        process.join()
+    assert waiting and entered and ticks > 10
@@ -0,0 +1,111 @@
+import asyncio
+
+import asyncssh
+import pytest
+
+from ssh_pool import SSHConnectionPool, SSHUnavailableError, _Slot
+
+
+class OpenServer(asyncssh.SSHServer):
+    def begin_auth(self, username):
+        return False
+
+
+async def echo(process):
+    """Answers "echo" with its stdin and "hold" by staying open until the client closes"""
+    if process.command == "hold":
+        await process.stdin.read()
+    else:
+        process.stdout.write(await process.stdin.read())
+    process.exit(0)
+
+
+async def serve():
+    key = asyncssh.generate_private_key('ssh-ed25519')
+    server = await asyncssh.create_server(OpenServer, '127.0.0.1', 0, server_host_keys=[key],
+                                          process_factory=echo)
+    return server, server.sockets[0].getsockname()[1]
+
+
+async def connected_pool(port, **options):
+    pool = SSHConnectionPool('127.0.0.1', 'test', None, port=port, known_hosts=None, backoff_base=0.01, **options)
+    await pool.start()
+    for _ in range(200):
+        if pool.healthy_connections() == len(pool._slots):
+            return pool
+        await asyncio.sleep(0.01)
+    raise AssertionError("pool did not connect")
+
+
+def test_runs_commands_on_pooled_channels():
+    async def run():
+        server, port = await serve()
+        pool = await connected_pool(port, size=2)
+        try:
+            outputs = []
+            for data in (b'one', b'two', b'three'):
+                proc = await pool.run("echo", data)
+                outputs.append(await proc.stdout.read())
+                assert await proc.wait() == 0
+            await asyncio.sleep(0.05)
+            return outputs, [slot['active'] for slot in pool.stats()]
+        finally:
+            await pool.close()
+            server.close()
+    outputs, active = asyncio.run(run())
+    assert outputs == [b'one', b'two', b'three']
+    assert active == [0, 0]
+
+
+def test_waits_for_capacity_and_gives_up_after_the_timeout():
+    async def run():
+        server, port = await serve()
+        pool = await connected_pool(port, size=1, max_channels=1, control_channels=1, acquire_timeout=0.2)
+        try:
+            held = await pool.run("hold")
+            # Control commands get a channel of their own beyond max_channels
+            control = await pool.run("hold", control=True)
+            with pytest.raises(SSHUnavailableError):
+                await pool.run("echo", b'x')
+            waiting = asyncio.create_task(pool.run("echo", b'late'))
+            await asyncio.sleep(0.05)
+            held.kill()
+            control.kill()
+            proc = await waiting
+            return await proc.stdout.read()
+        finally:
+            await pool.close()
+            server.close()
+    assert asyncio.run(run()) == b'late'
+
+
+def test_reconnects_after_the_connection_drops():
+    async def run():
+        server, port = await serve()
+        pool = await connected_pool(port, size=1)
+        try:
+            pool._slots[0].conn.close()
+            await asyncio.sleep(0.01)
+            for _ in range(200):
+                if pool.healthy_connections():
+                    break
+                await asyncio.sleep(0.01)
+            proc = await pool.run("echo", b'again')
+            return await proc.stdout.read()
+        finally:
+            await pool.close()
+            server.close()
+    assert asyncio.run(run()) == b'again'
+
+
+def test_picks_the_least_loaded_healthy_slot():
+    class Conn:
+        def is_closed(self):
+            return False
+    pool = SSHConnectionPool('host', 'user', None, size=3)
+    busy, idle, down = pool._slots
+    busy.conn, idle.conn = Conn(), Conn()
+    busy.active, idle.active = 3, 1
+    assert pool._pick(limit=8) is idle
+    assert pool._pick(limit=1) is None
+    assert not down.healthy and _Slot(0).active == 0
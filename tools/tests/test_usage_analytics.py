@@ -0,0 +1,109 @@
+import json
+import os
+
+import usage_analytics
+
+
+def inference(i, start, **fields):
+    return {'id': str(i), 'uid': "user", 'o': "org", 'ou': None, 'service': "llama", 'portal': "API",
+            'status': "COMPLETED", 'input_size': 10, 'start_timestamp': start, **fields}
+
+
+def response(i, start):
+    return inference(i, start, end_timestamp=start[:-1] + "2", output_size=5, input_tokens=3, output_tokens=2)
+
+
+def write_log(path, lines):
+    with open(path, 'a') as f:
+        f.write("".join(line + "\n" for line in lines))
+
+
+def test_log_lines_after_the_ledger_start_are_not_counted_twice(tmp_path):
+    log = tmp_path / "log"
+    log.mkdir()
+    # Before the upgrade only the log; afterwards the ledger and the same records in the log
+    write_log(log / "proxy-2025-01.log", [
+        "2025-01-01 00:00:00.000 INFO - Inference Response: " + json.dumps(response(1, "2025-01-01T00:00:00")),
+        "2025-01-02 00:00:00.000 INFO - Starting up...",
+        "2025-01-02 00:00:01.000 INFO - Inference Response: " + json.dumps(response(2, "2025-01-02T00:00:01")),
+    ])
+    write_log(log / "usage-2025-01.jsonl", [
+        json.dumps({'v': 1, 'event': "response", 'logged_at': "2025-01-02T00:00:01", **response(2, "2025-01-02T00:00:01")}),
+    ])
+    store = str(tmp_path / "store")
+    assert usage_analytics.ingest(store, [str(log)]) == 2
+    (total,) = usage_analytics.query(store)
+    assert total['requests'] == 2 and total['input_tokens'] == 6
+
+
+def ledger_line(event, record):
+    return json.dumps({'v': 1, 'event': event, 'logged_at': record['start_timestamp'], **record})
+
+
+def test_segments_round_trip(tmp_path):
+    rows = [usage_analytics.make_row(response(i, f"2025-03-0{i}T10:00:00"), True) for i in (1, 2)]
+    rows[1]['uid'] = "other"
+    path = str(tmp_path / "0.seg")
+    usage_analytics.write_segment(path, *usage_analytics.columns_of(rows))
+    segment = usage_analytics.Segment(path)
+    assert segment.rows == 2
+    assert list(segment.column('input_tokens')) == [3, 3]
+    assert [segment.dictionary('uid')[code] for code in segment.column('uid')] == ["user", "other"]
+    assert list(segment.column('latency')) == [2.0, 2.0]
+
+
+def test_ingest_reads_only_new_records_and_joins_requests(tmp_path):
+    log = tmp_path / "log"
+    log.mkdir()
+    store = str(tmp_path / "store")
+    ledger = log / "usage-2025-03.jsonl"
+    write_log(ledger, [ledger_line('request', inference(1, "2025-03-01T10:00:00")),
+                       ledger_line('response', response(1, "2025-03-01T10:00:00")),
+                       ledger_line('request', inference(2, "2025-03-01T11:00:00"))])
+    assert usage_analytics.ingest(store, [str(log)]) == 1
+    assert usage_analytics.ingest(store, [str(log)]) == 0
+    # A request without a response is stored once the records have moved on by the timeout
+    write_log(ledger, [ledger_line('response', response(3, "2025-03-03T10:00:00"))])
+    assert usage_analytics.ingest(store, [str(log)], pending_timeout=3600) == 2
+    results = usage_analytics.query(store, by=('status',))
+    assert [(r['status'], r['requests'], r['input_tokens']) for r in results] == [("COMPLETED", 3, 6)]
+    assert usage_analytics.load_state(store)['pending'] == {}
+
+
+def test_months_with_many_segments_are_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage_analytics, "MAX_SEGMENTS", 2)
+    log = tmp_path / "log"
+    log.mkdir()
+    store = str(tmp_path / "store")
+    for i in range(5):
+        write_log(log / "usage-2025-03.jsonl", [ledger_line('response', {
+            **response(i, f"2025-03-0{i + 1}T10:00:00"), 'uid': f"user{i % 2}"})])
+        usage_analytics.ingest(store, [str(log)])
+    segments = usage_analytics.load_state(store)['segments']
+    assert len(segments) <= 2
+    assert sorted(os.listdir(tmp_path / "store" / "2025-03")) == sorted(os.path.basename(s) for s in segments)
+    results = usage_analytics.query(store, by=('uid',))
+    assert [(r['uid'], r['requests']) for r in results] == [("user0", 3), ("user1", 2)]
+
+
+def test_query_buckets_filters_and_percentiles(tmp_path):
+    log = tmp_path / "log"
+    log.mkdir()
+    store = str(tmp_path / "store")
+    # 2025-03-02 is a Sunday and 2025-03-03 a Monday
+    records = [{**response(1, "2025-03-02T10:00:00"), 'service': "llama"},
+               {**response(2, "2025-03-03T10:00:00"), 'service': "llama", 'end_timestamp': "2025-03-03T10:00:04"},
+               {**response(3, "2025-03-03T12:00:00"), 'service': "qwen", 'o': None}]
+    write_log(log / "usage-2025-03.jsonl", [ledger_line('response', record) for record in records])
+    usage_analytics.ingest(store, [str(log)])
+    weeks = usage_analytics.query(store, bucket='week')
+    assert [(r['bucket'], r['requests']) for r in weeks] == [("2025-02-24", 1), ("2025-03-03", 2)]
+    days = usage_analytics.query(store, by=('service',), bucket='day')
+    assert [(r['bucket'], r['service'], r['requests']) for r in days] == [
+        ("2025-03-02", "llama", 1), ("2025-03-03", "llama", 1), ("2025-03-03", "qwen", 1)]
+    (llama,) = usage_analytics.query(store, where={'service': {"llama"}})
+    assert llama['requests'] == 2 and llama['latency_p50'] == 3.0 and llama['latency_p99'] == 3.98
+    since = usage_analytics.local_seconds("2025-03-03T00:00:00")
+    (late,) = usage_analytics.query(store, by=('o',), since=since, until=since + 11 * 3600)
+    assert (late['o'], late['requests']) == ("org", 1)
+    assert usage_analytics.query(store, where={'service': {"missing"}}) == []
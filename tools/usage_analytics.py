@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import collections
+import csv
+import datetime
+import glob
+import itertools
+import json
+import math
+import os
+import sys
+import time
+import zlib
+
+############################################################################
+## Usage analytics over the inference records of both proxies             ##
+############################################################################
+## "ingest" tails the usage-YYYY-MM.jsonl ledgers and the "Inference      ##
+## Request:" / "Inference Response:" lines of proxy-YYYY-MM.log files     ##
+## from the offsets it reached last time, joins request and response      ##
+## records by id and appends the inferences to a columnar store. Log      ##
+## lines are read only for records from before the first ledger record    ##
+## in the same directory, since the proxies log every record as well.     ##
+## "query" rolls them up by any of uid, o, ou, service, portal and        ##
+## status and a time bucket, with token totals and latency percentiles,   ##
+## reading only the columns and segments it needs.                        ##
+##                                                                        ##
+## The store holds one directory per month of segments. A segment is a    ##
+## JSON header followed by zlib-compressed columns: start time and        ##
+## latency as doubles, sizes and tokens as int64, and the dimensions as   ##
+## uint32 codes into a per-segment dictionary. state.json records the     ##
+## committed segments, the offset reached in every log file and the       ##
+## requests still waiting for their response; it is replaced atomically   ##
+## after the segments are written, so an interrupted ingest is redone.    ##
+##                                                                        ##
+##     usage_analytics.py ingest --store usage-store proxy-*/log          ##
+##     usage_analytics.py query --store usage-store --by o,service \      ##
+##         --bucket month --from 2025-01-01                               ##
+############################################################################
+
+MAGIC = b"USAGECOL1\n"
+DIMENSIONS = ('uid', 'o', 'ou', 'service', 'portal', 'status')
+NUMBERS = ('input_size', 'output_size', 'input_tokens', 'output_tokens')
+COLUMN_TYPES = {'start': 'd', 'latency': 'd', **{name: 'q' for name in NUMBERS}, **{name: 'I' for name in DIMENSIONS}}
+BUCKETS = ('none', 'hour', 'day', 'week', 'month')
+MARKERS = {b'Inference Request: ': 'request', b'Inference Response: ': 'response'}
+READ_SIZE = 64 * 1024 * 1024        # Bytes of a log file read at once
+MAX_SEGMENTS = 8                    # Segments per month before they are merged into one
+PENDING_TIMEOUT = 24 * 3600         # Seconds a request waits for its response before it is stored without one
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def local_seconds(timestamp):
+    """Seconds since 1970 of a naive ISO timestamp as written by the proxies, in their local time"""
+    return (datetime.datetime.fromisoformat(timestamp) - EPOCH).total_seconds()
+
+
+def percentile(values, p):
+    """Linear interpolation between the closest ranks of sorted values, like benchmarks/loadgen.py"""
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+############################################################################
+## Segments                                                               ##
+############################################################################
+
+def columns_of(rows):
+    """Columns and dimension dictionaries of rows, dicts with start, latency, the numbers and the dimensions"""
+    columns = {}
+    dictionaries = {}
+    for name, typecode in COLUMN_TYPES.items():
+        if name in DIMENSIONS:
+            codes = {}
+            columns[name] = array.array(typecode, (codes.setdefault(row[name], len(codes)) for row in rows))
+            dictionaries[name] = list(codes)
+        else:
+            columns[name] = array.array(typecode, (row[name] for row in rows))
+    return columns, dictionaries
+
+
+def write_segment(path, columns, dictionaries):
+    """Writes columns as a segment; dimension columns hold codes into their list in dictionaries"""
+    rows = len(columns['start'])
+    header = {'rows': rows, 'start_min': min(columns['start']), 'start_max': max(columns['start']),
+              'columns': {}}
+    blobs = []
+    offset = 0
+    for name, values in columns.items():
+        if sys.byteorder == 'big':
+            values.byteswap()
+        blob = zlib.compress(values.tobytes(), 6)
+        header['columns'][name] = {'type': values.typecode, 'offset': offset, 'length': len(blob)}
+        if name in dictionaries:
+            header['columns'][name]['values'] = dictionaries[name]
+        blobs.append(blob)
+        offset += len(blob)
+    encoded = json.dumps(header).encode()
+    temporary = path + ".tmp"
+    with open(temporary, 'wb') as f:
+        f.write(MAGIC + len(encoded).to_bytes(4, 'little') + encoded)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(temporary, path)
+
+
+class Segment:
+    """A segment on disk whose columns are read on demand"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a usage segment")
+            size = int.from_bytes(f.read(4), 'little')
+            self.header = json.loads(f.read(size))
+            self.data_offset = len(MAGIC) + 4 + size
+        self.rows = self.header['rows']
+
+    def column(self, name):
+        """The values of a column; the codes for dimensions"""
+        info = self.header['columns'][name]
+        with open(self.path, 'rb') as f:
+            f.seek(self.data_offset + info['offset'])
+            values = array.array(info['type'], zlib.decompress(f.read(info['length'])))
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def dictionary(self, name):
+        return self.header['columns'][name]['values']
+
+
+############################################################################
+## Ingestion                                                              ##
+############################################################################
+
+def load_state(store):
+    try:
+        with open(os.path.join(store, "state.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'files': {}, 'pending': {}, 'segments': [], 'next_segment': 0}
+
+
+def save_state(store, state):
+    temporary = os.path.join(store, "state.json.tmp")
+    with open(temporary, 'w') as f:
+        json.dump(state, f)
+    os.replace(temporary, os.path.join(store, "state.json"))
+
+
+def log_files(paths):
+    """Ledger and log files in paths, which may be files or directories"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += glob.glob(os.path.join(path, "usage-*.jsonl")) + glob.glob(os.path.join(path, "proxy-*.log"))
+        else:
+            files.append(path)
+    return sorted(os.path.abspath(f) for f in files)
+
+
+def parse_line(line):
+    """(event, inference) of a ledger line or a log line with an inference record, else None"""
+    try:
+        if line.startswith(b'{'):
+            record = json.loads(line)
+            return record.get('event'), record
+        for marker, event in MARKERS.items():
+            index = line.find(marker)
+            if index >= 0:
+                return event, json.loads(line[index + len(marker):])
+    except ValueError:
+        pass
+    return None
+
+
+def read_new_records(path, position):
+    """Yields the records appended to path since position, and finally its new position"""
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if position.get('inode') != stat.st_ino or stat.st_size < position.get('offset', 0):
+            position = {'inode': stat.st_ino, 'offset': 0}   # New or truncated file
+        offset = position['offset']
+        f.seek(offset)
+        rest = b''
+        while True:
+            block = f.read(READ_SIZE)
+            if not block:
+                break
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            for line in block[:end].splitlines():
+                # Most log lines are not inference records; only those are parsed
+                if line.startswith(b'{') or b'Inference Re' in line:
+                    parsed = parse_line(line)
+                    if parsed:
+                        yield parsed
+            offset += end
+    yield {'inode': stat.st_ino, 'offset': offset}
+
+
+def ledger_start(directory):
+    """logged_at of the first ledger record in directory, or None without ledgers"""
+    for path in sorted(glob.glob(os.path.join(directory, "usage-*.jsonl"))):
+        with open(path, 'rb') as f:
+            line = f.readline()
+        try:
+            return json.loads(line)['logged_at']
+        except (ValueError, KeyError):
+            continue
+    return None
+
+
+def make_row(inference, response):
+    """A store row from a response record, or from a request that never got one"""
+    try:
+        start = local_seconds(inference['start_timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    latency = math.nan
+    if response and inference.get('end_timestamp'):
+        try:
+            latency = local_seconds(inference['end_timestamp']) - start
+        except ValueError:
+            pass
+    row = {'start': start, 'latency': latency}
+    for name in NUMBERS:
+        value = inference.get(name)
+        row[name] = value if isinstance(value, int) else 0
+    for name in DIMENSIONS:
+        value = inference.get(name)
+        row[name] = None if value is None else str(value)
+    return row
+
+
+def ingest(store, paths, pending_timeout=PENDING_TIMEOUT):
+    """Adds the records appended to the files in paths since the last ingest; returns the rows stored"""
+    os.makedirs(store, exist_ok=True)
+    state = load_state(store)
+    pending = state['pending']
+    rows = []
+    for path in log_files(paths):
+        # Proxies with a ledger still log every record as before; those lines are only read up to the ledger's start
+        cutoff = None if path.endswith(".jsonl") else ledger_start(os.path.dirname(path))
+        for item in read_new_records(path, state['files'].get(path, {})):
+            if 'inode' in item:
+                state['files'][path] = item
+                continue
+            event, inference = item
+            if 'id' not in inference:
+                continue
+            if cutoff and (inference.get('start_timestamp') or '') >= cutoff:
+                continue
+            state['latest'] = max(state.get('latest') or '', inference.get('start_timestamp') or '')
+            if event == 'request':
+                pending[inference['id']] = inference
+            elif event == 'response':
+                # Responses repeat the request's fields, so the request is only needed if none arrives
+                pending.pop(inference['id'], None)
+                if (row := make_row(inference, True)):
+                    rows.append(row)
+    # Requests without a response, such as those of a crashed worker, are stored with their last status
+    # once the logs have moved on by pending_timeout, which also holds when older logs are ingested
+    horizon = local_seconds(state['latest']) - pending_timeout if state.get('latest') else -math.inf
+    for inference_id, inference in list(pending.items()):
+        try:
+            started = local_seconds(inference['start_timestamp'])
+        except (KeyError, TypeError, ValueError):
+            started = -math.inf
+        if started < horizon:
+            del pending[inference_id]
+            if (row := make_row(inference, False)):
+                rows.append(row)
+    by_month = {}
+    for row in rows:
+        month = (EPOCH + datetime.timedelta(seconds=row['start'])).strftime("%Y-%m")
+        by_month.setdefault(month, []).append(row)
+    for month, month_rows in sorted(by_month.items()):
+        os.makedirs(os.path.join(store, month), exist_ok=True)
+        name = os.path.join(month, f"{state['next_segment']:08d}.seg")
+        state['next_segment'] += 1
+        write_segment(os.path.join(store, name), *columns_of(month_rows))
+        state['segments'].append(name)
+    compacted = compact(store, state, by_month)
+    save_state(store, state)
+    for name in compacted:
+        os.remove(os.path.join(store, name))
+    return len(rows)
+
+
+def compact(store, state, months):
+    """Merges the segments of months with more than MAX_SEGMENTS into one; returns the names replaced"""
+    replaced = []
+    for month in months:
+        names = [name for name in state['segments'] if name.startswith(month + os.sep)]
+        if len(names) <= MAX_SEGMENTS:
+            continue
+        columns = {name: array.array(typecode) for name, typecode in COLUMN_TYPES.items()}
+        codes = {name: {} for name in DIMENSIONS}
+        for name in names:
+            segment = Segment(os.path.join(store, name))
+            for column in COLUMN_TYPES:
+                values = segment.column(column)
+                if column in DIMENSIONS:
+                    # Codes of the segment's dictionary mapped to those of the merged one
+                    mapping = [codes[column].setdefault(value, len(codes[column]))
+                               for value in segment.dictionary(column)]
+                    values = map(mapping.__getitem__, values)
+                columns[column].extend(values)
+        merged = os.path.join(month, f"{state['next_segment']:08d}.seg")
+        state['next_segment'] += 1
+        write_segment(os.path.join(store, merged), columns, {name: list(codes[name]) for name in DIMENSIONS})
+        state['segments'] = [name for name in state['segments'] if name not in names] + [merged]
+        replaced += names
+    return replaced
+
+
+############################################################################
+## Queries                                                                ##
+############################################################################
+
+def bucket_function(bucket):
+    """Maps start seconds to the label of their bucket, or None without buckets; labels are cached per day or hour"""
+    if bucket == 'none':
+        return None
+    width, label = {
+        'hour': (3600, lambda i: (EPOCH + datetime.timedelta(hours=i)).strftime("%Y-%m-%d %H:00")),
+        'day': (86400, lambda i: (EPOCH + datetime.timedelta(days=i)).strftime("%Y-%m-%d")),
+        # 1970-01-01 was a Thursday; weeks start on Monday
+        'week': (86400, lambda i: (EPOCH + datetime.timedelta(days=i - (i + 3) % 7)).strftime("%Y-%m-%d")),
+        'month': (86400, lambda i: (EPOCH + datetime.timedelta(days=i)).strftime("%Y-%m")),
+    }[bucket]
+    labels = {}
+
+    def bucket_of(start):
+        index = int(start // width)
+        try:
+            return labels[index]
+        except KeyError:
+            return labels.setdefault(index, label(index))
+    return bucket_of
+
+
+def query(store, by=(), bucket='none', since=None, until=None, where=None):
+    """Rolls up the stored inferences; returns one dict per group, in order of bucket and keys.
+
+    where maps dimensions to the values they may take. since and until
+    limit the start time, as local seconds, to [since, until).
+    """
+    state = load_state(store)
+    where = {name: set(values) for name, values in (where or {}).items()}
+    low = since if since is not None else -math.inf
+    high = until if until is not None else math.inf
+    bucket_of = bucket_function(bucket)
+    groups = {}
+    for name in state['segments']:
+        segment = Segment(os.path.join(store, name))
+        if segment.header['start_max'] < low or segment.header['start_min'] >= high:
+            continue
+        scan(segment, by, bucket_of, low, high, where, groups)
+    results = []
+    for key in sorted(groups, key=lambda key: tuple('' if k is None else k for k in key)):
+        count, input_tokens, output_tokens, input_size, output_size, latencies = groups[key]
+        latencies.sort()
+        result = dict(zip(('bucket', *by), key)) if bucket != 'none' else dict(zip(by, key[1:]))
+        result.update({
+            'requests': count, 'input_tokens': input_tokens, 'output_tokens': output_tokens,
+            'input_size': input_size, 'output_size': output_size,
+            'latency_p50': percentile(latencies, 50), 'latency_p90': percentile(latencies, 90),
+            'latency_p99': percentile(latencies, 99),
+        })
+        results.append(result)
+    return results
+
+
+def scan(segment, by, bucket_of, low, high, where, groups):
+    """Adds the rows of segment to groups, keyed by bucket and the values of by.
+
+    Rows are numbered by their group and summed column by column, so most
+    of the work happens in the iterators of zip, map and compress rather
+    than in Python code per row.
+    """
+    columns = {name: segment.column(name) for name in ('start', 'latency', *NUMBERS, *by)}
+    # Filters compare codes, which differ per segment
+    masks = []
+    for name, values in where.items():
+        dictionary = segment.dictionary(name)
+        allowed = {code for code, value in enumerate(dictionary) if value in values}
+        if not allowed:
+            return
+        if len(allowed) < len(dictionary):
+            masks.append(map(allowed.__contains__, segment.column(name)))
+    if not (low <= segment.header['start_min'] and segment.header['start_max'] < high):
+        masks.append(low <= t < high for t in columns['start'])
+    if masks:
+        mask = bytes(map(all, zip(*masks)))
+        columns = {name: list(itertools.compress(values, mask)) for name, values in columns.items()}
+    index = collections.defaultdict()
+    index.default_factory = index.__len__
+    buckets = map(bucket_of, columns['start']) if bucket_of else itertools.repeat('', len(columns['start']))
+    ids = list(map(index.__getitem__, zip(buckets, *(columns[name] for name in by))))
+    totals = [[0, 0, 0, 0, 0, []] for _ in index]
+    for group, count in collections.Counter(ids).items():
+        totals[group][0] = count
+    for position, name in enumerate(('input_tokens', 'output_tokens', 'input_size', 'output_size'), 1):
+        sums = [0] * len(index)
+        for group, value in zip(ids, columns[name]):
+            sums[group] += value
+        for group, value in enumerate(sums):
+            totals[group][position] = value
+    for group, value in zip(ids, columns['latency']):
+        if value == value:          # Not NaN
+            totals[group][5].append(value)
+    dictionaries = [segment.dictionary(name) for name in by]
+    for key, group in index.items():
+        key = (key[0], *(dictionary[code] for dictionary, code in zip(dictionaries, key[1:])))
+        merged = groups.get(key)
+        if merged is None:
+            groups[key] = totals[group]
+            continue
+        for i in range(5):
+            merged[i] += totals[group][i]
+        merged[5] += totals[group][5]
+
+
+############################################################################
+## Command line                                                           ##
+############################################################################
+
+def print_results(results, output_format, fields):
+    if output_format == 'json':
+        print(json.dumps(results, indent=2))
+        return
+    if output_format == 'csv':
+        writer = csv.DictWriter(sys.stdout, fields)
+        writer.writeheader()
+        writer.writerows(results)
+        return
+    def cell(value):
+        if value is None:
+            return '-'
+        if isinstance(value, float):
+            return f"{value:.2f}"
+        return str(value)
+    table = [fields] + [[cell(result[field]) for field in fields] for result in results]
+    widths = [max(len(row[i]) for row in table) for i in range(len(fields))]
+    for row in table:
+        print("  ".join(value.ljust(width) if i < len(fields) - 8 else value.rjust(width)
+                        for i, (value, width) in enumerate(zip(row, widths))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Usage analytics over the inference records of the proxies")
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help="Add new records of ledgers and logs to the store")
+    ingest_parser.add_argument('paths', nargs='+', help="usage-*.jsonl and proxy-*.log files or their directories")
+    ingest_parser.add_argument('--store', required=True, help="Directory of the columnar store")
+    ingest_parser.add_argument('--follow', type=float, metavar='SECONDS', help="Keep ingesting every SECONDS")
+    ingest_parser.add_argument('--pending-timeout', type=float, default=PENDING_TIMEOUT / 3600,
+                               help="Hours a request waits for its response (default 24)")
+    query_parser = commands.add_parser('query', help="Roll up the stored inferences")
+    query_parser.add_argument('--store', required=True, help="Directory of the columnar store")
+    query_parser.add_argument('--by', default='', help=f"Comma-separated dimensions out of {', '.join(DIMENSIONS)}")
+    query_parser.add_argument('--bucket', choices=BUCKETS, default='none', help="Time bucket of the start time")
+    query_parser.add_argument('--from', dest='since', help="First day or time, ISO format")
+    query_parser.add_argument('--to', dest='until', help="End day or time (exclusive), ISO format")
+    query_parser.add_argument('--where', action='append', default=[], metavar='DIMENSION=VALUE',
+                              help="Only inferences with this value; repeat for alternatives or other dimensions")
+    query_parser.add_argument('--sort', help="Sort by this field, descending")
+    query_parser.add_argument('--limit', type=int, help="Print at most this many groups")
+    query_parser.add_argument('--format', choices=('table', 'csv', 'json'), default='table')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        while True:
+            started = time.monotonic()
+            rows = ingest(args.store, args.paths, args.pending_timeout * 3600)
+            print(f"Stored {rows} inferences in {time.monotonic() - started:.1f} s", file=sys.stderr)
+            if not args.follow:
+                break
+            time.sleep(args.follow)
+        return
+
+    by = [name for name in args.by.split(',') if name]
+    if set(by) - set(DIMENSIONS):
+        parser.error(f"--by takes {', '.join(DIMENSIONS)}")
+    where = {}
+    for condition in args.where:
+        name, sep, value = condition.partition('=')
+        if not sep or name not in DIMENSIONS:
+            parser.error(f"--where takes DIMENSION=VALUE with one of {', '.join(DIMENSIONS)}")
+        where.setdefault(name, set()).add(value)
+    started = time.monotonic()
+    results = query(args.store, by, args.bucket,
+                    local_seconds(args.since) if args.since else None,
+                    local_seconds(args.until) if args.until else None, where)
+    elapsed = time.monotonic() - started
+    if args.sort:
+        results.sort(key=lambda result: (result.get(args.sort) is not None, result.get(args.sort)), reverse=True)
+    if args.limit:
+        results = results[:args.limit]
+    fields = (['bucket'] if args.bucket != 'none' else []) + by + [
+        'requests', 'input_tokens', 'output_tokens', 'input_size', 'output_size',
+        'latency_p50', 'latency_p90', 'latency_p99']
+    print_results(results, args.format, fields)
+    print(f"{len(results)} groups in {elapsed:.2f} s", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()